@@ -12,11 +12,10 @@ Usage:
 import sys
 import argparse
 import time
-import statistics
 
 sys.path.insert(0, '.')
 
-import marionette.dsl
+import marionette.profiler
 
 
 class TrafficAnalyzer:
@@ -30,7 +29,7 @@ class TrafficAnalyzer:
     def analyze(self):
         """Analyze the format's traffic characteristics."""
         try:
-            executable = marionette.dsl.load('client', self.format_name)
+            executable = marionette.profiler.load_client(self.format_name)
             
             # Extract state information
             self.states = list(executable.states_.keys())
@@ -64,22 +63,19 @@ class TrafficAnalyzer:
         }
     
     def get_capacity_characteristics(self):
-        """Estimate capacity characteristics."""
-        capacities = []
-        
-        for action in self.actions:
-            if action['module'] == 'fte' and action['args']:
-                # FTE capacity is typically in the args
-                if len(action['args']) >= 2:
-                    capacities.append(action['args'][1])  # msg_len parameter
-        
-        if capacities:
-            return {
-                'min_capacity': min(capacities),
-                'max_capacity': max(capacities),
-                'avg_capacity': statistics.mean(capacities),
-            }
-        return None
+        """Expected capacity and overhead, as measured by marionette.profiler."""
+        try:
+            profile = marionette.profiler.profile(self.format_name)
+        except Exception as e:
+            print(f"Error profiling format: {e}")
+            return None
+
+        return {
+            'bytes_per_connection': profile['bytes_per_connection'],
+            'goodput_ratio': profile['goodput_ratio'],
+            'round_trips': profile['round_trips'],
+            'cpu_per_byte': profile['cpu_per_byte'],
+        }
     
     def print_report(self):
         """Print analysis report."""
@@ -103,13 +99,20 @@ class TrafficAnalyzer:
         capacity = self.get_capacity_characteristics()
         if capacity:
             print(f"\nCapacity Characteristics:")
-            print(f"  Min: {capacity['min_capacity']} bytes")
-            print(f"  Max: {capacity['max_capacity']} bytes")
-            print(f"  Average: {capacity['avg_capacity']:.0f} bytes")
+            print(f"  Payload per connection: {format_value(capacity['bytes_per_connection'], '.0f')} bytes")
+            print(f"  Goodput ratio: {format_value(capacity['goodput_ratio'], '.3f')}")
+            print(f"  Round trips per connection: {format_value(capacity['round_trips'], '.1f')}")
+            print(f"  CPU per payload byte: {format_value(capacity['cpu_per_byte'], '.2e')} s")
         
         print("=" * 60)
 
 
+def format_value(value, spec):
+    """Formats value, which is None if the format never finishes a
+    connection."""
+    return format(value, spec) if value is not None else "N/A"
+
+
 def compare_formats(format_names):
     """Compare multiple formats."""
     print("Format Comparison")
@@ -127,11 +130,11 @@ def compare_formats(format_names):
             }
     
     # Print comparison table
-    print(f"\n{'Format':<30} {'States':<10} {'Actions':<10} {'Blocking':<10} {'Capacity':<15}")
+    print(f"\n{'Format':<30} {'States':<10} {'Actions':<10} {'Blocking':<10} {'Bytes/conn':<15}")
     print("-" * 75)
     
     for fmt, data in results.items():
-        capacity_str = f"{data['capacity']['avg_capacity']:.0f}" if data['capacity'] else "N/A"
+        capacity_str = format_value(data['capacity']['bytes_per_connection'], '.0f') if data['capacity'] else "N/A"
         print(f"{fmt:<30} {data['states']:<10} {data['actions']:<10} {data['timing']['blocking_ops']:<10} {capacity_str:<15}")
 
 
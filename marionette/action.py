@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import re
+import importlib
+
 
 class MarionetteAction(object):
 
@@ -11,6 +14,10 @@ class MarionetteAction(object):
         self.method_ = method
         self.args_ = args
         self.regex_match_incoming_ = regex
+        self.callable_ = None
+        self.prepare_callable_ = None
+        self.prepare_looked_up_ = False
+        self.compiled_regex_ = None
 
     def set_name(self, name):
         self.name_ = name
@@ -26,12 +33,18 @@ class MarionetteAction(object):
 
     def set_module(self, module):
         self.module_ = module
+        self.callable_ = None
+        self.prepare_callable_ = None
+        self.prepare_looked_up_ = False
 
     def get_module(self):
         return self.module_
 
     def set_method(self, method):
         self.method_ = method
+        self.callable_ = None
+        self.prepare_callable_ = None
+        self.prepare_looked_up_ = False
 
     def get_method(self):
         return self.method_
@@ -44,10 +57,38 @@ class MarionetteAction(object):
 
     def set_regex_match_incoming(self, regex):
         self.regex_match_incoming_ = regex
+        self.compiled_regex_ = None
 
     def get_regex_match_incoming(self):
         return self.regex_match_incoming_
 
+    def get_compiled_regex_match_incoming(self):
+        if self.regex_match_incoming_ and self.compiled_regex_ is None:
+            self.compiled_regex_ = re.compile(self.regex_match_incoming_)
+        return self.compiled_regex_
+
+    def get_callable(self):
+        """Returns the plugin function implementing this action. It's looked
+        up once and cached, as actions are evaluated on every transition
+        attempt."""
+        if self.callable_ is None:
+            plugin = importlib.import_module(
+                "marionette.plugins._" + self.module_)
+            self.callable_ = getattr(plugin, self.method_)
+        return self.callable_
+
+    def get_prepare_callable(self):
+        """Returns the plugin function that gets this action ready ahead of
+        time, prepare_<method>, or None if the plugin doesn't have one. Like
+        get_callable(), it's looked up once and cached."""
+        if not self.prepare_looked_up_:
+            plugin = importlib.import_module(
+                "marionette.plugins._" + self.module_)
+            self.prepare_callable_ = getattr(
+                plugin, "prepare_" + self.method_, None)
+            self.prepare_looked_up_ = True
+        return self.prepare_callable_
+
     def execute(self, party, name):
         retval = None
 
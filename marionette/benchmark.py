@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmarks for the record layer, the multiplexer, the fte and tg
+plugins, the DSL parser and model transitions.
+
+    python -m marionette.benchmark [--filter REGEX] [--json OUTPUT]
+                                   [--compare BASELINE] [--threshold 0.1]
+
+As with pyperf, each benchmark is timed by running it in a loop calibrated
+to take at least --min-time seconds, repeated --repeat times, and the
+result is the time per call of each repeat. --json saves the results, and
+--compare checks them against a saved baseline: benchmarks whose median
+is slower by more than --threshold are reported as regressions, and the
+exit status is 1 if there are any. --input compares saved results instead
+of running the benchmarks.
+
+Benchmarks are registered with @benchmark, as a generator yielding
+(name, setup) pairs; setup() builds what's needed and returns the function
+to time. This keeps setup (say, compiling a DFA) out of the timings, and
+out of the run altogether for benchmarks excluded by --filter.
+"""
+
+import re
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+
+sys.path.append('.')
+
+import fte
+
+import marionette.channel
+import marionette.conf
+import marionette.dsl
+import marionette.executables.pioa
+import marionette.multiplexer
+import marionette.record_layer
+
+RESULTS_VERSION = 1
+
+MIN_TIME_S = 0.05
+REPEAT = 5
+THRESHOLD = 0.1
+
+PAYLOAD_LEN = 4096
+
+BENCHMARKS = []
+
+
+def benchmark(fn):
+    BENCHMARKS.append(fn)
+    return fn
+
+
+class SinkTransport(object):
+    """Stands in for a twisted transport, keeping only the last write."""
+
+    def __init__(self):
+        self.last_write_ = b''
+
+    def write(self, data, addr=None):
+        self.last_write_ = data
+
+    def loseConnection(self):
+        pass
+
+
+class SinkProtocol(object):
+
+    def __init__(self):
+        self.transport = SinkTransport()
+
+
+def new_channel():
+    return marionette.channel.Channel(SinkProtocol(), 'tcp')
+
+
+def new_marionette_state(model_uuid=1, model_instance_id=1):
+    marionette_state = marionette.executables.pioa.MarionetteSystemState()
+    marionette_state.set_local("model_uuid", model_uuid)
+    marionette_state.set_local("model_instance_id", model_instance_id)
+    marionette_state.set_global("multiplexer_outgoing",
+                                marionette.multiplexer.BufferOutgoing())
+    marionette_state.set_global("multiplexer_incoming",
+                                marionette.multiplexer.BufferIncoming())
+    return marionette_state
+
+
+def get_format_names():
+    """Returns the names of the formats we ship, each once."""
+    retval = set()
+    for mar_file in marionette.dsl.list_mar_files('client'):
+        retval.add(mar_file.split(':')[0])
+    return sorted(retval)
+
+
+def load_client(format_name):
+    mar_path = marionette.dsl.find_mar_files('client', format_name)[-1]
+    return marionette.dsl.load('client', format_name, mar_path)
+
+
+def get_plugin_actions(module):
+    """Returns {name: (format_name, action)} for the send actions of module
+    in all formats, one per distinct set of arguments."""
+    retval = {}
+    seen = set()
+    for format_name in get_format_names():
+        try:
+            executable = load_client(format_name)
+        except Exception:
+            continue
+        for action in executable.actions_:
+            if action.get_module() != module or \
+                    not action.get_method().startswith('send'):
+                continue
+            key = tuple(action.get_args())
+            if key in seen:
+                continue
+            seen.add(key)
+            retval["%s:%s" % (format_name, action.get_name())] = action
+    return retval
+
+# benchmarks
+
+
+@benchmark
+def record_layer():
+    def serialize():
+        cell_obj = marionette.record_layer.Cell(1, 1, 1, 1)
+        cell_obj.set_payload(b'x' * PAYLOAD_LEN)
+        return cell_obj.to_bytes
+
+    def unserialize():
+        cell_obj = marionette.record_layer.Cell(1, 1, 1, 1)
+        cell_obj.set_payload(b'x' * PAYLOAD_LEN)
+        ptxt = cell_obj.to_bytes()
+        return lambda: marionette.record_layer.unserialize(ptxt)
+
+    yield ("record_layer.serialize", serialize)
+    yield ("record_layer.unserialize", unserialize)
+
+
+@benchmark
+def multiplexer():
+    header_bits = marionette.record_layer.PAYLOAD_HEADER_SIZE_IN_BITS
+
+    def push_pop():
+        buf = marionette.multiplexer.BufferOutgoing()
+        data = b'x' * (16 * PAYLOAD_LEN)
+
+        def run():
+            buf.push(1, data)
+            while buf.has_data(1):
+                buf.pop(1, 1, header_bits + PAYLOAD_LEN * 8)
+        return run
+
+    def pop_packed():
+        buf = marionette.multiplexer.BufferOutgoing()
+        data = b'x' * 512
+
+        def run():
+            for stream_id in range(1, 33):
+                buf.push(stream_id, data)
+            buf.pop_packed(1, 1, buf.queued_bits())
+        return run
+
+    def incoming_push():
+        buf = marionette.multiplexer.BufferIncoming()
+        cells = []
+        for seq_id in range(1, 17):
+            cell_obj = marionette.record_layer.Cell(1, 1, 1, seq_id)
+            cell_obj.set_payload(b'x' * PAYLOAD_LEN)
+            cells.append(cell_obj.to_bytes())
+        data = b''.join(cells)
+
+        def run():
+            buf.push(data)
+            buf.pop_cells()
+        return run
+
+    yield ("multiplexer.BufferOutgoing.push_pop", push_pop)
+    yield ("multiplexer.BufferOutgoing.pop_packed", pop_packed)
+    yield ("multiplexer.BufferIncoming.push", incoming_push)
+
+
+@benchmark
+def fte_plugin():
+    from marionette.plugins import _fte
+
+    def send(action):
+        marionette_state = new_marionette_state()
+        multiplexer = marionette_state.get_global("multiplexer_outgoing")
+        channel = new_channel()
+        data = b'x' * PAYLOAD_LEN
+
+        def run():
+            multiplexer.push(1, data)
+            _fte.send(channel, marionette_state, action.get_args())
+        return run
+
+    def recv(action):
+        marionette_state = new_marionette_state()
+        marionette_state.get_global("multiplexer_outgoing").push(
+            1, b'x' * PAYLOAD_LEN)
+        channel = new_channel()
+        _fte.send(channel, marionette_state, action.get_args())
+        ctxt = channel.protocol_.transport.last_write_
+        incoming = marionette_state.get_global("multiplexer_incoming")
+
+        def run():
+            channel.appendToBuffer(ctxt)
+            _fte.recv(channel, marionette_state, action.get_args())
+            incoming.pop_cells()
+        return run
+
+    for (name, action) in sorted(get_plugin_actions('fte').items()):
+        yield ("fte.send[%s]" % name, lambda action=action: send(action))
+        yield ("fte.recv[%s]" % name, lambda action=action: recv(action))
+
+
+@benchmark
+def tg_plugin():
+    from marionette.plugins import _tg
+
+    def send(grammar):
+        _tg.warm_up([grammar])
+        marionette_state = new_marionette_state()
+        multiplexer = marionette_state.get_global("multiplexer_outgoing")
+        channel = new_channel()
+        data = b'x' * PAYLOAD_LEN
+
+        def run():
+            multiplexer.push(1, data)
+            _tg.send(channel, marionette_state, [grammar])
+        return run
+
+    def recv(grammar):
+        _tg.warm_up([grammar])
+        marionette_state = new_marionette_state()
+        marionette_state.get_global("multiplexer_outgoing").push(
+            1, b'x' * PAYLOAD_LEN)
+        channel = new_channel()
+        _tg.send(channel, marionette_state, [grammar])
+        ctxt = channel.protocol_.transport.last_write_
+        incoming = marionette_state.get_global("multiplexer_incoming")
+
+        def run():
+            channel.appendToBuffer(ctxt)
+            _tg.recv(channel, marionette_state, [grammar])
+            incoming.pop_cells()
+        return run
+
+    grammars = set()
+    for action in get_plugin_actions('tg').values():
+        grammars.add(action.get_args()[0])
+    for grammar in sorted(grammars):
+        yield ("tg.send[%s]" % grammar, lambda grammar=grammar: send(grammar))
+        yield ("tg.recv[%s]" % grammar, lambda grammar=grammar: recv(grammar))
+
+
+@benchmark
+def dsl():
+    def parse(format_name):
+        mar_path = marionette.dsl.find_mar_files('client', format_name)[-1]
+        with open(mar_path) as f:
+            mar_str = f.read()
+        return lambda: marionette.dsl.parse(mar_str)
+
+    for format_name in get_format_names():
+        yield ("dsl.parse[%s]" % format_name,
+               lambda format_name=format_name: parse(format_name))
+
+
+@benchmark
+def pioa():
+    def transition(format_name):
+        executable = load_client(format_name)
+        if executable.first_sender_ != 'client':
+            raise Exception("the server sends first")
+        executable.set_multiplexer_outgoing(
+            marionette.multiplexer.BufferOutgoing())
+        executable.set_multiplexer_incoming(
+            marionette.multiplexer.BufferIncoming())
+        executable.set_channel(new_channel())
+        model_instance_id = executable.get_local("model_instance_id")
+
+        # one run is every transition up to the first the client can't
+        # make on its own, normally a recv
+        def run():
+            executable.current_state_ = 'start'
+            executable.next_state_ = None
+            executable.rng_.seed(model_instance_id)
+            for i in range(marionette.executables.pioa.MAX_TRANSITIONS_PER_CALL):
+                if not executable.isRunning() or not executable.transition():
+                    break
+        return run
+
+    for format_name in get_format_names():
+        yield ("pioa.transition[%s]" % format_name,
+               lambda format_name=format_name: transition(format_name))
+
+# running and comparing
+
+
+def time_benchmark(fn, min_time=MIN_TIME_S, repeat=REPEAT):
+    """Returns {'loops': n, 'values': [seconds per call, ...]} for fn."""
+    loops = 1
+    while True:
+        elapsed = time_loops(fn, loops)
+        if elapsed >= min_time:
+            break
+        if elapsed > 0:
+            loops = max(loops * 2, int(loops * min_time * 1.2 / elapsed))
+        else:
+            loops *= 10
+
+    values = [time_loops(fn, loops) / loops for i in range(repeat)]
+    return {'loops': loops, 'values': values}
+
+
+def time_loops(fn, loops):
+    t0 = time.perf_counter()
+    for i in range(loops):
+        fn()
+    return time.perf_counter() - t0
+
+
+def summarize(result):
+    values = result['values']
+    result['median'] = statistics.median(values)
+    result['mean'] = statistics.mean(values)
+    result['stdev'] = statistics.stdev(values) if len(values) > 1 else 0.0
+    result['min'] = min(values)
+    return result
+
+
+def run_benchmarks(name_filter=None, min_time=MIN_TIME_S, repeat=REPEAT,
+                   out=None):
+    """Runs the benchmarks whose name matches name_filter, and returns their
+    results, ready to be saved as JSON."""
+    if name_filter:
+        name_filter = re.compile(name_filter)
+
+    benchmarks = {}
+    for group in BENCHMARKS:
+        for (name, setup) in group():
+            if name_filter and not name_filter.search(name):
+                continue
+            try:
+                fn = setup()
+                result = summarize(time_benchmark(fn, min_time, repeat))
+            except Exception as e:
+                if out:
+                    out.write("%-60s skipped: %s\n" % (name, e))
+                continue
+            benchmarks[name] = result
+            if out:
+                out.write("%-60s %s +- %s\n" % (
+                    name, format_time(result['median']),
+                    format_time(result['stdev'])))
+                out.flush()
+
+    return {
+        'version': RESULTS_VERSION,
+        'metadata': get_metadata(min_time, repeat),
+        'benchmarks': benchmarks,
+    }
+
+
+def get_metadata(min_time, repeat):
+    return {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'fte': getattr(fte, '__version__', 'unknown'),
+        'fte.workers': marionette.conf.get("fte.workers"),
+        'min_time': min_time,
+        'repeat': repeat,
+    }
+
+
+def compare(baseline, results, threshold=THRESHOLD):
+    """Returns (name, baseline median, median, ratio, status) for each
+    benchmark in both, where status is 'slower' or 'faster' if the medians
+    differ by more than threshold, else 'same'."""
+    retval = []
+    for name in sorted(results['benchmarks']):
+        if name not in baseline['benchmarks']:
+            continue
+        old = baseline['benchmarks'][name]['median']
+        new = results['benchmarks'][name]['median']
+        ratio = new / old if old > 0 else float('inf')
+        if ratio > 1 + threshold:
+            status = 'slower'
+        elif ratio < 1 / (1 + threshold):
+            status = 'faster'
+        else:
+            status = 'same'
+        retval.append((name, old, new, ratio, status))
+    return retval
+
+
+def format_time(seconds):
+    for (unit, scale) in [('s', 1), ('ms', 1e-3), ('us', 1e-6)]:
+        if seconds >= scale:
+            return "%.2f %s" % (seconds / scale, unit)
+    return "%.0f ns" % (seconds / 1e-9)
+
+
+def load_results(path):
+    with open(path) as f:
+        results = json.load(f)
+    if results.get('version') != RESULTS_VERSION:
+        raise ValueError("%s: unsupported results version %s" % (
+            path, results.get('version')))
+    return results
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Marionette microbenchmarks.')
+    parser.add_argument('--filter', '-k', dest='filter',
+        help='only run benchmarks whose name matches this regex')
+    parser.add_argument('--json', '-o', dest='json',
+        help='save the results to this file')
+    parser.add_argument('--compare', '-c', dest='compare',
+        help='compare the results with those saved in this file')
+    parser.add_argument('--input', '-i', dest='input',
+        help='compare the results saved in this file instead of running')
+    parser.add_argument('--threshold', '-t', dest='threshold', type=float,
+        default=THRESHOLD,
+        help='relative slowdown reported as a regression (default %.2f)'
+             % THRESHOLD)
+    parser.add_argument('--min-time', dest='min_time', type=float,
+        default=MIN_TIME_S,
+        help='minimum time per repeat in seconds (default %.2f)' % MIN_TIME_S)
+    parser.add_argument('--repeat', '-r', dest='repeat', type=int,
+        default=REPEAT, help='repeats per benchmark (default %d)' % REPEAT)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.input:
+        results = load_results(args.input)
+    else:
+        # time the plugins themselves, not the round trip to a pool
+        marionette.conf.set("fte.workers", 0)
+        results = run_benchmarks(args.filter, args.min_time, args.repeat,
+                                 sys.stdout)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    retval = 0
+    if args.compare:
+        baseline = load_results(args.compare)
+        print("")
+        for (name, old, new, ratio, status) in compare(
+                baseline, results, args.threshold):
+            print("%-60s %10s -> %10s  x%.2f %s" % (
+                name, format_time(old), format_time(new), ratio,
+                status if status != 'same' else ''))
+            if status == 'slower':
+                retval = 1
+
+    return retval
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,17 +3,37 @@
 
 import os
 import sys
+import weakref
 import threading
 
 import twisted.internet.error
 from twisted.internet import protocol
 from twisted.internet import reactor
-from twisted.python import log
 
 sys.path.append('.')
 
 import marionette.conf
+import marionette.logger
+import marionette.metrics
 
+LOG = marionette.logger.get_logger('channel')
+
+# open channels, read when metrics are collected
+channels_ = weakref.WeakSet()
+
+
+def get_active_channels():
+    retval = {}
+    for channel in list(channels_):
+        if not channel.is_closed():
+            key = (str(channel.party), channel.transport_protocol_)
+            retval[key] = retval.get(key, 0) + 1
+    return retval
+
+
+marionette.metrics.gauge(
+    'marionette_channels_active', 'Open channels.',
+    ['party', 'transport']).set_function(get_active_channels)
 
 
 class Channel(object):
@@ -31,6 +51,17 @@ class Channel(object):
         self.remote_host = None
         self.remote_port = None
         self.party = None #client/server
+        self.data_callbacks_ = []
+        channels_.add(self)
+
+    def add_data_callback(self, callback):
+        """Call ``callback()`` whenever new data is appended to the buffer."""
+        if callback not in self.data_callbacks_:
+            self.data_callbacks_.append(callback)
+
+    def remove_data_callback(self, callback):
+        if callback in self.data_callbacks_:
+            self.data_callbacks_.remove(callback)
 
     def appendToBuffer(self, chunk):
         with self.buffer_lock_:
@@ -39,6 +70,9 @@ class Channel(object):
                 chunk = chunk.decode('latin-1')
             self.buffer_ += chunk
 
+        for callback in list(self.data_callbacks_):
+            callback()
+
     def recv(self):
         with self.buffer_lock_:
             retval = self.buffer_
@@ -50,6 +84,17 @@ class Channel(object):
         with self.buffer_lock_:
             return self.buffer_
 
+    def consume(self, prefix, n):
+        """Removes the first n bytes of the buffer, provided that it still
+        starts with prefix (as returned by an earlier peek()). Returns whether
+        it did."""
+        with self.buffer_lock_:
+            if not self.buffer_.startswith(prefix):
+                return False
+            self.last_buffer_ = self.buffer_[:n]
+            self.buffer_ = self.buffer_[n:]
+        return True
+
     def send(self, data):
         # Convert string to bytes using latin-1 encoding (preserves byte values 0-255)
         if isinstance(data, str):
@@ -105,23 +150,25 @@ class MyClient(protocol.Protocol):
             self.channel.remote_port = self.port
             self.channel.party = 'client'
             self.callback_(self.channel)
-            log.msg("channel.Client: UDP Connection established %s:%d" 
-                % (self.host, self.port))
+            LOG.info("channel.Client: UDP Connection established %s:%d",
+                     self.host, self.port)
 
     def datagramReceived(self, chunk, addr):
         host, port = addr
-        log.msg("channel.Client: %d bytes received" % len(chunk))
+        if LOG.debug_enabled:
+            LOG.debug("channel.Client: %d bytes received", len(chunk))
         self.channel.appendToBuffer(chunk)
 
     def doStop(self):
         if self.transport_protocol == 'udp':
-            log.msg("channel.Client.doStop: Stopping UDP connection")
+            LOG.info("channel.Client.doStop: Stopping UDP connection")
 
     def connectionMade(self):
-        log.msg("channel.Client.connectionMade")
+        LOG.info("channel.Client.connectionMade")
 
     def dataReceived(self, chunk):
-        log.msg("channel.Client: %d bytes received" % len(chunk))
+        if LOG.debug_enabled:
+            LOG.debug("channel.Client: %d bytes received", len(chunk))
         self.channel.appendToBuffer(chunk)
 
 
@@ -145,7 +192,9 @@ def open_new_channel(transport_protocol, port, callback):
     return True
 
 def start_connection(transport_protocol, port, callback):
-    if transport_protocol == 'tcp':
+    if loopback_ is not None:
+        loopback_.connect(transport_protocol, int(port), callback)
+    elif transport_protocol == 'tcp':
         factory = MyClientFactory(callback)
         factory.protocol = MyClient
         reactor.connectTCP(marionette.conf.get("server.server_ip"),
@@ -164,31 +213,36 @@ def start_connection(transport_protocol, port, callback):
 
 incoming = {}
 incoming_lock = threading.RLock()
+incoming_callbacks_ = {}
 listening_sockets_ = {}
+inherited_sockets_ = {}
+loopback_ = None
 
 class MyServer(protocol.Protocol):
 
     def __init__(self, transport_protocol='tcp'):
         self.transport_protocol = transport_protocol
-        log.msg("channel.Server transport_protocol: %s" % self.transport_protocol)
+        LOG.debug("channel.Server transport_protocol: %s",
+                  self.transport_protocol)
 
     def connectionMade(self):
-        log.msg("channel.Server.connectionMade")
+        LOG.info("channel.Server.connectionMade")
         port = int(self.transport.getHost().port)
-        with incoming_lock:
-            if not incoming.get(port):
-                incoming[port] = []
-            incoming[port].append(self)
         self.channel = Channel(self, self.transport_protocol)
         self.channel.party = "server"
+        add_incoming(port, self)
 
     def dataReceived(self, chunk):
         self.channel.appendToBuffer(chunk)
-        log.msg("channel.Server[%s]: %d bytes received" % (self.channel, len(chunk)))
+        if LOG.debug_enabled:
+            LOG.debug("channel.Server[%s]: %d bytes received", self.channel,
+                      len(chunk))
 
     def datagramReceived(self, chunk, addr):
         host, port = addr
-        log.msg("channel.Server[%s]: %d bytes received" % (self.channel, len(chunk)))
+        if LOG.debug_enabled:
+            LOG.debug("channel.Server[%s]: %d bytes received", self.channel,
+                      len(chunk))
         if self.channel.is_closed():
             self.connectionMade()
         self.channel.remote_host = host
@@ -196,7 +250,19 @@ class MyServer(protocol.Protocol):
         self.channel.appendToBuffer(chunk)
 
     def doStop(self):
-        log.msg("channel.Server.doStop: Stopping UDP connection")
+        LOG.info("channel.Server.doStop: Stopping UDP connection")
+
+def add_incoming(port, protocol):
+    """Queues protocol, whose channel has just been opened, for
+    accept_new_channel on port."""
+    with incoming_lock:
+        if not incoming.get(port):
+            incoming[port] = []
+        incoming[port].append(protocol)
+
+    callback = incoming_callbacks_.get(port)
+    if callback:
+        callback()
 
 def bind(port=0):
     with incoming_lock:
@@ -215,19 +281,57 @@ def accept_new_channel(transport_protocol, port):
 
     return channel
 
+def set_incoming_callback(port, callback):
+    """Call ``callback()`` whenever a new channel arrives on ``port``."""
+    with incoming_lock:
+        if callback:
+            incoming_callbacks_[port] = callback
+        else:
+            incoming_callbacks_.pop(port, None)
+
+def set_inherited_sockets(sockets):
+    """Listen on the already bound sockets in ``sockets``, a dict of
+    {(transport_protocol, port): socket}, instead of binding new ones. Used
+    by server workers, see marionette.workers."""
+    with incoming_lock:
+        inherited_sockets_.clear()
+        inherited_sockets_.update(sockets)
+
+def set_loopback(loopback):
+    """Connect and listen through loopback, a marionette.loopback.Loopback,
+    instead of the network. None goes back to the network."""
+    global loopback_
+
+    with incoming_lock:
+        loopback_ = loopback
+
 def start_listener(transport_protocol, port):
     retval = port
 
     if not port or not listening_sockets_.get(port):
         try:
-            if transport_protocol == 'tcp':
+            sock = None
+            if port:
+                sock = inherited_sockets_.get((transport_protocol, int(port)))
+
+            if loopback_ is not None:
+                connector = loopback_.listen(transport_protocol, int(port))
+            elif transport_protocol == 'tcp':
                 factory = protocol.Factory()
                 factory.protocol = MyServer
-                connector = reactor.listenTCP(int(port), factory,
-                        interface=marionette.conf.get("server.server_ip"))
+                if sock:
+                    connector = reactor.adoptStreamPort(sock.fileno(),
+                            sock.family, factory)
+                else:
+                    connector = reactor.listenTCP(int(port), factory,
+                            interface=marionette.conf.get("server.server_ip"))
             else: #udp
-                connector = reactor.listenUDP(int(port), MyServer('udp'),
-                        interface=marionette.conf.get("server.server_ip"), maxPacketSize=65535)
+                if sock:
+                    connector = reactor.adoptDatagramPort(sock.fileno(),
+                            sock.family, MyServer('udp'), maxPacketSize=65535)
+                else:
+                    connector = reactor.listenUDP(int(port), MyServer('udp'),
+                            interface=marionette.conf.get("server.server_ip"), maxPacketSize=65535)
             port = connector.getHost().port
             listening_sockets_[port] = connector
             retval = port
@@ -239,6 +343,7 @@ def start_listener(transport_protocol, port):
 
 def stop_accepting_new_channels(transport_protocol, port):
     with incoming_lock:
+        incoming_callbacks_.pop(port, None)
         if listening_sockets_.get(port):
             listening_sockets_[port].stopListening()
             del listening_sockets_[port]
@@ -7,7 +7,6 @@ import time
 sys.path.append('.')
 
 from twisted.internet import reactor
-from twisted.python import log
 
 from . import driver
 from . import multiplexer
@@ -15,8 +14,17 @@ from . import record_layer
 from . import updater
 from . import dsl
 from . import conf
+from . import wakeup
+from . import logger
 
-EVENT_LOOP_FREQUENCY_S = 0.01
+# the driver wakes us up when a model finishes; this is only a fallback for
+# anything that slips through
+HOUSEKEEPING_INTERVAL_S = 1.0
+# pause between a model finishing and its replacement starting, so that
+# formats with short-lived connections don't spin when there's no traffic
+MODEL_RESTART_DELAY_S = 0.01
+
+LOG = logger.get_logger('client')
 AUTOUPDATE_DELAY = 5
 CLEANUP_INTERVAL_S = 60  # Run cleanup every 60 seconds
 
@@ -30,15 +38,20 @@ class Client(object):
         self.streams_ = {}
         self.stream_last_activity = {}  # Track last activity time for each stream
         self.stream_counter_ = random.randint(1,2**32-1)
+        self.reactor_ = None
+        self.wakeup_ = wakeup.Wakeup(self.execute)
 
         self.set_driver(format_name, format_version)
         self.reload_ = False
+        self.stopped_ = False
 
         # first update must be
-        reactor.callLater(AUTOUPDATE_DELAY, self.check_for_update)
+        self.update_call_ = reactor.callLater(AUTOUPDATE_DELAY,
+                                              self.check_for_update)
         
         # Schedule periodic cleanup
-        reactor.callLater(CLEANUP_INTERVAL_S, self._periodic_cleanup, reactor)
+        self.cleanup_call_ = reactor.callLater(CLEANUP_INTERVAL_S,
+                                               self._periodic_cleanup, reactor)
 
     def set_driver(self, format_name, format_version=None):
         self.format_name_ = format_name
@@ -50,6 +63,7 @@ class Client(object):
         self.driver_ = driver.ClientDriver("client")
         self.driver_.set_multiplexer_incoming(self.multiplexer_incoming_)
         self.driver_.set_multiplexer_outgoing(self.multiplexer_outgoing_)
+        self.driver_.set_wakeup_callback(self.wakeup)
         self.driver_.setFormat(self.format_name_, self.format_version_)
 
     def get_format(self):
@@ -59,15 +73,34 @@ class Client(object):
         return retval
 
     def execute(self, reactor):
+        if self.stopped_:
+            return
+        self.reactor_ = reactor
+
         if self.driver_.isRunning():
             self.driver_.execute(reactor)
+
+        if self.driver_.isRunning():
+            self.wakeup_.schedule(reactor, HOUSEKEEPING_INTERVAL_S)
         else:
             if self.reload_:
                 self.set_driver(self.format_name_)
                 self.reload_ = False
             self.driver_.reset()
+            self.wakeup_.schedule(reactor, MODEL_RESTART_DELAY_S)
+
+    def wakeup(self):
+        if self.reactor_ and not self.stopped_:
+            self.wakeup_.schedule(self.reactor_)
 
-        reactor.callLater(EVENT_LOOP_FREQUENCY_S, self.execute, reactor)
+    def stop(self):
+        """Stops our models and doesn't start any new ones."""
+        self.stopped_ = True
+        self.wakeup_.cancel()
+        self.driver_.stop()
+        for call in [self.update_call_, self.cleanup_call_]:
+            if call.active():
+                call.cancel()
 
     def process_cell(self, cell_obj):
         payload = cell_obj.get_payload()
@@ -79,8 +112,8 @@ class Client(object):
             try:
                 self.streams_[stream_id].srv_queue.put(payload)
             except:
-                log.msg("Client.process_cell: Caught KeyError exception for stream_id :%d"
-                    % (stream_id))
+                LOG.warning("Client.process_cell: Caught KeyError exception "
+                            "for stream_id :%d", stream_id)
                 return
 
     def start_new_stream(self, srv_queue=None):
@@ -120,8 +153,9 @@ class Client(object):
                 orphaned_streams.append(stream_id)
         
         for stream_id in orphaned_streams:
-            log.msg("Cleaning up orphaned stream %d (inactive for %.1f seconds)" %
-                   (stream_id, current_time - self.stream_last_activity.get(stream_id, 0)))
+            LOG.info("Cleaning up orphaned stream %d (inactive for %.1f seconds)",
+                     stream_id,
+                     current_time - self.stream_last_activity.get(stream_id, 0))
             self._cleanup_stream(stream_id)
         
         return len(orphaned_streams)
@@ -135,11 +169,13 @@ class Client(object):
         self.cleanup_orphaned_streams()
         
         # Schedule next cleanup
-        reactor.callLater(CLEANUP_INTERVAL_S, self._periodic_cleanup, reactor)
+        self.cleanup_call_ = reactor.callLater(CLEANUP_INTERVAL_S,
+                                               self._periodic_cleanup, reactor)
 
     # call this function if you want reload formats from disk
     # at the next possible time
     def reload_driver(self):
+        dsl.invalidate_compiled_formats()
         self.reload_ = True
 
     def check_for_update(self):
@@ -45,6 +45,28 @@ def parse_conf():
         conf_["server.server_ip"] = confparser.get("server", "server_ip")
         conf_["server.proxy_ip"] = confparser.get("server", "proxy_ip")
         conf_["server.proxy_port"] = confparser.getint("server", "proxy_port")
+        conf_["multiplexer.scheduler"] = confparser.get("multiplexer",
+            "scheduler", fallback="random")
+        conf_["fte.dfa_cache"] = confparser.getboolean("fte", "dfa_cache",
+            fallback=True)
+        conf_["fte.dfa_cache_dir"] = confparser.get("fte", "dfa_cache_dir",
+            fallback="")
+        conf_["fte.workers"] = confparser.getint("fte", "workers",
+            fallback=0)
+        conf_["fte.covertext_pool"] = confparser.getint("fte",
+            "covertext_pool", fallback=4)
+        conf_["fte.presend"] = confparser.getboolean("fte", "presend",
+            fallback=False)
+        conf_["fte.pack_cells"] = confparser.getboolean("fte", "pack_cells",
+            fallback=False)
+        conf_["metrics.listen"] = confparser.get("metrics", "listen",
+            fallback="")
+        conf_["logging.level"] = confparser.get("logging", "level",
+            fallback="")
+        conf_["logging.levels"] = confparser.get("logging", "levels",
+            fallback="")
+        conf_["logging.sample"] = confparser.get("logging", "sample",
+            fallback="")
     except Exception as e:
         print('cannot parse conf file')
         sys.exit(1)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Pools of ready-made covertexts.
+
+Some covertexts don't carry any data: fte padding cells sent when no stream
+has anything to send, and the dummy bodies tg handlers fill messages of the
+wrong size for fte with. They can be made ahead of time, so a pool keeps a
+few of each kind ready and tops itself up in the background, a few
+covertexts per reactor iteration, after it's drawn from. Idle traffic then
+costs next to nothing when it's sent.
+
+Every covertext is handed out once; padding cells are encrypted, and we
+never want the same ciphertext on the wire twice.
+"""
+
+import sys
+import weakref
+import collections
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+sys.path.append('.')
+
+import marionette.conf
+import marionette.logger
+
+LOG = marionette.logger.get_logger('covertext_pool')
+
+# covertexts made per reactor iteration, over all pools
+REFILLS_PER_CALL = 4
+
+shared_pools_ = {}
+refilling_ = weakref.WeakSet()
+refill_call_ = None
+
+
+def get_pool_size():
+    return marionette.conf.get("fte.covertext_pool")
+
+
+class CovertextPool(object):
+    """Covertexts made by make(), which returns one or a Deferred for one.
+
+    A pool only starts filling up once it's been drawn from twice, and
+    holds at most one covertext fewer than have been drawn, so that short
+    lived models don't pay for covertexts they never send."""
+
+    def __init__(self, make, size=None):
+        self.make_ = make
+        self.size_ = get_pool_size() if size is None else size
+        self.covertexts_ = collections.deque()
+        self.filling_ = 0
+        self.taken_ = 0
+
+    def __len__(self):
+        return len(self.covertexts_)
+
+    def get(self):
+        """Returns a covertext, made there and then (so possibly a Deferred)
+        if the pool is empty. Either way the pool is topped up later."""
+        self.taken_ += 1
+        if self.covertexts_:
+            retval = self.covertexts_.popleft()
+        else:
+            retval = self.make_()
+        self.request_refill()
+        return retval
+
+    def is_full(self):
+        target = min(self.size_, self.taken_ - 1)
+        return len(self.covertexts_) + self.filling_ >= target
+
+    def request_refill(self):
+        if not self.is_full():
+            refilling_.add(self)
+            schedule_refill()
+
+    def refill_one(self):
+        covertext = self.make_()
+        if isinstance(covertext, defer.Deferred):
+            self.filling_ += 1
+            covertext.addCallbacks(self.refilled, self.refill_failed)
+        else:
+            self.covertexts_.append(covertext)
+
+    def refilled(self, covertext):
+        self.filling_ -= 1
+        self.covertexts_.append(covertext)
+
+    def refill_failed(self, failure):
+        self.filling_ -= 1
+        LOG.warning("Can't make covertext: %s", failure.getErrorMessage())
+
+
+def get_shared_pool(key, make):
+    """Returns the process-wide pool for key, creating it with make if
+    there's none yet. make must only depend on key."""
+    pool = shared_pools_.get(key)
+    if pool is None:
+        pool = CovertextPool(make)
+        shared_pools_[key] = pool
+    return pool
+
+
+def schedule_refill():
+    global refill_call_
+
+    if refill_call_ is None or not refill_call_.active():
+        refill_call_ = reactor.callLater(0, refill)
+
+
+def refill():
+    """Makes up to REFILLS_PER_CALL covertexts, one per pool in turn, and
+    comes back for more on the next reactor iteration. Pools of models that
+    have finished drop out on their own."""
+    global refill_call_
+
+    refill_call_ = None
+    made = 0
+    while made < REFILLS_PER_CALL and len(refilling_) > 0:
+        for pool in list(refilling_):
+            if pool.is_full():
+                refilling_.discard(pool)
+                continue
+            try:
+                pool.refill_one()
+            except Exception as e:
+                LOG.warning("Can't make covertext: %s", e)
+                refilling_.discard(pool)
+            made += 1
+            if made == REFILLS_PER_CALL:
+                break
+
+    if len(refilling_) > 0:
+        schedule_refill()
+
+
+def clear():
+    """Drops all pools."""
+    global refill_call_
+
+    shared_pools_.clear()
+    refilling_.clear()
+    if refill_call_ is not None and refill_call_.active():
+        refill_call_.cancel()
+    refill_call_ = None
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Caches for the DFAs behind fte and tg actions.
+
+Turning a regex into a minimized DFA is the slow part of loading a format,
+so the result of fte.regex2dfa.regex2dfa is kept on disk, one file per
+regex, and survives restarts. The directory is versioned by CACHE_VERSION
+and the fte and regex2dfa versions, so that upgrading either never serves a
+DFA the other side would build differently.
+
+The encoders and rankers built from a DFA for a given msg_len are only kept
+in memory, shared within the process and rebuilt from the cached DFA by the
+next one. Building them from a DFA is cheap next to regex2dfa itself: with
+fte 0.3.0 the 17 (regex, msg_len) pairs of the shipped formats take about
+20ms for all encoders and as much for all rankers, at most 1-3ms for one,
+and their counting tables are bigints that would cost about as much to
+unpickle. The DFA is the only part worth persisting.
+"""
+
+import os
+import sys
+import hashlib
+import tempfile
+import importlib.metadata
+
+import fte
+import fte.dfa
+import fte.encoder
+
+sys.path.append('.')
+
+import marionette.conf
+import marionette.logger
+
+LOG = marionette.logger.get_logger('dfa_cache')
+
+CACHE_VERSION = 1
+
+dfas_ = {}
+encoders_ = {}
+rankers_ = {}
+
+
+def get_cache_dir():
+    """Returns the directory DFAs are persisted in, or None if the on-disk
+    cache is disabled."""
+    if not marionette.conf.get("fte.dfa_cache"):
+        return None
+
+    cache_dir = marionette.conf.get("fte.dfa_cache_dir")
+    if not cache_dir:
+        cache_home = os.environ.get('XDG_CACHE_HOME') or \
+            os.path.join(os.path.expanduser('~'), '.cache')
+        cache_dir = os.path.join(cache_home, 'marionette', 'dfa')
+
+    return os.path.join(cache_dir, 'v%d-fte%s-regex2dfa%s' % (
+        CACHE_VERSION, get_version('fte'), get_version('regex2dfa')))
+
+
+def get_version(package):
+    """Returns the installed version of package, or 'unknown'."""
+    try:
+        return importlib.metadata.version(package)
+    except importlib.metadata.PackageNotFoundError:
+        if package == 'fte':
+            return getattr(fte, '__version__', 'unknown')
+        return 'unknown'
+
+
+def get_cache_path(regex):
+    cache_dir = get_cache_dir()
+    if not cache_dir:
+        return None
+
+    digest = hashlib.sha256(regex.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, digest + '.dfa')
+
+
+def regex2dfa(regex):
+    """fte.regex2dfa.regex2dfa, backed by the in-process and on-disk
+    caches."""
+    dfa = dfas_.get(regex)
+    if dfa is not None:
+        return dfa
+
+    cache_path = get_cache_path(regex)
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path) as f:
+                dfa = f.read()
+        except (IOError, OSError) as e:
+            LOG.warning("Can't read cached DFA %s: %s", cache_path, e)
+
+    if not dfa:
+        dfa = fte.regex2dfa.regex2dfa(regex)
+        if cache_path:
+            store(cache_path, dfa)
+
+    dfas_[regex] = dfa
+    return dfa
+
+
+def store(cache_path, dfa):
+    # write to a temp file and rename it into place, so that concurrent
+    # processes never see a partial DFA
+    cache_dir = os.path.dirname(cache_path)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(dfa)
+            # mkstemp makes the file private; a cache dir shared between
+            # users must stay readable by all of them
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except (IOError, OSError) as e:
+        LOG.warning("Can't cache DFA in %s: %s", cache_dir, e)
+
+
+def get_encoder(regex, msg_len):
+    """Returns the shared fte.encoder.DfaEncoder for regex and msg_len."""
+    key = (regex, msg_len)
+    encoder = encoders_.get(key)
+    if encoder is None:
+        encoder = fte.encoder.DfaEncoder(regex2dfa(regex), msg_len)
+        encoders_[key] = encoder
+    return encoder
+
+
+def get_ranker(regex, msg_len):
+    """Returns the shared fte.dfa.DFA for regex and msg_len."""
+    key = (regex, msg_len)
+    ranker = rankers_.get(key)
+    if ranker is None:
+        ranker = fte.dfa.DFA(regex2dfa(regex), msg_len)
+        rankers_[key] = ranker
+    return ranker
+
+
+def clear():
+    """Drops the in-process caches. The on-disk cache is left alone."""
+    dfas_.clear()
+    encoders_.clear()
+    rankers_.clear()
@@ -18,11 +18,13 @@ class ClientDriver(object):
         self.multiplexer_outgoing_ = None
         self.multiplexer_incoming_ = None
         self.state_ = None
+        self.wakeup_callback_ = None
 
     def execute(self, reactor):
         while len(self.to_start_) > 0:
             executable = self.to_start_.pop()
             self.running_.append(executable)
+            executable.set_done_callback(self.wakeup_callback_)
 
             if self.state_:
                 for key in self.state_.local_:
@@ -59,6 +61,10 @@ class ClientDriver(object):
     def set_state(self, state):
         self.state_ = state
 
+    def set_wakeup_callback(self, callback):
+        """Call ``callback()`` whenever one of our executables finishes."""
+        self.wakeup_callback_ = callback
+
     def stop(self):
         for executable in self.running_:
             executable.stop()
@@ -80,6 +86,7 @@ class ServerDriver(object):
         self.multiplexer_outgoing_ = None
         self.multiplexer_incoming_ = None
         self.state_ = None
+        self.wakeup_callback_ = None
 
     def execute(self, reactor):
         while True:
@@ -88,8 +95,13 @@ class ServerDriver(object):
                 break
 
             self.running_.append(new_executable)
+            new_executable.set_done_callback(self.wakeup_callback_)
             reactor.callFromThread(new_executable.execute, reactor)
 
+        if self.wakeup_callback_:
+            self.executable_.wait_for_incoming_connections(
+                self.wakeup_callback_)
+
         running_count = len(self.running_)
         self.running_ = [executable for executable
                          in self.running_
@@ -112,6 +124,11 @@ class ServerDriver(object):
     def set_multiplexer_incoming(self, multiplexer):
         self.multiplexer_incoming_ = multiplexer
 
+    def set_wakeup_callback(self, callback):
+        """Call ``callback()`` whenever a new channel arrives or one of our
+        executables finishes."""
+        self.wakeup_callback_ = callback
+
     def set_state(self, state):
         self.state_ = state
 
@@ -121,4 +138,14 @@ class ServerDriver(object):
                     self.executable_.set_local(key, self.state_.local_[key])
 
     def stop(self):
+        """Stops accepting connections. Models already running carry on to
+        completion; model.spawn relies on that for models it accepted past
+        the number it waits for."""
         self.executable_.stop()
+
+    def stop_all(self):
+        """Stops accepting connections and stops the running models too."""
+        for executable in self.running_:
+            executable.stop()
+        self.running_ = []
+        self.stop()
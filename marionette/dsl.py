@@ -1,10 +1,11 @@
 import os
 import sys
 import copy
-import glob
+import json
 import hashlib
 import fnmatch
 import codecs
+import tempfile
 
 import ply.lex as lex
 import ply.yacc as yacc
@@ -13,7 +14,18 @@ import fte.bit_ops
 
 sys.path.append('.')
 
+import marionette.action
 import marionette.executables.pioa
+import marionette.logger
+
+LOG = marionette.logger.get_logger('dsl')
+
+# Parsed formats are saved as bundles, next to their .mar file as
+# <file>.mar.json by marionette_compile or in the user's cache dir, so that
+# loading them again doesn't need PLY. Bump this when the layout of the
+# bundle changes.
+BUNDLE_VERSION = 1
+BUNDLE_SUFFIX = '.json'
 
 # TODO: fix it s.t. "server" in var name doesn't cause problem
 
@@ -310,7 +322,15 @@ def p_error(p):
     print("Syntax error at '%s' on line %s" % (str([p.value]), p.lineno))
     # yacc.errok()
 
-yacc.yacc(debug=False, write_tables=False)
+# built on first use, as formats with an up to date bundle don't need it
+parser_ = None
+
+
+def get_parser():
+    global parser_
+    if parser_ is None:
+        parser_ = yacc.yacc(debug=False, write_tables=False)
+    return parser_
 
 ###################
 
@@ -371,7 +391,7 @@ def parse(s):
 
     retval = MarionetteFormat()
 
-    parsed_format = yacc.parse(s)
+    parsed_format = get_parser().parse(s)
 
     retval.set_transport(parsed_format[0])
     retval.set_port(parsed_format[1])
@@ -380,6 +400,139 @@ def parse(s):
 
     return retval
 
+
+def format_to_dict(parsed_format):
+    return {
+        'transport': parsed_format.get_transport(),
+        'port': parsed_format.get_port(),
+        'transitions': [
+            [transition.get_src(), transition.get_dst(),
+             transition.get_action_block(), transition.get_probability(),
+             transition.is_error_transition()]
+            for transition in parsed_format.get_transitions()],
+        'actions': [
+            [action.get_name(), action.get_party(), action.get_module(),
+             action.get_method(), action.get_args(),
+             action.get_regex_match_incoming()]
+            for action in parsed_format.get_action_blocks()],
+    }
+
+
+def format_from_dict(d):
+    retval = MarionetteFormat()
+    retval.set_transport(d['transport'])
+    retval.set_port(d['port'])
+    retval.set_transitions([MarionetteTransition(*transition)
+                            for transition in d['transitions']])
+    retval.set_action_blocks([marionette.action.MarionetteAction(*action)
+                              for action in d['actions']])
+    return retval
+
+
+def get_digest(mar_str):
+    return hashlib.sha1(mar_str.encode('utf-8')).hexdigest()
+
+
+def parse_file(mar_path, mar_str=None, digest=None):
+    """Returns the parsed format in mar_path, read from a bundle made from
+    the same source if there is one, else parsed. Bundles are looked for
+    next to mar_path, where marionette_compile writes them, then in the
+    user's cache dir, where a format we had to parse is saved."""
+    if mar_str is None:
+        with open(mar_path) as f:
+            mar_str = f.read()
+    if digest is None:
+        digest = get_digest(mar_str)
+
+    cache_path = get_bundle_cache_path(digest)
+    for bundle_path in [mar_path + BUNDLE_SUFFIX, cache_path]:
+        retval = read_bundle(bundle_path, digest)
+        if retval is not None:
+            return retval
+
+    retval = parse(mar_str)
+    if cache_path:
+        write_bundle(cache_path, retval, digest)
+    return retval
+
+
+def compile_file(mar_path):
+    """Parses mar_path and saves its bundle next to it."""
+    with open(mar_path) as f:
+        mar_str = f.read()
+    return write_bundle(mar_path + BUNDLE_SUFFIX, parse(mar_str),
+                        get_digest(mar_str))
+
+
+def get_bundle_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'marionette', 'formats',
+                        'v%d' % BUNDLE_VERSION)
+
+
+def get_bundle_cache_path(digest):
+    cache_dir = get_bundle_cache_dir()
+    if not cache_dir:
+        return None
+    return os.path.join(cache_dir, digest + BUNDLE_SUFFIX)
+
+
+def read_bundle(bundle_path, digest):
+    """Returns the parsed format in the bundle at bundle_path, or None if
+    there's none or it wasn't made from the source with this digest."""
+    try:
+        with open(bundle_path) as f:
+            bundle = json.load(f)
+    except (IOError, OSError):
+        return None
+    except ValueError as e:
+        LOG.warning("Can't read bundle %s: %s", bundle_path, e)
+        return None
+
+    if not isinstance(bundle, dict) or \
+            bundle.get('version') != BUNDLE_VERSION or \
+            bundle.get('sha1') != digest:
+        return None
+    try:
+        return format_from_dict(bundle['format'])
+    except (KeyError, TypeError, ValueError) as e:
+        LOG.warning("Can't load bundle %s: %s", bundle_path, e)
+        return None
+
+
+def write_bundle(bundle_path, parsed_format, digest):
+    """Saves parsed_format as the bundle at bundle_path. Returns True if it
+    was saved."""
+    bundle = {
+        'version': BUNDLE_VERSION,
+        'sha1': digest,
+        'format': format_to_dict(parsed_format),
+    }
+    # write to a temp file and rename it into place, so that concurrent
+    # processes never see a partial bundle
+    bundle_dir = os.path.dirname(bundle_path)
+    try:
+        if not os.path.isdir(bundle_dir):
+            os.makedirs(bundle_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=bundle_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(bundle, f)
+            # mkstemp makes the file private; bundles written by root or at
+            # install time must be readable by whoever runs marionette
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, bundle_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except (IOError, OSError) as e:
+        # we just parse the format again next time
+        LOG.info("Can't save bundle %s: %s", bundle_path, e)
+        return False
+    return True
+
+
 def get_search_dirs():
     dsl_dir = os.path.dirname(os.path.join(__file__))
     dsl_dir = os.path.join(dsl_dir, 'formats')
@@ -393,11 +546,19 @@ def get_search_dirs():
              ]
     return retval
 
+# The formats dir, found once, and an index of the .mar files in it.
+format_dir_ = None
+format_index_ = None
+
+FORMAT_BANNER = '### marionette formats dir ###'
+
+
 def get_format_dir():
-    retval = None
+    global format_dir_
+    if format_dir_ is not None:
+        return format_dir_
 
     search_dirs = get_search_dirs()
-    FORMAT_BANNER = '### marionette formats dir ###'
     for cur_dir in search_dirs:
         init_path = os.path.join(cur_dir, '__init__.py')
 
@@ -406,88 +567,157 @@ def get_format_dir():
             with open(init_path) as fh:
                 contents = fh.read()
                 contents = contents.strip()
-                if contents != FORMAT_BANNER:
-                    continue
-                else:
-                    retval = cur_dir
+                if contents == FORMAT_BANNER:
+                    format_dir_ = cur_dir
                     break
-        else:
-            continue
 
-    return retval
+    return format_dir_
 
-def find_mar_files(party, format_name, version=None):
-    retval = []
 
-    # get marionette format directory
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class FormatIndex(object):
+    """The .mar files under a formats dir, by format name and version, with
+    their mtimes. Versions are the subdirs of the formats dir and sort
+    oldest first; format names are paths relative to their version, without
+    the .mar extension, such as ``ta/amzn_sess``."""
+
+    def __init__(self, format_dir):
+        self.format_dir_ = format_dir
+        self.mtime_ = None
+        self.versions_ = []
+        # {format name: {version: (path, mtime)}}
+        self.formats_ = {}
+        if format_dir:
+            self.scan()
+
+    def scan(self):
+        self.mtime_ = get_mtime(self.format_dir_)
+        try:
+            names = os.listdir(self.format_dir_)
+        except OSError as e:
+            LOG.warning("Can't list formats in %s: %s", self.format_dir_, e)
+            return
+
+        for version in sorted(names):
+            # like glob, skip hidden dirs
+            if version.startswith('.'):
+                continue
+            version_dir = os.path.join(self.format_dir_, version)
+            if not os.path.isdir(version_dir):
+                continue
+            self.versions_.append(version)
+
+            for root, dirnames, filenames in os.walk(version_dir):
+                for filename in fnmatch.filter(filenames, '*.mar'):
+                    mar_path = os.path.join(root, filename)
+                    format_name = os.path.splitext(
+                        os.path.relpath(mar_path, version_dir))[0]
+                    format_name = format_name.replace(os.sep, '/')
+                    self.formats_.setdefault(format_name, {})[version] = (
+                        mar_path, get_mtime(mar_path))
+
+    def is_stale(self):
+        """True if versions were added or removed since we were built, which
+        costs a stat of the formats dir. Formats added to an existing
+        version aren't noticed; see refresh_format_index()."""
+        return bool(self.format_dir_) and \
+            get_mtime(self.format_dir_) != self.mtime_
+
+    def has_version(self, version):
+        return version in self.versions_
+
+    def get_versions(self, format_name, version=None):
+        """Returns the versions that have format_name, oldest first, only
+        those matching the glob version if it's given."""
+        versions = self.formats_.get(format_name, {})
+        retval = sorted(versions)
+        if version:
+            retval = [cur_version for cur_version in retval
+                      if fnmatch.fnmatchcase(cur_version, version)]
+        return retval
+
+    def get_path(self, format_name, version):
+        return self.formats_[format_name][version][0]
+
+    def get_mtime(self, format_name, version):
+        return self.formats_[format_name][version][1]
+
+    def list_formats(self):
+        """Returns (format name, version) for every .mar file."""
+        return [(format_name, version)
+                for version in self.versions_
+                for format_name in sorted(self.formats_)
+                if version in self.formats_[format_name]]
+
+
+def get_format_index():
+    """Returns the index of the formats dir, building it on first use and
+    again once versions are installed or removed."""
+    global format_index_
     format_dir = get_format_dir()
+    if format_index_ is None or format_index_.format_dir_ != format_dir or \
+            format_index_.is_stale():
+        format_index_ = FormatIndex(format_dir)
+    return format_index_
 
-    # check all subdirs unless a version is specified
-    if version:
-        subdirs = glob.glob(os.path.join(format_dir, version))
-    else:
-        subdirs = glob.glob(os.path.join(format_dir, '*'))
-
-    # make sure we prefer the most recent format
-    subdirs.sort()
-
-    # for each subdir, load our format_name
-    formats = {}
-    for path in subdirs:
-        if os.path.isdir(path):
-            conf_path = os.path.join(path, format_name + '.mar')
-            if os.path.exists(conf_path):
-                if not formats.get(format_name):
-                    formats[format_name] = []
-                if party == 'client':
-                    formats[format_name] = [conf_path]
-                elif party == 'server':
-                    formats[format_name] += [conf_path]
-
-    for key in formats.keys():
-        retval += formats[key]
 
-    return retval
+def refresh_format_index():
+    """Forgets the formats dir and its index, e.g. after installing
+    formats, so that they're found again on next use."""
+    global format_dir_, format_index_
+    format_dir_ = None
+    format_index_ = None
 
-def list_mar_files(party):
-    format_dir = get_format_dir()
 
-    subdirs = glob.glob(os.path.join(format_dir,'*'))
+def find_mar_files(party, format_name, version=None):
+    index = get_format_index()
 
-    mar_files = []
-    for path in subdirs:
-        if os.path.isdir(path):
-            format_version = os.path.basename(path)
+    # check all versions unless one is specified; the client takes the most
+    # recent format, the server all of them
+    versions = index.get_versions(format_name, version)
+    if party == 'client':
+        versions = versions[-1:]
+    elif party != 'server':
+        versions = []
 
-            for root, dirnames, filenames in os.walk(path):
-                for filename in fnmatch.filter(filenames, '*.mar'):
-                    full_path = os.path.join(root,filename)
-                    rel_path = os.path.relpath(full_path, path)
-                    format = os.path.splitext(rel_path)[0]
-                    mar_file = "%s:%s" % (format,format_version)
-                    mar_files.append(mar_file)
+    return [index.get_path(format_name, cur_version)
+            for cur_version in versions]
 
-    return mar_files
 
-def get_latest_version(party, format_name):
-    mar_version = None
+def list_mar_files(party):
+    return ["%s:%s" % (format_name, format_version)
+            for (format_name, format_version)
+            in get_format_index().list_formats()]
 
-    # get marionette format directory
-    format_dir = get_format_dir()
 
-    subdirs = glob.glob(os.path.join(format_dir, '*'))
+def compile_all(format_dir=None):
+    """Saves an up to date bundle next to every .mar file under format_dir,
+    the formats dir by default. Returns (path, whether its bundle was
+    saved) for each .mar file."""
+    if format_dir is None:
+        format_dir = get_format_dir()
+
+    retval = []
+    for root, dirnames, filenames in os.walk(format_dir):
+        dirnames.sort()
+        for filename in sorted(fnmatch.filter(filenames, '*.mar')):
+            mar_path = os.path.join(root, filename)
+            retval.append((mar_path, compile_file(mar_path)))
 
-    # make sure we prefer the most recent format
-    subdirs.sort()
+    return retval
 
-    # for each subdir, load our format_name
-    for path in subdirs:
-        if os.path.isdir(path):
-            conf_path = os.path.join(path, format_name + '.mar')
-            if os.path.exists(conf_path):
-                mar_version = path.split('/')[-1]
 
-    return mar_version
+def get_latest_version(party, format_name):
+    versions = get_format_index().get_versions(format_name)
+    if versions:
+        return versions[-1]
+    return None
 
 
 def load_all(party, format_name, version=None):
@@ -503,12 +733,54 @@ def load_all(party, format_name, version=None):
     return retval
 
 
-def load(party, format_name, mar_path):
+# Compiled formats, shared by everything in the process that loads them.
+# Entries are keyed by (party, format, version, hash of the .mar file) so an
+# edited file is never served stale; invalidate_compiled_formats() drops
+# entries that are no longer needed.
+compiled_formats_ = {}
 
+
+def load(party, format_name, mar_path):
     with open(mar_path) as f:
         mar_str = f.read()
 
-    parsed_format = parse(mar_str)
+    format_version = get_format_version(mar_path)
+    digest = get_digest(mar_str)
+    key = (party, format_name, format_version, digest)
+
+    compiled = compiled_formats_.get(key)
+    if compiled is None:
+        compiled = compile_format(party, format_name, mar_str,
+                                  parse_file(mar_path, mar_str, digest))
+        compiled_formats_[key] = compiled
+
+    return compiled.clone()
+
+
+def get_format_version(mar_path):
+    """Returns the version of the format at mar_path, the subdir of the
+    formats dir it's in; for ``20150701/ta/amzn_sess.mar`` that's
+    20150701. Outside the formats dir, it's the dir mar_path is in."""
+    format_dir = get_format_dir()
+    if format_dir:
+        rel_path = os.path.relpath(os.path.abspath(mar_path), format_dir)
+        version = rel_path.split(os.sep)[0]
+        if version != os.pardir and version != rel_path:
+            return version
+    return os.path.basename(os.path.dirname(mar_path))
+
+
+def invalidate_compiled_formats(format_name=None):
+    """Forget compiled formats, either all of them or just the versions of
+    ``format_name``."""
+    for key in list(compiled_formats_.keys()):
+        if format_name is None or key[1] == format_name:
+            del compiled_formats_[key]
+
+
+def compile_format(party, format_name, mar_str, parsed_format=None):
+    if parsed_format is None:
+        parsed_format = parse(mar_str)
     
     # Validate format before creating executable
     import marionette.format_validator
@@ -526,6 +798,7 @@ def load(party, format_name, mar_path):
     executable.set_port(parsed_format.get_port())
     executable.set_local(
         "model_uuid", get_model_uuid(mar_str))
+    executable.set_local("format_name", format_name)
 
     for transition in parsed_format.get_transitions():
         executable.add_state(transition.get_src())
@@ -579,6 +852,8 @@ def load(party, format_name, mar_path):
             executable.states_["end"].add_transition("dead", None, 1)
             executable.states_["dead"].add_transition("dead", None, 1)
 
+    executable.compile_action_blocks()
+
     return executable
 
 
@@ -5,18 +5,19 @@ sys.path.append('.')
 import marionette.channel
 import marionette.dsl
 
-EVENT_LOOP_FREQUENCY_S = 0.001
-
 class Executable(object):
 
-    def __init__(self, party, format_name, format_version, multiplexer_outgoing, multiplexer_incoming):
+    def __init__(self, party, format_name, format_version, multiplexer_outgoing, multiplexer_incoming, executables=None):
         self.party_ = party
         self.format_ = format_name
         self.format_version_ = format_version
         self.port_ = None
         self.multiplexer_outgoing_ = multiplexer_outgoing
         self.multiplexer_incoming_ = multiplexer_incoming
-        self.executables_ = self.load(party, self.format_, self.format_version_)
+        self.done_callback_ = None
+        if executables is None:
+            executables = self.load(party, self.format_, self.format_version_)
+        self.executables_ = executables
 
     def load(self, party, format_name, format_version):
         executables = marionette.dsl.load_all(party, format_name, format_version)
@@ -37,17 +38,34 @@ class Executable(object):
         return executables
 
     def execute(self, reactor):
-        for executable in self.executables_:
-            if executable.get_success():
-                for executable in self.executables_:
-                    executable.stop()
-
+        # each model schedules itself from here on; we only hear back from
+        # them once they stop
         if self.isRunning():
             for executable in self.executables_:
                 if executable.isRunning():
+                    executable.set_done_callback(self.model_done)
                     reactor.callFromThread(executable.execute, reactor)
 
-            reactor.callLater(EVENT_LOOP_FREQUENCY_S, self.execute, reactor)
+    def model_done(self):
+        if not self.isRunning():
+            for executable in self.executables_:
+                executable.stop()
+
+            done_callback = self.done_callback_
+            self.done_callback_ = None
+            if done_callback:
+                done_callback()
+
+    def set_done_callback(self, callback):
+        """Call ``callback()`` once one of our models has run to
+        completion."""
+        self.done_callback_ = callback
+
+    def wait_for_incoming_connections(self, callback):
+        if self.party_ == "server":
+            port = self.get_port()
+            if isinstance(port, int):
+                marionette.channel.set_incoming_callback(port, callback)
 
     def isRunning(self):
         retval = True
@@ -58,12 +76,13 @@ class Executable(object):
         return retval
 
     def replicate(self):
+        executables = [executable.replicate()
+                       for executable
+                         in self.executables_]
         retval = Executable(self.party_, self.format_, self.format_version_,
                             self.multiplexer_outgoing_,
-                            self.multiplexer_incoming_)
-        retval.executables_ = [executable.replicate()
-                                for executable
-                                  in self.executables_]
+                            self.multiplexer_incoming_,
+                            executables)
         return retval
 
     def stop(self):
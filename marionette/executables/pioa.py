@@ -2,12 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import os
-import re
 import sys
+import time
+import bisect
 import random
-import importlib
 
-from twisted.python import log
+from twisted.internet import defer
 
 sys.path.append('.')
 
@@ -16,12 +16,41 @@ import fte.encoder
 import fte.bit_ops
 
 import marionette.channel
+import marionette.dfa_cache
+import marionette.fte_pool
+import marionette.logger
+import marionette.metrics
+import marionette.wakeup
 
-EVENT_LOOP_FREQUENCY_S = 0.001
+# A model runs transitions back to back until it blocks, yielding to the
+# reactor after this many in a row.
+MAX_TRANSITIONS_PER_CALL = 32
+
+# A blocked model is woken by incoming channel data, new outgoing data (if
+# it has async sends) or a timer requested by an action. As a safety net
+# for actions that can't signal when they're ready, it's also woken this
+# often.
+IDLE_WAKEUP_S = 1.0
+
+# how many transitions without actions prepare_next_transition() looks past
+MAX_PREPARE_LOOKAHEAD = 8
+
+LOG = marionette.logger.get_logger('model')
 
 # the following varibles are reserved and shouldn't be passed down
 #   to spawned models.
-RESERVED_LOCAL_VARS = ['party','model_instance_id','model_uuid']
+RESERVED_LOCAL_VARS = ['party','model_instance_id','model_uuid',
+                       'format_name']
+
+TRANSITIONS = marionette.metrics.counter(
+    'marionette_transitions_total', 'Transitions models made.', ['format'])
+ERROR_TRANSITIONS = marionette.metrics.counter(
+    'marionette_error_transitions_total',
+    'Times models fell back to an error transition.', ['format'])
+
+# state IDs every StateMachine gives start and dead
+START = 0
+DEAD = 1
 
 class PIOA(object):
 
@@ -29,11 +58,14 @@ class PIOA(object):
         super(PIOA, self).__init__()
 
         self.actions_ = []
+        self.machine_ = None
+        # parsed model.sleep distributions, held for as long as the format is
+        self.sleep_samplers_ = []
         self.channel_ = None
         self.channel_requested_ = False
-        self.current_state_ = 'start'
+        self.state_id_ = START
         self.first_sender_ = first_sender
-        self.next_state_ = None
+        self.next_state_id_ = None
         self.marionette_state_ = MarionetteSystemState()
         self.marionette_state_.set_local("party", party)
         self.party_ = party
@@ -43,6 +75,13 @@ class PIOA(object):
         self.history_len_ = 0
         self.states_ = {}
         self.success_ = False
+        self.reactor_ = None
+        self.wakeup_ = marionette.wakeup.Wakeup(self.execute)
+        self.done_callback_ = None
+        self.waits_on_outgoing_ = None
+        self.last_action_block_ = None
+        self.pending_action_ = None
+        self.prepared_ = None
 
         if self.party_ == first_sender:
             self.marionette_state_.set_local(
@@ -52,18 +91,106 @@ class PIOA(object):
                 self.marionette_state_.get_local("model_instance_id"))
 
     def do_precomputations(self):
+        grammars = set()
+        self.sleep_samplers_ = []
         for action in self.actions_:
             if action.get_module() == 'fte' and action.get_method().startswith('send'):
                 [regex, msg_len] = action.get_args()
                 self.marionette_state_.get_fte_obj(regex, msg_len)
+                marionette.fte_pool.warm_up(regex, int(msg_len))
+            elif action.get_module() == 'tg':
+                grammars.add(action.get_args()[0])
+            elif action.get_module() == 'model' and \
+                    action.get_method() == 'sleep':
+                from marionette.plugins import _model
+                self.sleep_samplers_.append(
+                    _model.get_sleep_sampler(action.get_args()[0]))
+
+        # only formats that use tg pay for importing it
+        if grammars:
+            from marionette.plugins import _tg
+            _tg.warm_up(sorted(grammars))
 
     def execute(self, reactor):
-        if self.isRunning():
-            self.transition()
-            reactor.callLater(EVENT_LOOP_FREQUENCY_S, self.execute, reactor)
+        self.reactor_ = reactor
+
+        # Async actions always succeed, but mark themselves idle when they
+        # didn't move any data. Going round a whole cycle of idle
+        # transitions means we're blocked just as if a transition had failed.
+        # Transitions without actions count as neither idle nor progress.
+        blocked = False
+        idle_states = set()
+        for i in range(MAX_TRANSITIONS_PER_CALL):
+            if not self.isRunning():
+                break
+            self.marionette_state_.pop_idle()
+            if not self.transition():
+                blocked = True
+                break
+            if self.marionette_state_.pop_idle():
+                if self.state_id_ in idle_states:
+                    blocked = True
+                    break
+                idle_states.add(self.state_id_)
+            elif self.last_action_block_:
+                idle_states.clear()
+
+        if not self.isRunning():
+            self.finish()
+        elif blocked:
+            self.prepare_next_transition()
+            self.wait_for_events(reactor)
         else:
+            self.wakeup_.schedule(reactor)
+
+    def wait_for_events(self, reactor):
+        delay = self.marionette_state_.pop_wakeup_delay()
+        if delay is None:
+            delay = IDLE_WAKEUP_S
+        deadline = self.marionette_state_.get_deadline()
+        if deadline is not None:
+            delay = max(0, min(delay, deadline - time.monotonic()))
+
+        if self.get_waits_on_outgoing():
+            multiplexer = self.marionette_state_.get_global(
+                "multiplexer_outgoing")
+            if multiplexer:
+                multiplexer.wait_for_data(self.wakeup)
+
+        self.wakeup_.schedule(reactor, delay)
+
+    def get_waits_on_outgoing(self):
+        # only async sends block until there's outgoing data; blocking
+        # sends fall back to padding cells
+        if self.waits_on_outgoing_ is None:
+            self.waits_on_outgoing_ = any(
+                action.get_party() == self.party_ and
+                action.get_method() == 'send_async'
+                for action in self.actions_)
+        return self.waits_on_outgoing_
+
+    def wakeup(self):
+        if self.pending_action_ and self.pending_action_[2] is None:
+            # whatever woke us may be what the pending action lacked
+            self.pending_action_[4] = True
+        if self.reactor_ and self.isRunning():
+            self.wakeup_.schedule(self.reactor_)
+
+    def finish(self):
+        self.wakeup_.cancel()
+        self.release_prepared()
+        if self.channel_:
+            self.channel_.remove_data_callback(self.wakeup)
             self.channel_.close()
 
+        done_callback = self.done_callback_
+        self.done_callback_ = None
+        if done_callback:
+            done_callback()
+
+    def set_done_callback(self, callback):
+        """Call ``callback()`` once this model stops running."""
+        self.done_callback_ = callback
 
     def check_channel_state(self):
         if self.party_ == "client":
@@ -76,6 +203,9 @@ class PIOA(object):
 
     def set_channel(self, channel):
         self.channel_ = channel
+        if channel:
+            channel.add_data_callback(self.wakeup)
+            self.wakeup()
 
     def check_rng_state(self):
         if self.marionette_state_.get_local("model_instance_id"):
@@ -84,57 +214,161 @@ class PIOA(object):
                 self.rng_.seed(
                     self.marionette_state_.get_local("model_instance_id"))
 
-                self.current_state_ = 'start'
+                machine = self.get_machine()
+                self.state_id_ = START
                 for i in range(self.history_len_):
-                    self.current_state_ = self.states_[
-                        self.current_state_].transition(self.rng_)
-                self.next_state_ = None
+                    self.state_id_ = machine.transition(self.state_id_,
+                                                        self.rng_)
+                self.next_state_id_ = None
 
             #Reset history length once RNGs are sync'd
             self.history_len_ = 0
 
+    def compile_action_blocks(self):
+        """Compiles states_ and actions_ into the StateMachine this model,
+        and every replica of it, runs. Must be called again if the states or
+        actions change."""
+        self.machine_ = StateMachine(self.states_, self.actions_, self.party_)
+
+    def get_machine(self):
+        if self.machine_ is None:
+            self.compile_action_blocks()
+        return self.machine_
+
     def determine_action_block(self, src_state, dst_state):
-        retval = []
-        for action in self.actions_:
-            action_name = self.states_[src_state].transitions_[dst_state][0]
-            success = action.execute(self.party_, action_name)
-            if success is not None:
-                retval.append(action)
-        return retval
+        machine = self.get_machine()
+        return machine.action_blocks_[machine.ids_[src_state]][
+            machine.ids_[dst_state]]
 
-    def get_potential_transitions(self):
-        retval = []
+    # the current and next state by name, for callers outside the hot path
 
-        if self.rng_:
-            if not self.next_state_:
-                self.next_state_ = self.states_[
-                    self.current_state_].transition(self.rng_)
-            retval += [self.next_state_]
+    def get_current_state(self):
+        return self.get_machine().names_[self.state_id_]
+
+    def set_current_state(self, name):
+        self.state_id_ = self.get_machine().ids_[name]
+
+    current_state_ = property(get_current_state, set_current_state)
+
+    def get_next_state(self):
+        if self.next_state_id_ is None:
+            return None
+        return self.get_machine().names_[self.next_state_id_]
+
+    def set_next_state(self, name):
+        if name is None:
+            self.next_state_id_ = None
         else:
-            for transition in \
-                self.states_[self.current_state_].transitions_.keys():
-                if self.states_[self.current_state_].transitions_[transition][1]>0:
-                    retval += [transition]
+            self.next_state_id_ = self.get_machine().ids_[name]
 
-        return retval
+    next_state_ = property(get_next_state, set_next_state)
+
+    def prepare_next_transition(self):
+        """While we're blocked, give the next transition with actions of
+        our own a head start. If that's a single action whose plugin has a
+        prepare_<method> function, it's run now; it returns a function that
+        undoes its work, or None if it didn't do any.
+
+        The transition we're blocked on, if we got as far as attempting one,
+        is skipped, as are transitions without actions. The route is picked
+        with a copy of our RNG, so it's the one we'll take unless we take an
+        error transition instead."""
+        if self.prepared_ or \
+                not self.marionette_state_.get_local("model_instance_id"):
+            return
+
+        rng = None
+        if self.rng_:
+            rng = random.Random()
+            rng.setstate(self.rng_.getstate())
+
+        machine = self.get_machine()
+        route = []
+        src_state = self.state_id_
+        dst_state = self.next_state_id_
+        action_block = []
+        for i in range(MAX_PREPARE_LOOKAHEAD):
+            if dst_state is None:
+                dst_state = self.predict_transition(src_state, rng)
+                if dst_state is None:
+                    return
+            route.append((src_state, dst_state))
+
+            action_block = machine.action_blocks_[src_state][dst_state]
+            blocked_on = (i == 0 and self.channel_ is not None)
+            if action_block and not blocked_on:
+                break
+            src_state = dst_state
+            dst_state = None
+
+        if len(action_block) != 1 or \
+                action_block[0].get_regex_match_incoming():
+            return
+        action_obj = action_block[0]
+
+        try:
+            prepare = action_obj.get_prepare_callable()
+        except (ImportError, AttributeError):
+            return
+        if prepare is None:
+            return
+
+        cancel = prepare(
+            self.channel_, self.marionette_state_, action_obj.get_args())
+        if cancel:
+            self.prepared_ = (route, cancel)
+
+    def predict_transition(self, src_state, rng):
+        machine = self.get_machine()
+        num_transitions = machine.num_transitions_[src_state]
+        if not num_transitions:
+            return None
+        if rng or num_transitions == 1:
+            return machine.transition(src_state, rng)
+        return None
+
+    def release_prepared(self, src_state=None, dst_state=None):
+        """Undoes the work of prepare_next_transition(), unless we've just
+        made the transition src_state -> dst_state and are still on the way
+        to the prepared one. If the prepared action ran, undoing it is a
+        no-op."""
+        if not self.prepared_:
+            return
+
+        (route, cancel) = self.prepared_
+        if (src_state, dst_state) in route[:-1]:
+            return
+
+        self.prepared_ = None
+        cancel()
+
+    def get_potential_transitions(self):
+        if self.rng_:
+            if self.next_state_id_ is None:
+                self.next_state_id_ = self.get_machine().transition(
+                    self.state_id_, self.rng_)
+            return (self.next_state_id_,)
+        return self.get_machine().potential_[self.state_id_]
 
     def advance_to_next_state(self):
-        retval = False
+        if self.pending_action_:
+            return self.complete_pending_action()
 
         # get the list of possible transitions we could make
         potential_transitions = self.get_potential_transitions()
         assert len(potential_transitions) > 0
 
         # attempt to do a normal transition
+        action_blocks = self.machine_.action_blocks_[self.state_id_]
         fatal = 0
         success = False
         for dst_state in potential_transitions:
-            action_block = self.determine_action_block(self.current_state_, dst_state)
+            action_block = action_blocks[dst_state]
 
             try:
                 success = self.eval_action_block(action_block)
             except Exception as e:
-                log.msg("EXCEPTION: %s" % (str(e)))
+                LOG.warning("EXCEPTION: %s", e)
                 fatal += 1
 
             if success:
@@ -142,25 +376,82 @@ class PIOA(object):
 
         # if all potential transitions are fatal, attempt the error transition
         if not success and fatal == len(potential_transitions):
-            src_state = self.current_state_
-            dst_state = self.states_[self.current_state_].get_error_transition()
+            return self.attempt_error_transition()
 
-            if dst_state:
-                action_block = self.determine_action_block(src_state, dst_state)
-                success = self.eval_action_block(action_block)
+        return self.finish_transition(success, dst_state, action_block)
+
+    def attempt_error_transition(self):
+        ERROR_TRANSITIONS.labels(marionette.metrics.get_format_name(
+            self.marionette_state_)).inc()
+        machine = self.get_machine()
+        dst_state = machine.error_[self.state_id_]
+
+        success = False
+        action_block = None
+        if dst_state is not None:
+            action_block = machine.action_blocks_[self.state_id_][dst_state]
+            success = self.eval_action_block(action_block)
+
+        return self.finish_transition(success, dst_state, action_block)
+
+    def finish_transition(self, success, dst_state, action_block):
+        # an action that returns a Deferred is still running; we're blocked
+        # until it fires and we're woken up to complete the transition
+        if isinstance(success, defer.Deferred):
+            # [dst_state, action_block, result, idle, woken up meanwhile]
+            self.pending_action_ = [dst_state, action_block, None, False, False]
+            success.addCallbacks(self.pending_action_done,
+                                 self.pending_action_failed)
+            return False
+
+        retval = False
 
         # if we have a successful transition, update our state info.
         if success:
+            self.release_prepared(self.state_id_, dst_state)
             self.history_len_ += 1
-            self.current_state_ = dst_state
-            self.next_state_ = None
+            self.marionette_state_.set_deadline(None)
+            TRANSITIONS.labels(marionette.metrics.get_format_name(
+                self.marionette_state_)).inc()
+            self.state_id_ = dst_state
+            self.last_action_block_ = action_block
+            self.next_state_id_ = None
             retval = True
 
-            if self.current_state_ == 'dead':
+            if dst_state == DEAD:
                 self.success_ = True
 
         return retval
 
+    def pending_action_done(self, success):
+        if self.pending_action_:
+            self.pending_action_[2] = bool(success)
+            self.pending_action_[3] = self.marionette_state_.pop_idle()
+            self.wakeup()
+
+    def pending_action_failed(self, failure):
+        LOG.warning("EXCEPTION: %s", failure.value)
+        if self.pending_action_:
+            self.pending_action_[2] = 'fatal'
+            self.wakeup()
+
+    def complete_pending_action(self):
+        [dst_state, action_block, success, idle, woken] = self.pending_action_
+        if success is None:
+            return False
+
+        self.pending_action_ = None
+        if idle:
+            self.marionette_state_.mark_idle()
+
+        if success is not True and woken:
+            # new data came in while the action was running, so it's worth
+            # trying again rather than waiting for more
+            return self.advance_to_next_state()
+        if success == 'fatal':
+            return self.attempt_error_transition()
+        return self.finish_transition(success, dst_state, action_block)
+
     def eval_action_block(self, action_block):
         retval = False
 
@@ -168,9 +459,10 @@ class PIOA(object):
             retval = True
         elif len(action_block)>=1:
             for action_obj in action_block:
-                if action_obj.get_regex_match_incoming():
+                regex = action_obj.get_compiled_regex_match_incoming()
+                if regex:
                     incoming_buffer = self.channel_.peek()
-                    m = re.search(action_obj.get_regex_match_incoming(), incoming_buffer)
+                    m = regex.search(incoming_buffer)
                     if m:
                         retval = self.eval_action(action_obj)
                 else:
@@ -191,30 +483,37 @@ class PIOA(object):
                     self.first_sender_)
         retval.actions_ = self.actions_
         retval.states_ = self.states_
+        retval.machine_ = self.get_machine()
+        retval.sleep_samplers_ = self.sleep_samplers_
         retval.marionette_state_.global_ = self.marionette_state_.global_
         model_uuid = self.marionette_state_.get_local("model_uuid")
         retval.marionette_state_.set_local("model_uuid", model_uuid)
+        retval.marionette_state_.set_local(
+            "format_name", self.marionette_state_.get_local("format_name"))
         retval.port_ = self.port_
         retval.transport_protocol_ = self.transport_protocol_
         return retval
 
+    def clone(self):
+        """Like replicate(), but the copy gets its own globals, starting out
+        as a copy of ours, instead of sharing them."""
+        retval = self.replicate()
+        retval.marionette_state_.global_ = dict(self.marionette_state_.global_)
+        return retval
+
     def isRunning(self):
-        return (self.current_state_ != "dead")
+        return (self.state_id_ != DEAD)
 
     def eval_action(self, action_obj):
-        module = action_obj.get_module()
-        method = action_obj.get_method()
-        args = action_obj.get_args()
+        method_obj = action_obj.get_callable()
 
-        i = importlib.import_module("marionette.plugins._" + module)
-        method_obj = getattr(i, method)
-
-        success = method_obj(self.channel_, self.marionette_state_, args)
+        success = method_obj(
+            self.channel_, self.marionette_state_, action_obj.get_args())
 
         return success
 
     def add_state(self, name):
-        if not name in list(self.states_.keys()):
+        if name not in self.states_:
             self.states_[name] = PAState(name)
 
     def set_multiplexer_outgoing(self, multiplexer):
@@ -224,7 +523,9 @@ class PIOA(object):
         self.marionette_state_.set_global("multiplexer_incoming", multiplexer)
 
     def stop(self):
-        self.current_state_ = "dead"
+        self.state_id_ = DEAD
+        if self.reactor_:
+            self.wakeup_.schedule(self.reactor_)
 
     def set_port(self, port):
         self.port_ = port
@@ -259,6 +560,78 @@ class PIOA(object):
     def get_success(self):
         return self.success_
 
+class StateMachine(object):
+    """The compiled form of a party's model, shared by every model running
+    the format: states are numbered, start as START and dead as DEAD, and
+    for each state ID there's
+
+    - potential_: the destination IDs with a non-zero probability
+    - cumulative_: their running probabilities, as PAState adds them up
+    - fallback_: the destination if those fall short of the coin
+    - num_transitions_: the number of destinations, zero included
+    - error_: the error transition's destination ID, or None
+    - action_blocks_: {destination ID: the actions this party runs}
+
+    A model only keeps the ID of its current state. Nothing here changes
+    once it's built."""
+
+    def __init__(self, states, actions, party):
+        names = ['start', 'dead']
+        for (name, state) in states.items():
+            names.append(name)
+            names.extend(state.transitions_)
+            if state.get_error_transition():
+                names.append(state.get_error_transition())
+        self.names_ = tuple(dict.fromkeys(names))
+        self.ids_ = dict((name, i) for (i, name) in enumerate(self.names_))
+
+        self.potential_ = []
+        self.cumulative_ = []
+        self.fallback_ = []
+        self.num_transitions_ = []
+        self.error_ = []
+        self.action_blocks_ = []
+        for name in self.names_:
+            state = states.get(name) or PAState(name)
+            state.compile_transitions()
+            (potential, cumulative, fallback, first) = state.table_
+            self.potential_.append(tuple(self.ids_[dst] for dst in potential))
+            self.cumulative_.append(tuple(cumulative))
+            self.fallback_.append(self.ids_.get(fallback))
+            self.num_transitions_.append(len(state.transitions_))
+            self.error_.append(self.ids_.get(state.get_error_transition()))
+            self.action_blocks_.append(dict(
+                (self.ids_[dst], get_action_block(actions, party, action_name))
+                for (dst, [action_name, probability])
+                in state.transitions_.items()))
+
+    def transition(self, state_id, rng):
+        """Returns the destination PAState.transition() would pick."""
+        assert (rng or self.num_transitions_[state_id] == 1)
+        if rng and self.num_transitions_[state_id] > 1:
+            potential = self.potential_[state_id]
+            i = bisect.bisect_left(self.cumulative_[state_id], rng.random())
+            if i < len(potential):
+                return potential[i]
+        return self.fallback_[state_id]
+
+
+def get_action_block(actions, party, action_name):
+    """Returns the actions party runs for action_name, with their plugin
+    functions and regexes resolved."""
+    retval = [action for action in actions
+              if action.execute(party, action_name) is not None]
+    for action in retval:
+        action.get_compiled_regex_match_incoming()
+        try:
+            action.get_callable()
+        except (ImportError, AttributeError) as e:
+            # reported when the transition is attempted
+            LOG.warning("Can't resolve action %s.%s: %s",
+                        action.get_module(), action.get_method(), e)
+    return retval
+
+
 class PAState(object):
 
     def __init__(self, name):
@@ -267,9 +640,11 @@ class PAState(object):
         self.format_type_ = None
         self.format_value_ = None
         self.error_state_ = None
+        self.table_ = None
 
     def add_transition(self, dst, action_name, probability):
         self.transitions_[dst] = [action_name, float(probability)]
+        self.table_ = None
 
     def set_error_transition(self, error_state):
         self.error_state_ = error_state
@@ -277,20 +652,44 @@ class PAState(object):
     def get_error_transition(self):
         return self.error_state_
 
+    def compile_transitions(self):
+        """Builds the table transition() and get_potential_transitions()
+        use: the destinations with a non-zero probability, their running
+        sums in the order they were added, and the destination taken if the
+        sums fall short of the coin, which is the last one added. Must be
+        called again if transitions_ is changed directly."""
+        states = []
+        cumulative = []
+        total = 0
+        for state in self.transitions_:
+            if self.transitions_[state][1] == 0:
+                continue
+            # added up in the same order as the peer does, so the sums,
+            # and the states they pick, are identical on both sides
+            total += self.transitions_[state][1]
+            states.append(state)
+            cumulative.append(total)
+
+        dsts = list(self.transitions_.keys()) or [None]
+        self.table_ = (tuple(states), cumulative, dsts[-1], dsts[0])
+
+    def get_potential_transitions(self):
+        """Returns the destinations with a non-zero probability."""
+        if self.table_ is None:
+            self.compile_transitions()
+        return self.table_[0]
+
     def transition(self, rng):
         assert (rng or len(self.transitions_) == 1)
+        if self.table_ is None:
+            self.compile_transitions()
+        (states, cumulative, fallback, first) = self.table_
         if rng and len(self.transitions_) > 1:
-            coin = rng.random()
-            sum = 0
-            for state in self.transitions_:
-                if self.transitions_[state][1] == 0:
-                    continue
-                sum += self.transitions_[state][1]
-                if sum >= coin:
-                    break
-        else:
-            state = list(self.transitions_.keys())[0]
-        return state
+            i = bisect.bisect_left(cumulative, rng.random())
+            if i < len(states):
+                return states[i]
+            return fallback
+        return first
 
 
 class MarionetteSystemState(object):
@@ -298,6 +697,10 @@ class MarionetteSystemState(object):
     def __init__(self):
         self.global_ = {}
         self.local_ = {}
+        self.wakeup_delay_ = None
+        self.deadline_ = None
+        self.idle_ = False
+        self.prepared_ = {}
 
     def set_global(self, key, val):
         self.global_[key] = val
@@ -311,11 +714,49 @@ class MarionetteSystemState(object):
     def get_local(self, key):
         return self.local_.get(key)
 
+    def request_wakeup(self, delay):
+        """Ask for the model to be run again after at most ``delay`` seconds
+        if the current transition attempt blocks."""
+        if self.wakeup_delay_ is None or delay < self.wakeup_delay_:
+            self.wakeup_delay_ = delay
+
+    def pop_wakeup_delay(self):
+        retval = self.wakeup_delay_
+        self.wakeup_delay_ = None
+        return retval
+
+    def get_deadline(self):
+        return self.deadline_
+
+    def set_deadline(self, deadline):
+        """Hold the current transition until time.monotonic() reaches
+        ``deadline``; while it's blocked, the model is woken up no later
+        than that. Cleared when the model makes a transition."""
+        self.deadline_ = deadline
+
+    def mark_idle(self):
+        """Flag that the current action succeeded without moving data."""
+        self.idle_ = True
+
+    def pop_idle(self):
+        retval = self.idle_
+        self.idle_ = False
+        return retval
+
+    def set_prepared(self, key, val):
+        """Keeps work an action did ahead of time for itself to pick up."""
+        self.prepared_[key] = val
+
+    def get_prepared(self, key):
+        return self.prepared_.get(key)
+
+    def pop_prepared(self, key):
+        return self.prepared_.pop(key, None)
+
     def get_fte_obj(self, regex, msg_len):
         fte_key = 'fte_obj-' + regex + str(msg_len)
         if not self.get_global(fte_key):
-            dfa = fte.regex2dfa.regex2dfa(regex)
-            fte_obj = fte.encoder.DfaEncoder(dfa, msg_len)
+            fte_obj = marionette.dfa_cache.get_encoder(regex, msg_len)
             self.set_global(fte_key, fte_obj)
 
         return self.get_global(fte_key)
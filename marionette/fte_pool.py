@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+An optional process pool for fte encoding and decoding.
+
+Encrypting and unranking a large cell can take long enough to stall every
+other connection served by the reactor. With ``workers`` set in the [fte]
+section of marionette.conf, fte actions hand that work to a pool of worker
+processes and wait for the result as a Deferred instead.
+
+Each worker builds its fte encoders on start-up for every (regex, msg_len)
+registered with warm_up() so far (which dsl.load does for the formats it
+loads), and any others on first use.
+"""
+
+import sys
+import multiprocessing
+import concurrent.futures
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+sys.path.append('.')
+
+import marionette.conf
+import marionette.dfa_cache
+
+pool_ = None
+warm_keys_ = set()
+
+
+def is_enabled():
+    return get_num_workers() > 0
+
+
+def get_num_workers():
+    return marionette.conf.get("fte.workers")
+
+
+def warm_up(regex, msg_len):
+    """Have workers started from now on build the encoder for regex and
+    msg_len before taking any work."""
+    warm_keys_.add((regex, msg_len))
+
+
+def get_pool():
+    global pool_
+
+    if pool_ is None:
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            # Forking us directly would leak our sockets into the workers,
+            # keeping connections open after we close them. Don't preload
+            # __main__ in the fork server either, as the bin scripts aren't
+            # import-safe.
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(['marionette.fte_pool'])
+        else:
+            context = multiprocessing.get_context('spawn')
+        pool_ = concurrent.futures.ProcessPoolExecutor(
+            max_workers=get_num_workers(),
+            mp_context=context,
+            initializer=init_worker,
+            initargs=(sorted(warm_keys_),))
+        reactor.addSystemEventTrigger('before', 'shutdown', shutdown)
+    return pool_
+
+
+def shutdown():
+    global pool_
+
+    if pool_ is not None:
+        pool_.shutdown(wait=False, cancel_futures=True)
+        pool_ = None
+
+
+def submit(fn, *args):
+    """Runs fn(*args) in the pool. Returns a Deferred that fires in the
+    reactor thread with its result."""
+    d = defer.Deferred()
+
+    def done(future):
+        if future.cancelled():
+            return
+        exception = future.exception()
+        if exception is not None:
+            reactor.callFromThread(d.errback, exception)
+        else:
+            reactor.callFromThread(d.callback, future.result())
+
+    get_pool().submit(fn, *args).add_done_callback(done)
+    return d
+
+
+def encode(regex, msg_len, ptxt):
+    return submit(do_encode, regex, msg_len, bytes(ptxt))
+
+
+def decode(regex, msg_len, ctxt):
+    return submit(do_decode, regex, msg_len, ctxt)
+
+# run in the workers
+
+
+def init_worker(warm_keys):
+    for (regex, msg_len) in warm_keys:
+        marionette.dfa_cache.get_encoder(regex, msg_len)
+
+
+def do_encode(regex, msg_len, ptxt):
+    ctxt = marionette.dfa_cache.get_encoder(regex, msg_len).encode(ptxt)
+    if not isinstance(ctxt, bytes):
+        ctxt = ctxt.encode('latin-1') if isinstance(ctxt, str) else bytes(ctxt)
+    return ctxt
+
+
+def do_decode(regex, msg_len, ctxt):
+    [ptxt, remainder] = marionette.dfa_cache.get_encoder(
+        regex, msg_len).decode(ctxt)
+    return (bytes(ptxt), bytes(remainder))
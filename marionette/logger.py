@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Leveled logging for marionette's subsystems, on top of twisted's log.
+
+Each module gets a logger for its subsystem once, at import time:
+
+    LOG = marionette.logger.get_logger('multiplexer')
+    ...
+    LOG.debug("Stream %d Enqueue ID %d", stream_id, seq_id)
+
+Messages below a logger's level are dropped before their arguments are
+formatted. Per-cell and per-chunk paths test the level first, so a
+disabled level costs them a single attribute check:
+
+    if LOG.debug_enabled:
+        LOG.debug("%d bytes received", len(chunk))
+
+Levels and sampling are set per subsystem by configure(), from the
+[logging] section of marionette.conf. Events carry ``system`` (the
+subsystem), ``logLevel`` (a stdlib logging level) and any keyword fields
+the caller passed, for observers that want them.
+"""
+
+import sys
+
+from twisted.python import log
+
+sys.path.append('.')
+
+import marionette.conf
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {
+    'debug': DEBUG,
+    'info': INFO,
+    'warning': WARNING,
+    'error': ERROR,
+}
+
+DEFAULT_LEVEL = INFO
+
+loggers_ = {}
+
+
+class Message(object):
+    """A message formatted when it's rendered, by whichever observer gets
+    to it first."""
+
+    __slots__ = ('format_', 'args_')
+
+    def __init__(self, format_, args):
+        self.format_ = format_
+        self.args_ = args
+
+    def __str__(self):
+        if self.args_:
+            return self.format_ % self.args_
+        return self.format_
+
+
+class Logger(object):
+
+    def __init__(self, name, level=DEFAULT_LEVEL, sample=1):
+        self.name_ = name
+        self.system_ = 'marionette.' + name
+        self.count_ = 0
+        self.set_level(level)
+        self.set_sample(sample)
+
+    def get_level(self):
+        return self.level_
+
+    def set_level(self, level):
+        self.level_ = level
+        self.debug_enabled = (level <= DEBUG)
+        self.info_enabled = (level <= INFO)
+
+    def get_sample(self):
+        return self.sample_
+
+    def set_sample(self, sample):
+        """Only log one in every ``sample`` debug and info messages."""
+        self.sample_ = max(1, int(sample))
+
+    def is_enabled(self, level):
+        return level >= self.level_
+
+    def debug(self, format_, *args, **fields):
+        if self.debug_enabled:
+            self.log(DEBUG, format_, args, fields)
+
+    def info(self, format_, *args, **fields):
+        if self.info_enabled:
+            self.log(INFO, format_, args, fields)
+
+    def warning(self, format_, *args, **fields):
+        if self.level_ <= WARNING:
+            self.log(WARNING, format_, args, fields)
+
+    def error(self, format_, *args, **fields):
+        if self.level_ <= ERROR:
+            self.log(ERROR, format_, args, fields)
+
+    def log(self, level, format_, args, fields):
+        if level < WARNING and self.sample_ > 1:
+            self.count_ += 1
+            if self.count_ % self.sample_:
+                return
+        log.msg(Message(format_, args), system=self.system_,
+                logLevel=level, **fields)
+
+
+def get_logger(name):
+    """Returns the logger for subsystem ``name``, making it if needed."""
+    retval = loggers_.get(name)
+    if retval is None:
+        retval = Logger(name)
+        loggers_[name] = retval
+    return retval
+
+
+def parse_level(level):
+    try:
+        return LEVELS[level.strip().lower()]
+    except KeyError:
+        raise ValueError("unknown log level %r" % level)
+
+
+def parse_subsystems(value, parse_value):
+    """Parses ``name:value, name:value`` into {name: value}."""
+    retval = {}
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if ':' not in item:
+            raise ValueError("expected subsystem:value, got %r" % item)
+        (name, item_value) = item.split(':', 1)
+        retval[name.strip()] = parse_value(item_value)
+    return retval
+
+
+def configure(level=None, levels=None, sample=None):
+    """Sets every subsystem's level and sampling, by default from the
+    [logging] section of marionette.conf. Subsystems without a level of
+    their own get ``level``; if that's empty, it's debug with
+    general.debug set, else info."""
+    if level is None:
+        level = marionette.conf.get("logging.level")
+    if levels is None:
+        levels = marionette.conf.get("logging.levels")
+    if sample is None:
+        sample = marionette.conf.get("logging.sample")
+
+    if level:
+        default_level = parse_level(level)
+    elif marionette.conf.get("general.debug"):
+        default_level = DEBUG
+    else:
+        default_level = DEFAULT_LEVEL
+    levels = parse_subsystems(levels, parse_level)
+    sample = parse_subsystems(sample, int)
+
+    for name in set(levels) | set(sample):
+        get_logger(name)
+    for (name, logger) in loggers_.items():
+        logger.set_level(levels.get(name, default_level))
+        logger.set_sample(sample.get(name, 1))
@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Runs a Client and a Server in one process, connected in memory.
+
+    python -m marionette.loopback [--format NAME ...] [--streams 10]
+                                  [--size 100000] [--json OUTPUT]
+
+With a Loopback installed (see marionette.channel.set_loopback), the
+channels models open and listen on are connected to each other directly
+instead of through the network, so there are no ports to bind, no other
+processes to start and nothing to clean up afterwards.
+
+For each format, --streams client streams each send --size random bytes to
+a server that echoes them back, all at once. We report:
+
+- goodput: payload bytes, both ways, per second
+- cells/s: cells received, both ways, including padding, per second
+- overhead: bytes on the wire per payload byte
+- connections: channels opened, one per model run
+- p50/p99 latency: time for a stream's bytes to come back in full
+
+The exit status is 1 if any format failed to echo everything back within
+--timeout seconds, or echoed something else.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import collections
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.python import log
+
+sys.path.append('.')
+
+import marionette
+import marionette.channel
+import marionette.conf
+import marionette.dsl
+import marionette.logger
+
+LOG = marionette.logger.get_logger('loopback')
+
+RESULTS_VERSION = 1
+
+NUM_STREAMS = 10
+STREAM_SIZE = 100000
+TIMEOUT_S = 60.0
+
+# ports handed out to listeners that ask for any port, as bind() does
+FIRST_EPHEMERAL_PORT = 49152
+
+
+class LoopbackTransport(object):
+    """The write end of one direction of a loopback connection. Data is
+    delivered, in order, delay seconds after it's written, and at the
+    earliest on the next reactor iteration, as with a socket."""
+
+    def __init__(self, loopback, party, delay=0):
+        self.loopback_ = loopback
+        self.party_ = party
+        self.delay_ = delay
+        self.peer_ = None
+        self.pending_ = collections.deque()
+        self.deliver_call_ = None
+        self.closed_ = False
+
+    def set_peer(self, peer):
+        self.peer_ = peer
+
+    def write(self, data, addr=None):
+        self.loopback_.record_write(self.party_, len(data))
+        self.pending_.append((reactor.seconds() + self.delay_, data))
+        if self.deliver_call_ is None:
+            self.deliver_call_ = reactor.callLater(self.delay_, self.deliver)
+
+    def deliver(self):
+        self.deliver_call_ = None
+
+        now = reactor.seconds()
+        chunks = []
+        while self.pending_ and self.pending_[0][0] <= now:
+            chunks.append(self.pending_.popleft()[1])
+        if chunks:
+            self.peer_.dataReceived(b''.join(chunks))
+
+        if self.pending_:
+            self.deliver_call_ = reactor.callLater(
+                self.pending_[0][0] - now, self.deliver)
+
+    def loseConnection(self):
+        # like TCP, anything already written still arrives
+        self.closed_ = True
+
+
+class LoopbackProtocol(object):
+    """One end of a loopback connection, standing in for MyClient or
+    MyServer."""
+
+    def __init__(self, transport, transport_protocol, party, port):
+        self.transport = transport
+        self.channel = marionette.channel.Channel(self, transport_protocol)
+        self.channel.party = party
+        self.channel.remote_host = 'loopback'
+        self.channel.remote_port = port
+
+    def dataReceived(self, chunk):
+        if not self.channel.is_closed():
+            self.channel.appendToBuffer(chunk)
+
+    def close(self):
+        self.channel.close()
+
+
+class LoopbackPort(object):
+    """Returned by Loopback.listen in place of a twisted listening port."""
+
+    def __init__(self, loopback, transport_protocol, port):
+        self.loopback_ = loopback
+        self.transport_protocol_ = transport_protocol
+        self.port = port
+
+    def getHost(self):
+        return self
+
+    def stopListening(self):
+        self.loopback_.stop_listening(self.transport_protocol_, self.port)
+
+
+class Loopback(object):
+    """Connects the channels opened by marionette.channel to the ones it
+    accepts, and counts the bytes written each way."""
+
+    def __init__(self, delay=0):
+        self.delay_ = delay
+        self.listening_ = set()
+        self.next_port_ = FIRST_EPHEMERAL_PORT
+        self.bytes_written_ = {'client': 0, 'server': 0}
+        self.num_connections_ = 0
+
+    def install(self):
+        marionette.channel.set_loopback(self)
+
+    def uninstall(self):
+        marionette.channel.set_loopback(None)
+
+    def listen(self, transport_protocol, port):
+        if not port:
+            port = self.next_port_
+            self.next_port_ += 1
+        self.listening_.add((transport_protocol, port))
+        return LoopbackPort(self, transport_protocol, port)
+
+    def stop_listening(self, transport_protocol, port):
+        self.listening_.discard((transport_protocol, port))
+
+    def connect(self, transport_protocol, port, callback):
+        if (transport_protocol, port) not in self.listening_:
+            LOG.info("loopback: nothing is listening on %s port %d",
+                     transport_protocol, port)
+            return
+
+        client_transport = LoopbackTransport(self, 'client', self.delay_)
+        server_transport = LoopbackTransport(self, 'server', self.delay_)
+        client = LoopbackProtocol(client_transport, transport_protocol,
+                                  'client', port)
+        server = LoopbackProtocol(server_transport, transport_protocol,
+                                  'server', port)
+        client_transport.set_peer(server)
+        server_transport.set_peer(client)
+        self.num_connections_ += 1
+
+        marionette.channel.add_incoming(port, server)
+        callback(client.channel)
+
+    def record_write(self, party, n):
+        self.bytes_written_[party] += n
+
+    def get_bytes_written(self):
+        return sum(self.bytes_written_.values())
+
+    def get_num_connections(self):
+        return self.num_connections_
+
+# driving streams through a format
+
+
+class EchoProtocol(object):
+    """Server side: sends every stream's data straight back."""
+
+    def connectionMade(self, stream):
+        self.stream_ = stream
+
+    def dataReceived(self, data):
+        self.stream_.push(data)
+
+    def connectionLost(self):
+        pass
+
+
+class EchoedStream(object):
+    """Client side: the srv_queue of one stream, collecting what the server
+    echoes back."""
+
+    def __init__(self, data, done):
+        self.data_ = data
+        self.done_ = done
+        self.received_ = []
+        self.num_received_ = 0
+        self.started_ = None
+        self.finished_ = None
+
+    def start(self, stream):
+        self.started_ = time.perf_counter()
+        stream.push(self.data_)
+
+    def put(self, payload):
+        if isinstance(payload, str):
+            payload = payload.encode('latin-1')
+        self.received_.append(payload)
+        self.num_received_ += len(payload)
+        if self.finished_ is None and self.num_received_ >= len(self.data_):
+            self.finished_ = time.perf_counter()
+            self.done_(self)
+
+    def is_intact(self):
+        return b''.join(self.received_) == self.data_
+
+    def get_latency(self):
+        return self.finished_ - self.started_
+
+
+class FormatRun(object):
+    """Echoes num_streams streams of stream_size bytes through format_name
+    over a Loopback."""
+
+    def __init__(self, format_name, num_streams=NUM_STREAMS,
+                 stream_size=STREAM_SIZE, timeout=TIMEOUT_S, delay=0):
+        self.format_name_ = format_name
+        self.num_streams_ = num_streams
+        self.stream_size_ = stream_size
+        self.timeout_ = timeout
+        self.loopback_ = Loopback(delay)
+        self.streams_ = []
+        self.num_finished_ = 0
+        self.num_cells_ = 0
+        self.client_ = None
+        self.server_ = None
+        self.started_ = None
+        self.finished_ = None
+        self.timeout_call_ = None
+        self.deferred_ = defer.Deferred()
+
+    def start(self):
+        """Returns a Deferred that fires with our results."""
+        self.loopback_.install()
+        try:
+            self.server_ = marionette.Server(self.format_name_)
+            self.server_.factory = EchoProtocol
+            self.client_ = marionette.Client(self.format_name_, None)
+        except Exception:
+            self.loopback_.uninstall()
+            raise
+        self.count_cells(self.server_.multiplexer_incoming_)
+        self.count_cells(self.client_.multiplexer_incoming_)
+
+        # the server has to be listening before the client connects
+        self.server_.execute(reactor)
+        self.client_.execute(reactor)
+
+        self.started_ = time.perf_counter()
+        for i in range(self.num_streams_):
+            stream = EchoedStream(os.urandom(self.stream_size_),
+                                  self.stream_finished)
+            self.streams_.append(stream)
+            stream.start(self.client_.start_new_stream(stream))
+
+        self.timeout_call_ = reactor.callLater(self.timeout_, self.finish)
+        return self.deferred_
+
+    def count_cells(self, multiplexer_incoming):
+        process_cell = multiplexer_incoming.callback_
+
+        def count(cell_obj):
+            self.num_cells_ += 1
+            process_cell(cell_obj)
+        multiplexer_incoming.addCallback(count)
+
+    def stream_finished(self, stream):
+        self.num_finished_ += 1
+        if self.num_finished_ == self.num_streams_:
+            self.finish()
+
+    def finish(self):
+        if self.finished_ is not None:
+            return
+        self.finished_ = time.perf_counter()
+        if self.timeout_call_.active():
+            self.timeout_call_.cancel()
+
+        self.client_.stop()
+        self.server_.stop()
+        self.loopback_.uninstall()
+
+        self.deferred_.callback(self.get_results())
+
+    def get_results(self):
+        elapsed = self.finished_ - self.started_
+        payload_bytes = 2 * sum(stream.num_received_
+                                for stream in self.streams_)
+        wire_bytes = self.loopback_.get_bytes_written()
+        latencies = sorted(stream.get_latency() for stream in self.streams_
+                           if stream.finished_ is not None)
+
+        if self.num_finished_ < self.num_streams_:
+            error = 'timeout'
+        elif not all(stream.is_intact() for stream in self.streams_):
+            error = 'corrupt'
+        else:
+            error = None
+
+        return {
+            'format': self.format_name_,
+            'streams': self.num_streams_,
+            'stream_size': self.stream_size_,
+            'error': error,
+            'elapsed': elapsed,
+            'payload_bytes': payload_bytes,
+            'wire_bytes': wire_bytes,
+            'cells': self.num_cells_,
+            'connections': self.loopback_.get_num_connections(),
+            'goodput': payload_bytes / elapsed if elapsed > 0 else 0.0,
+            'cells_per_s': self.num_cells_ / elapsed if elapsed > 0 else 0.0,
+            'overhead': wire_bytes / payload_bytes if payload_bytes else None,
+            'latency_p50': percentile(latencies, 50),
+            'latency_p99': percentile(latencies, 99),
+        }
+
+
+def percentile(values, p):
+    """The nearest-rank p-th percentile of the sorted list values, or None
+    if it's empty."""
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+
+@defer.inlineCallbacks
+def run_formats(format_names, num_streams=NUM_STREAMS,
+                stream_size=STREAM_SIZE, timeout=TIMEOUT_S, delay=0,
+                out=None):
+    """Runs the formats one after the other in the running reactor.
+    Returns a Deferred that fires with their results."""
+    retval = []
+    for format_name in format_names:
+        format_run = FormatRun(format_name, num_streams, stream_size,
+                               timeout, delay)
+        try:
+            result = yield format_run.start()
+        except Exception as e:
+            result = {'format': format_name, 'error': str(e)}
+        retval.append(result)
+        if out:
+            out.write(format_result(result) + "\n")
+            out.flush()
+    return retval
+
+
+def run(format_names, num_streams=NUM_STREAMS, stream_size=STREAM_SIZE,
+        timeout=TIMEOUT_S, delay=0, out=None):
+    """Runs the reactor until all formats have run, and returns their
+    results. The reactor can't be restarted, so call this once per
+    process."""
+    results = []
+
+    def done(retval):
+        results.extend(retval)
+        reactor.stop()
+
+    def failed(failure):
+        log.err(failure)
+        reactor.stop()
+
+    def start():
+        d = run_formats(format_names, num_streams, stream_size, timeout,
+                        delay, out)
+        d.addCallbacks(done, failed)
+
+    reactor.callWhenRunning(start)
+    reactor.run()
+    return results
+
+
+def get_format_names():
+    """Returns the names of the formats we ship, each once."""
+    retval = set()
+    for mar_file in marionette.dsl.list_mar_files('client'):
+        retval.add(mar_file.split(':')[0])
+    return sorted(retval)
+
+
+def format_result(result):
+    if result.get('elapsed') is None:
+        return "%-32s error: %s" % (result['format'], result['error'])
+
+    line = "%-32s %8.1f KiB/s %8.1f cells/s  overhead %s  %4d conns" \
+           "  p50 %s  p99 %s" % (
+               result['format'], result['goodput'] / 1024,
+               result['cells_per_s'],
+               "%6.2fx" % result['overhead'] if result['overhead'] else "    -",
+               result['connections'],
+               format_latency(result['latency_p50']),
+               format_latency(result['latency_p99']))
+    if result['error']:
+        line += "  %s" % result['error']
+    return line
+
+
+def format_latency(seconds):
+    if seconds is None:
+        return "     -"
+    return "%5.0fms" % (seconds * 1000)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Echo streams through formats over an in-memory '
+                    'loopback.')
+    parser.add_argument('--format', '-f', dest='formats', action='append',
+        help='format to run, may be repeated (default: all formats)')
+    parser.add_argument('--streams', '-n', dest='streams', type=int,
+        default=NUM_STREAMS,
+        help='concurrent streams (default %d)' % NUM_STREAMS)
+    parser.add_argument('--size', '-s', dest='size', type=int,
+        default=STREAM_SIZE,
+        help='bytes sent on each stream (default %d)' % STREAM_SIZE)
+    parser.add_argument('--timeout', dest='timeout', type=float,
+        default=TIMEOUT_S,
+        help='seconds to give each format (default %.0f)' % TIMEOUT_S)
+    parser.add_argument('--delay', dest='delay', type=float, default=0,
+        help='one-way delay of the loopback in seconds (default 0)')
+    parser.add_argument('--json', '-o', dest='json',
+        help='save the results to this file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # we want the formats as they are on disk
+    marionette.conf.set("general.autoupdate", False)
+
+    format_names = args.formats or get_format_names()
+    results = run(format_names, args.streams, args.size, args.timeout,
+                  args.delay, sys.stdout)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'version': RESULTS_VERSION, 'results': results}, f,
+                      indent=2, sort_keys=True)
+
+    if len(results) < len(format_names) or \
+            any(result['error'] for result in results):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
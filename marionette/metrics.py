@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Counters, gauges and histograms, served in the Prometheus text format.
+
+Metrics are registered once, at import time, by the modules that update
+them:
+
+    CELLS_SENT = marionette.metrics.counter(
+        'marionette_cells_sent_total', 'Cells sent.', ['format'])
+    ...
+    CELLS_SENT.labels(format_name).inc(len(cells))
+
+Updating a metric is a dict lookup and an addition, cheap enough for the
+per-cell paths. Values that are already kept elsewhere, such as queue
+depths, are read when the metrics are scraped instead, with
+Gauge.set_function.
+
+With ``listen`` set in the [metrics] section of marionette.conf (or
+--metrics on the command line), start_server() serves them at /metrics,
+either on host:port or, for ``unix:PATH``, on a Unix socket.
+"""
+
+import sys
+import bisect
+import threading
+
+from twisted.internet import reactor
+
+sys.path.append('.')
+
+import marionette.conf
+import marionette.logger
+import marionette.record_layer
+
+LOG = marionette.logger.get_logger('metrics')
+
+# seconds, for encode/decode times
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric(object):
+    """A metric with a value per combination of label values. labels()
+    returns the child holding one of them, which is what gets updated."""
+
+    type_ = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name_ = name
+        self.documentation_ = documentation
+        self.labelnames_ = tuple(labelnames)
+        self.children_ = {}
+        self.lock_ = threading.Lock()
+        self.function_ = None
+
+    def labels(self, *labelvalues):
+        child = self.children_.get(labelvalues)
+        if child is None:
+            if len(labelvalues) != len(self.labelnames_):
+                raise ValueError("%s takes labels %s, got %r" % (
+                    self.name_, self.labelnames_, labelvalues))
+            with self.lock_:
+                child = self.children_.setdefault(labelvalues,
+                                                  self.new_child())
+        return child
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def clear(self):
+        with self.lock_:
+            self.children_ = {}
+
+    def collect(self):
+        """Returns [(suffix, labelvalues, extra labels, value)] for each
+        sample, in the order they're rendered."""
+        retval = []
+        for (labelvalues, child) in sorted(self.children_.items()):
+            retval.extend(child.samples(labelvalues))
+        return retval
+
+
+class CounterChild(object):
+
+    def __init__(self):
+        self.value_ = 0.0
+
+    def inc(self, amount=1):
+        self.value_ += amount
+
+    def get(self):
+        return self.value_
+
+    def samples(self, labelvalues):
+        return [('', labelvalues, (), self.value_)]
+
+
+class Counter(Metric):
+    type_ = 'counter'
+
+    def new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class GaugeChild(CounterChild):
+
+    def dec(self, amount=1):
+        self.value_ -= amount
+
+    def set(self, value):
+        self.value_ = value
+
+
+class Gauge(Metric):
+    type_ = 'gauge'
+
+    def new_child(self):
+        return GaugeChild()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        """Read the gauge's values from function() when collected, instead
+        of keeping them. function returns {labelvalues: value}."""
+        self.function_ = function
+
+    def collect(self):
+        if self.function_ is None:
+            return Metric.collect(self)
+        return [('', labelvalues, (), value)
+                for (labelvalues, value)
+                in sorted(self.function_().items())]
+
+
+class HistogramChild(object):
+
+    def __init__(self, buckets):
+        self.buckets_ = buckets
+        self.counts_ = [0] * (len(buckets) + 1)
+        self.sum_ = 0.0
+
+    def observe(self, value):
+        self.counts_[bisect.bisect_left(self.buckets_, value)] += 1
+        self.sum_ += value
+
+    def get_count(self):
+        return sum(self.counts_)
+
+    def samples(self, labelvalues):
+        retval = []
+        cumulative = 0
+        for (bound, count) in zip(self.buckets_, self.counts_):
+            cumulative += count
+            retval.append(('_bucket', labelvalues, (('le', format_value(bound)),),
+                           cumulative))
+        cumulative += self.counts_[-1]
+        retval.append(('_bucket', labelvalues, (('le', '+Inf'),), cumulative))
+        retval.append(('_sum', labelvalues, (), self.sum_))
+        retval.append(('_count', labelvalues, (), cumulative))
+        return retval
+
+
+class Histogram(Metric):
+    type_ = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, documentation, labelnames)
+        self.buckets_ = tuple(sorted(buckets))
+
+    def new_child(self):
+        return HistogramChild(self.buckets_)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics_ = {}
+
+    def register(self, metric):
+        if metric.name_ in self.metrics_:
+            raise ValueError("metric %s is already registered" %
+                             metric.name_)
+        self.metrics_[metric.name_] = metric
+        return metric
+
+    def get(self, name):
+        return self.metrics_.get(name)
+
+    def clear(self):
+        """Resets every metric we hold to no values."""
+        for metric in self.metrics_.values():
+            metric.clear()
+
+    def render(self):
+        """Returns all metrics in the Prometheus text format."""
+        lines = []
+        for name in sorted(self.metrics_):
+            metric = self.metrics_[name]
+            lines.append('# HELP %s %s' % (
+                name, escape_help(metric.documentation_)))
+            lines.append('# TYPE %s %s' % (name, metric.type_))
+            for (suffix, labelvalues, extra, value) in metric.collect():
+                labels = list(zip(metric.labelnames_, labelvalues))
+                labels.extend(extra)
+                if labels:
+                    lines.append('%s%s{%s} %s' % (
+                        name, suffix,
+                        ','.join('%s="%s"' % (key, escape_label(value))
+                                 for (key, value) in labels),
+                        format_value(value)))
+                else:
+                    lines.append('%s%s %s' % (name, suffix,
+                                              format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def escape_help(s):
+    return s.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def escape_label(s):
+    return str(s).replace('\\', '\\\\').replace('\n', '\\n').replace(
+        '"', '\\"')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return '%d' % value
+    return repr(float(value))
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames,
+                                       buckets))
+
+
+def render():
+    return REGISTRY.render()
+
+# traffic, updated by the fte and tg plugins
+
+CELLS_SENT = counter(
+    'marionette_cells_sent_total', 'Cells sent, padding included.',
+    ['format'])
+CELLS_RECEIVED = counter(
+    'marionette_cells_received_total', 'Cells received, padding included.',
+    ['format'])
+PAYLOAD_BYTES_SENT = counter(
+    'marionette_payload_bytes_sent_total', 'Stream data sent.', ['format'])
+PAYLOAD_BYTES_RECEIVED = counter(
+    'marionette_payload_bytes_received_total', 'Stream data received.',
+    ['format'])
+COVERTEXT_BYTES_SENT = counter(
+    'marionette_covertext_bytes_sent_total',
+    'Bytes written to channels by models.', ['format'])
+COVERTEXT_BYTES_RECEIVED = counter(
+    'marionette_covertext_bytes_received_total',
+    'Bytes read from channels by models.', ['format'])
+
+
+def get_format_name(marionette_state):
+    return marionette_state.get_local("format_name") or 'unknown'
+
+
+def record_sent(marionette_state, cells, covertext_len):
+    """Counts a message of covertext_len bytes holding cells, or a padding
+    cell if cells is None."""
+    format_name = get_format_name(marionette_state)
+    if cells is None:
+        CELLS_SENT.labels(format_name).inc()
+    else:
+        CELLS_SENT.labels(format_name).inc(len(cells))
+        PAYLOAD_BYTES_SENT.labels(format_name).inc(
+            sum(len(cell_obj.get_payload()) for cell_obj in cells))
+    COVERTEXT_BYTES_SENT.labels(format_name).inc(covertext_len)
+
+
+def record_received(marionette_state, ptxt, covertext_len):
+    """Counts a message of covertext_len bytes that decoded to ptxt."""
+    format_name = get_format_name(marionette_state)
+    if isinstance(ptxt, str):
+        ptxt = ptxt.encode('latin-1')
+    (num_cells, payload_bytes) = marionette.record_layer.count_cells(ptxt)
+    CELLS_RECEIVED.labels(format_name).inc(num_cells)
+    PAYLOAD_BYTES_RECEIVED.labels(format_name).inc(payload_bytes)
+    COVERTEXT_BYTES_RECEIVED.labels(format_name).inc(covertext_len)
+
+# serving
+
+
+def start_server(listen=None):
+    """Serves the metrics at /metrics on listen, host:port or unix:PATH,
+    defaulting to ``listen`` in the [metrics] section of marionette.conf.
+    Returns the listening port, or None if there's nothing to listen on or
+    we can't."""
+    from twisted.internet import error
+    from twisted.web import resource
+    from twisted.web import server
+
+    if listen is None:
+        listen = marionette.conf.get("metrics.listen")
+    if not listen:
+        return None
+
+    class MetricsResource(resource.Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            if request.postpath not in ([b'metrics'], []):
+                request.setResponseCode(404)
+                return b''
+            request.setHeader(b'Content-Type', CONTENT_TYPE.encode('ascii'))
+            return render().encode('utf-8')
+
+    site = server.Site(MetricsResource())
+    try:
+        if listen.startswith('unix:'):
+            # wantPID clears the socket left by a worker that crashed, so
+            # its replacement can listen again
+            retval = reactor.listenUNIX(listen[len('unix:'):], site,
+                                        wantPID=True)
+        else:
+            (host, port) = listen.rsplit(':', 1)
+            retval = reactor.listenTCP(int(port), site,
+                                       interface=host.strip('[]'))
+    except (error.CannotListenError, ValueError) as e:
+        LOG.warning("Can't serve metrics on %s: %s", listen, e)
+        return None
+
+    LOG.info("Serving metrics on %s", listen)
+    return retval
@@ -1,15 +1,56 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import random
 import threading
 import heapq
 import time
+import weakref
+import collections
 
 from twisted.internet import reactor
-from twisted.python import log
 
+import marionette.conf
+import marionette.logger
+import marionette.metrics
 import marionette.record_layer
+import marionette.scheduler
+
+
+LOG = marionette.logger.get_logger('multiplexer')
+
+# live buffers, read when metrics are collected
+outgoing_buffers_ = weakref.WeakSet()
+incoming_buffers_ = weakref.WeakSet()
+
+
+def get_outgoing_queued_bytes():
+    retval = {}
+    for buffer_obj in list(outgoing_buffers_):
+        with buffer_obj.lock_:
+            for (stream_id, fifo) in buffer_obj.fifo_.items():
+                key = (str(stream_id),)
+                retval[key] = retval.get(key, 0) + len(fifo)
+    return retval
+
+
+def get_incoming_reorder_cells():
+    retval = {}
+    for buffer_obj in list(incoming_buffers_):
+        with buffer_obj.lock_:
+            for (stream_id, cells) in buffer_obj.output_q.items():
+                key = (str(stream_id),)
+                retval[key] = retval.get(key, 0) + len(cells)
+    return retval
+
+
+marionette.metrics.gauge(
+    'marionette_outgoing_queued_bytes',
+    'Stream data waiting to be sent.',
+    ['stream']).set_function(get_outgoing_queued_bytes)
+marionette.metrics.gauge(
+    'marionette_incoming_reorder_cells',
+    'Cells received out of order, waiting for the ones before them.',
+    ['stream']).set_function(get_incoming_reorder_cells)
 
 
 class MarionetteStream(object):
@@ -47,40 +88,166 @@ class MarionetteStream(object):
         return self.buffer_
 
 
-class BufferOutgoing(object):
+class StreamBuffer(object):
+    """FIFO of outgoing bytes for a single stream.
+
+    Data is kept as a deque of immutable chunks plus a read offset into the
+    first one, so appends are O(1) and pops never copy the data left behind.
+    A pop served from a single chunk returns a memoryview into it.
+    """
 
     def __init__(self):
+        self.chunks_ = collections.deque()
+        self.offset_ = 0
+        self.len_ = 0
+
+    def __len__(self):
+        return self.len_
+
+    def append(self, data):
+        if data:
+            self.chunks_.append(data)
+            self.len_ += len(data)
+
+    def pop(self, n):
+        n = min(n, self.len_)
+        if n <= 0:
+            return b''
+
+        head = self.chunks_[0]
+        head_left = len(head) - self.offset_
+        if n < head_left:
+            retval = memoryview(head)[self.offset_:self.offset_ + n]
+            self.offset_ += n
+        elif n == head_left:
+            if self.offset_ == 0:
+                retval = head
+            else:
+                retval = memoryview(head)[self.offset_:]
+            self.chunks_.popleft()
+            self.offset_ = 0
+        else:
+            parts = []
+            remaining = n
+            while remaining > 0:
+                head = self.chunks_[0]
+                head_left = len(head) - self.offset_
+                if remaining < head_left:
+                    parts.append(head[self.offset_:self.offset_ + remaining])
+                    self.offset_ += remaining
+                    remaining = 0
+                else:
+                    parts.append(head[self.offset_:])
+                    self.chunks_.popleft()
+                    self.offset_ = 0
+                    remaining -= head_left
+            retval = b''.join(parts)
+
+        self.len_ -= n
+        return retval
+
+    def peek(self):
+        if not self.chunks_:
+            return b''
+        chunks = list(self.chunks_)
+        chunks[0] = chunks[0][self.offset_:]
+        return b''.join(chunks)
+
+
+class BufferOutgoing(object):
+
+    def __init__(self, scheduler=None):
         self.fifo_ = {}
         self.terminate_ = set()
         self.streams_with_data_ = set()
         self.sequence_nums = {}
         self.lock_ = threading.RLock()
+        self.waiters_ = set()
+        self.requeued_ = collections.deque()
+        self.total_bytes_queued_ = 0
+
+        if scheduler is None:
+            scheduler = marionette.conf.get("multiplexer.scheduler")
+        if isinstance(scheduler, str):
+            scheduler = marionette.scheduler.new_scheduler(scheduler)
+        self.scheduler_ = scheduler
+        outgoing_buffers_.add(self)
 
     def push(self, stream_id, s):
         with self.lock_:
-            if not self.fifo_.get(stream_id):
-                self.fifo_[stream_id] = ''
-            # Convert bytes to string using latin-1 encoding (preserves byte values 0-255)
-            if isinstance(s, bytes):
-                s = s.decode('latin-1')
-            self.fifo_[stream_id] += s
+            # Keep an immutable copy; strs are treated as latin-1
+            # (preserves byte values 0-255)
+            if isinstance(s, str):
+                s = s.encode('latin-1')
+            elif not isinstance(s, bytes):
+                s = bytes(s)
+
+            if stream_id not in self.fifo_:
+                self.fifo_[stream_id] = StreamBuffer()
+            self.fifo_[stream_id].append(s)
+            self.total_bytes_queued_ += len(s)
 
             if s:
                 self.streams_with_data_.add(stream_id)
+                self.scheduler_.add(stream_id)
+
+        if s:
+            self.notify_waiters()
+
+        return True
+
+    def wait_for_data(self, callback):
+        """Call ``callback()`` once, the next time data is pushed or a stream
+        is terminated."""
+        with self.lock_:
+            self.waiters_.add(callback)
 
-            return True
+    def notify_waiters(self):
+        with self.lock_:
+            waiters = self.waiters_
+            self.waiters_ = set()
+        for callback in waiters:
+            callback()
+
+    def requeue(self, cell_obj):
+        """Put back a cell that was popped but never sent. It's handed out
+        again, ahead of everything else, by the next pop, padded for that
+        pop rather than the one it came from."""
+        with self.lock_:
+            cell_obj.set_length(0)
+            self.requeued_.append(cell_obj)
+        self.notify_waiters()
 
     def pop(self, model_uuid, model_instance_id, n=0):
+        """Pop a cell of n bits, which is a padding cell if there's no data
+        or not even a byte of it fits. With n=0 the cell takes all the data
+        of one stream, and it's None if there's none."""
+        cells = self.pop_many(model_uuid, model_instance_id, n, 1)
+        return cells[0] if cells else None
+
+    def pop_many(self, model_uuid, model_instance_id, n, max_cells):
+        """Pop up to ``max_cells`` cells from a single stream.
+
+        Every data cell carries up to ``n`` bits, including the cell header.
+        Padding and end-of-stream cells are always returned alone. With
+        n > 0 there's always at least one cell.
+        """
         with self.lock_:
             assert model_uuid is not None
             assert model_instance_id is not None
 
-            cell_obj = None
+            # its sequence ID is already taken, so a requeued cell goes out
+            # with its payload whole, relabelled for the model now sending
+            # it and padded to n (or longer, if its payload doesn't fit)
+            if self.requeued_:
+                cell_obj = self.requeued_.popleft()
+                cell_obj.set_model(model_uuid, model_instance_id)
+                cell_obj.set_length(n)
+                return [cell_obj]
 
-            stream_id = 0
-            interesting = self.streams_with_data_.union(self.terminate_)
-            if len(list(interesting)) > 0:
-                stream_id = random.choice(list(interesting))
+            stream_id = self.scheduler_.next()
+            if stream_id is None:
+                stream_id = 0
 
             if not self.sequence_nums.get(stream_id):
                 self.sequence_nums[stream_id] = 1
@@ -88,87 +255,163 @@ class BufferOutgoing(object):
                 sequence_id = 1
             else:
                 sequence_id = self.sequence_nums[stream_id]
-                self.sequence_nums[stream_id] += 1
 
             # determine if we should terminate the stream
-            if self.fifo_.get(
-                    stream_id) == '' and stream_id in self.terminate_:
-                cell_obj = marionette.record_layer.Cell(
+            if stream_id in self.terminate_ and not self.has_data(stream_id):
+                cells = marionette.record_layer.Cell.from_many(
                     model_uuid,
                     model_instance_id,
                     stream_id,
                     sequence_id,
+                    [b''],
                     n,
                     marionette.record_layer.END_OF_STREAM)
 
                 self.terminate_.remove(stream_id)
-                del self.fifo_[stream_id]
+                self.fifo_.pop(stream_id, None)
                 del self.sequence_nums[stream_id]
-                return cell_obj
+                self.scheduler_.remove(stream_id)
+                return cells
 
-            if n > 0:
-                if self.has_data(stream_id):
-                    cell_obj = marionette.record_layer.Cell(
-                        model_uuid,
-                        model_instance_id,
-                        stream_id,
-                        sequence_id,
-                        n)
+            cells = []
+            if self.has_data(stream_id):
+                fifo = self.fifo_[stream_id]
+                if n > 0:
                     payload_length = (
                         n - marionette.record_layer.PAYLOAD_HEADER_SIZE_IN_BITS) // 8
-                    payload = self.fifo_[stream_id][:payload_length]
-                    self.fifo_[stream_id] = self.fifo_[
-                        stream_id][payload_length:]
-                    cell_obj.set_payload(payload)
+                    if payload_length <= 0:
+                        # not even a byte of payload fits, so the data
+                        # stays queued and this goes out as padding
+                        return marionette.record_layer.Cell.from_many(
+                            model_uuid,
+                            model_instance_id,
+                            0,
+                            1,
+                            [b''],
+                            n)
                 else:
-                    cell_obj = marionette.record_layer.Cell(
-                        model_uuid,
-                        model_instance_id,
-                        0,
-                        sequence_id,
-                        n)
-            else:
+                    payload_length = len(fifo)
+                    max_cells = 1
+
+                payloads = []
+                while len(payloads) < max_cells and len(fifo) > 0:
+                    payloads.append(fifo.pop(payload_length))
+                    self.total_bytes_queued_ -= len(payloads[-1])
+
+                cells = marionette.record_layer.Cell.from_many(
+                    model_uuid,
+                    model_instance_id,
+                    stream_id,
+                    sequence_id,
+                    payloads,
+                    n)
+            elif n > 0:
+                cells = marionette.record_layer.Cell.from_many(
+                    model_uuid,
+                    model_instance_id,
+                    0,
+                    sequence_id,
+                    [b''],
+                    n)
+
+            if stream_id != 0:
+                self.sequence_nums[stream_id] += max(len(cells), 1)
+
+            if stream_id != 0:
                 if self.has_data(stream_id):
-                    cell_obj = marionette.record_layer.Cell(
-                        model_uuid,
-                        model_instance_id,
-                        stream_id,
-                        sequence_id)
-                    payload_length = len(self.fifo_[stream_id])
-                    payload = self.fifo_[stream_id][:payload_length]
-                    self.fifo_[stream_id] = self.fifo_[
-                        stream_id][payload_length:]
-                    cell_obj.set_payload(payload)
-
-            if self.fifo_.get(stream_id) == '':
-                self.streams_with_data_.remove(stream_id)
-
-            return cell_obj
+                    self.scheduler_.charge(
+                        stream_id, sum(len(cell_obj.get_payload())
+                                       for cell_obj in cells))
+                else:
+                    self.streams_with_data_.discard(stream_id)
+                    if stream_id in self.terminate_:
+                        self.scheduler_.charge(stream_id, 0)
+                    else:
+                        self.scheduler_.remove(stream_id)
+
+            return cells
+
+    def pop_packed(self, model_uuid, model_instance_id, n, min_n=0):
+        """Pop cells from as many streams as it takes to fill n bits, cell
+        headers included, for sending back to back in one message.
+
+        Each cell is cut to fit its payload, except that the last one is
+        padded so that together they take at least min_n bits. If there's
+        nothing to send, that's a single padding cell of min_n bits.
+        """
+        header_bits = marionette.record_layer.PAYLOAD_HEADER_SIZE_IN_BITS
+        n = max(n, min_n, header_bits + 8)
+
+        with self.lock_:
+            if self.is_empty():
+                return self.pop_many(model_uuid, model_instance_id, min_n, 1)
+
+            cells = []
+            used = 0
+            while n - used >= header_bits + 8 and not self.is_empty():
+                cell_obj = self.pop_many(model_uuid, model_instance_id,
+                                         n - used, 1)[0]
+                cell_len = header_bits + len(cell_obj.get_payload()) * 8
+                cell_obj.set_length(cell_len)
+                cells.append(cell_obj)
+                used += cell_len
+
+            if used < min_n:
+                cells[-1].set_length(
+                    cells[-1].get_length() + min_n - used)
+
+            return cells
+
+    def queued_bits(self):
+        """Returns the bits it takes to send everything queued, as cells
+        packed by pop_packed: payloads plus a cell header per stream."""
+        with self.lock_:
+            retval = self.total_bytes_queued_ * 8
+            retval += len(self.scheduler_) * \
+                marionette.record_layer.PAYLOAD_HEADER_SIZE_IN_BITS
+            for cell_obj in self.requeued_:
+                retval += marionette.record_layer.PAYLOAD_HEADER_SIZE_IN_BITS
+                retval += len(cell_obj.get_payload()) * 8
+        return retval
 
     def peek(self, stream_id):
-        retval = ''
+        retval = b''
         with self.lock_:
-            if self.fifo_.get(stream_id):
-                retval = self.fifo_.get(stream_id)
+            if stream_id in self.fifo_:
+                retval = self.fifo_[stream_id].peek()
         return retval
 
     def has_data(self, stream_id):
         retval = False
         with self.lock_:
-            if self.fifo_.get(stream_id):
+            if stream_id in self.fifo_:
                 retval = len(self.fifo_[stream_id]) > 0
         return retval
 
+    def bytes_queued(self, stream_id):
+        with self.lock_:
+            fifo = self.fifo_.get(stream_id)
+            return len(fifo) if fifo is not None else 0
+
     def has_data_for_any_stream(self):
         retval = None
         with self.lock_:
-            if len(self.streams_with_data_) > 0:
-                retval = random.choice(list(self.streams_with_data_))
+            if self.requeued_:
+                retval = self.requeued_[0].get_stream_id()
+            elif len(self.streams_with_data_) > 0:
+                retval = self.scheduler_.peek()
         return retval
 
+    def is_empty(self):
+        """True if the next pop can only return a padding cell."""
+        with self.lock_:
+            return not self.requeued_ and len(self.scheduler_) == 0
+
     def terminate(self, stream_id):
         with self.lock_:
             self.terminate_.add(stream_id)
+            self.scheduler_.add(stream_id)
+        self.notify_waiters()
 
 
 class BufferIncoming(object):
@@ -176,8 +419,13 @@ class BufferIncoming(object):
     # Default timeout for orphaned streams (seconds)
     DEFAULT_STREAM_TIMEOUT = 300  # 5 minutes
 
+    # Consumed bytes are only dropped from the front of fifo_ once there
+    # are at least this many, and they make up at least half the buffer.
+    COMPACT_THRESHOLD = 2 ** 16
+
     def __init__(self, stream_timeout=None):
-        self.fifo_ = ''
+        self.fifo_ = bytearray()
+        self.fifo_offset_ = 0
         self.fifo_len_ = 0
         self.output_q = {}
         self.curr_seq_id = {}
@@ -186,6 +434,7 @@ class BufferIncoming(object):
         self.has_data_ = False
         self.callback_ = None
         self.lock_ = threading.RLock()
+        incoming_buffers_.add(self)
 
     def addCallback(self, callback):
         with self.lock_:
@@ -203,11 +452,12 @@ class BufferIncoming(object):
                 cell_obj = heapq.heappop(self.output_q[cell_stream_id])
                 self.curr_seq_id[cell_stream_id] += 1
 
-                log.msg("Stream %d Dequeue ID %d" % 
-                    (cell_stream_id,cell_obj.get_seq_id()))
+                if LOG.debug_enabled:
+                    LOG.debug("Stream %d Dequeue ID %d", cell_stream_id,
+                              cell_obj.get_seq_id())
 
                 if cell_obj.get_cell_type() == marionette.record_layer.END_OF_STREAM:
-                    log.msg("Removing Stream %d" % (cell_stream_id))
+                    LOG.debug("Removing Stream %d", cell_stream_id)
                     remove_keys.add(cell_stream_id)
 
                 reactor.callFromThread(self.callback_, cell_obj)
@@ -224,47 +474,70 @@ class BufferIncoming(object):
                 self.output_q[cell_stream_id] = []
                 self.curr_seq_id[cell_stream_id] = 1
             heapq.heappush(self.output_q[cell_stream_id],cell_obj)
-            log.msg("Stream %d Enqueue ID %d" % (cell_stream_id,cell_obj.get_seq_id()))
+            if LOG.debug_enabled:
+                LOG.debug("Stream %d Enqueue ID %d", cell_stream_id,
+                          cell_obj.get_seq_id())
 
     def push(self, s):
         with self.lock_:
-            # Convert bytes to string using latin-1 encoding (preserves byte values 0-255)
-            if isinstance(s, bytes):
-                s = s.decode('latin-1')
+            # strs are treated as latin-1 (preserves byte values 0-255)
+            if isinstance(s, str):
+                s = s.encode('latin-1')
             self.fifo_ += s
             self.fifo_len_ += len(s)
 
         if self.callback_:
-            while True:
-                cell_obj = self.pop()
-                if cell_obj:
-                    cell_stream_id = cell_obj.get_stream_id()
-                    if cell_stream_id > 0:
-                        self.enqueue(cell_obj, cell_stream_id)
-                        self.dequeue(cell_stream_id)
-                    else:
-                        reactor.callFromThread(self.callback_, cell_obj)
-                    continue
+            for cell_obj in self.pop_cells():
+                cell_stream_id = cell_obj.get_stream_id()
+                if cell_stream_id > 0:
+                    self.enqueue(cell_obj, cell_stream_id)
+                    self.dequeue(cell_stream_id)
                 else:
-                    break
+                    reactor.callFromThread(self.callback_, cell_obj)
 
         return True
 
     def pop(self):
         with self.lock_:
-            cell_obj = None
-
-            if len(self.fifo_) >= 8:
-                cell_len = marionette.record_layer.bytes_to_long(
-                    str(self.fifo_[:4]))
-                cell_obj = marionette.record_layer.unserialize(
-                    self.fifo_[:cell_len])
-                self.fifo_ = self.fifo_[cell_len:]
+            (cell_obj, cell_len) = marionette.record_layer.unserialize_from(
+                self.fifo_, self.fifo_offset_)
+            if cell_obj:
+                self.fifo_offset_ += cell_len
                 self.fifo_len_ -= cell_len
-                self.fifo_len_ = max(self.fifo_len_, 0)
+                self._compact()
 
         return cell_obj
 
+    def pop_cells(self):
+        """Pop every complete cell currently buffered.
+
+        A trailing, partially received cell is left in the buffer until the
+        rest of it arrives.
+        """
+        retval = []
+        with self.lock_:
+            while True:
+                (cell_obj, cell_len) = \
+                    marionette.record_layer.unserialize_from(
+                        self.fifo_, self.fifo_offset_)
+                if not cell_obj:
+                    break
+                retval.append(cell_obj)
+                self.fifo_offset_ += cell_len
+                self.fifo_len_ -= cell_len
+            self._compact()
+
+        return retval
+
+    def _compact(self):
+        if self.fifo_offset_ == len(self.fifo_):
+            self.fifo_ = bytearray()
+            self.fifo_offset_ = 0
+        elif self.fifo_offset_ >= self.COMPACT_THRESHOLD and \
+                self.fifo_offset_ * 2 >= len(self.fifo_):
+            del self.fifo_[:self.fifo_offset_]
+            self.fifo_offset_ = 0
+
     def _cleanup_stream(self, stream_id):
         """Clean up resources for a stream."""
         with self.lock_:
@@ -289,8 +562,9 @@ class BufferIncoming(object):
                     orphaned_streams.append(stream_id)
             
             for stream_id in orphaned_streams:
-                log.msg("Cleaning up orphaned stream %d (inactive for %.1f seconds)" %
-                       (stream_id, current_time - self.stream_last_activity.get(stream_id, 0)))
+                LOG.info("Cleaning up orphaned stream %d (inactive for %.1f seconds)",
+                         stream_id,
+                         current_time - self.stream_last_activity.get(stream_id, 0))
                 self._cleanup_stream(stream_id)
             
             return len(orphaned_streams)
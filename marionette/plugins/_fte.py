@@ -2,20 +2,46 @@
 # coding: utf-8
 
 import math
+import time
+
+from twisted.internet import defer
 
 import fte.encoder
+import marionette.conf
+import marionette.covertext_pool
+import marionette.fte_pool
+import marionette.metrics
 import marionette.record_layer
 
 MAX_CELL_LENGTH_IN_BITS = (2 ** 18) * 8
 
+ENCODE_SECONDS = marionette.metrics.histogram(
+    'marionette_fte_encode_seconds',
+    'Time to make an fte covertext, including waiting for the pool.',
+    ['format'])
+DECODE_SECONDS = marionette.metrics.histogram(
+    'marionette_fte_decode_seconds',
+    'Time to decode an fte covertext, including waiting for the pool.',
+    ['format'])
+
 
 def send_async(channel, marionette_state, input_args):
-    send(channel, marionette_state, input_args, blocking=False)
-    return True
+    retval = send(channel, marionette_state, input_args, blocking=False)
+    if isinstance(retval, defer.Deferred):
+        return retval.addCallback(mark_idle_unless, marionette_state)
+    return mark_idle_unless(retval, marionette_state)
 
 
 def recv_async(channel, marionette_state, input_args):
-    recv(channel, marionette_state, input_args, blocking=False)
+    retval = recv(channel, marionette_state, input_args, blocking=False)
+    if isinstance(retval, defer.Deferred):
+        return retval.addCallback(mark_idle_unless, marionette_state)
+    return mark_idle_unless(retval, marionette_state)
+
+
+def mark_idle_unless(success, marionette_state):
+    if not success:
+        marionette_state.mark_idle()
     return True
 
 
@@ -25,42 +51,181 @@ def send(channel, marionette_state, input_args, blocking=True):
     regex = input_args[0]
     msg_len = int(input_args[1])
 
-    stream_id = marionette_state.get_global(
-        "multiplexer_outgoing").has_data_for_any_stream()
-    if stream_id or blocking:
+    (cells, ctxt) = (None, None)
+    if blocking:
+        (cells, ctxt) = take_presend(marionette_state, regex, msg_len)
+
+    if ctxt is None:
+        stream_id = marionette_state.get_global(
+            "multiplexer_outgoing").has_data_for_any_stream()
+        if stream_id or blocking:
+            (cells, ctxt) = make_ctxt(marionette_state, regex, msg_len)
+
+    if isinstance(ctxt, defer.Deferred):
+        retval = ctxt.addCallback(send_ctxt, channel, marionette_state, cells)
+    elif ctxt is not None:
+        retval = send_ctxt(ctxt, channel, marionette_state, cells)
+
+    return retval
+
+
+def prepare_send(channel, marionette_state, input_args):
+    """Pops and encodes the cells for an upcoming send, so that they're
+    ready when we get there. Returns a function that puts their data back,
+    if the send doesn't happen after all."""
+    if not marionette.conf.get("fte.presend"):
+        return None
+
+    regex = input_args[0]
+    msg_len = int(input_args[1])
+
+    (cells, ctxt) = make_ctxt(marionette_state, regex, msg_len)
+
+    presend = [regex, msg_len, cells, ctxt]
+    marionette_state.set_prepared("fte.send", presend)
 
-        fteObj = marionette_state.get_fte_obj(regex, msg_len)
+    def cancel():
+        if marionette_state.get_prepared("fte.send") is presend:
+            marionette_state.pop_prepared("fte.send")
+            discard_presend(marionette_state, presend)
 
-        bits_in_buffer = len(
-            marionette_state.get_global("multiplexer_outgoing").peek(stream_id)) * 8
-        min_cell_len_in_bytes = int(math.floor(fteObj.getCapacity() / 8.0)) \
-            - fte.encoder.DfaEncoderObject._COVERTEXT_HEADER_LEN_CIPHERTEXT \
-            - fte.encrypter.Encrypter._CTXT_EXPANSION
-        min_cell_len_in_bits = min_cell_len_in_bytes * 8
+    return cancel
 
-        cell_headers_in_bits = marionette.record_layer.PAYLOAD_HEADER_SIZE_IN_BITS
+
+def take_presend(marionette_state, regex, msg_len):
+    """Returns the cells and ciphertext (or a Deferred for it)
+    prepare_send() made for this send, if they're still what we'd send now,
+    else (None, None)."""
+    presend = marionette_state.pop_prepared("fte.send")
+    if presend is None:
+        return (None, None)
+
+    [presend_regex, presend_msg_len, cells, ctxt] = presend
+    stale = (presend_regex, presend_msg_len) != (regex, msg_len)
+    if cells is None and not marionette_state.get_global(
+            "multiplexer_outgoing").is_empty():
+        # data came in since; don't send padding in its place
+        stale = True
+
+    if stale:
+        discard_presend(marionette_state, presend)
+        return (None, None)
+    return (cells, ctxt)
+
+
+def discard_presend(marionette_state, presend):
+    [regex, msg_len, cells, ctxt] = presend
+    for cell_obj in cells or []:
+        if cell_obj.get_stream_id() != 0:
+            marionette_state.get_global(
+                "multiplexer_outgoing").requeue(cell_obj)
+    if isinstance(ctxt, defer.Deferred):
+        ctxt.addErrback(lambda failure: None)
+
+
+def make_ctxt(marionette_state, regex, msg_len):
+    """Returns the cells to send next and their ciphertext, or a Deferred
+    for it if we encode in the pool. Padding comes ready-made from the
+    model's covertext pool, without cells.
+
+    With fte.pack_cells set, the message is sized for everything that's
+    queued, and holds a cell from each stream with data, so that many small
+    streams share one message instead of each taking a minimum-length one.
+    Otherwise it holds a single cell, sized for one stream, which is all
+    that peers without pack_cells accept."""
+    multiplexer = marionette_state.get_global("multiplexer_outgoing")
+    if multiplexer.is_empty():
+        pool = get_padding_pool(marionette_state, regex, msg_len)
+        return (None, pool.get())
+
+    min_cell_len_in_bits = get_min_cell_len(marionette_state, regex, msg_len)
+    model_uuid = marionette_state.get_local("model_uuid")
+    model_instance_id = marionette_state.get_local("model_instance_id")
+
+    if marionette.conf.get("fte.pack_cells"):
+        cell_len_in_bits = max(min_cell_len_in_bits,
+                               multiplexer.queued_bits())
+        cell_len_in_bits = min(cell_len_in_bits, MAX_CELL_LENGTH_IN_BITS)
+        cells = multiplexer.pop_packed(model_uuid, model_instance_id,
+                                       cell_len_in_bits,
+                                       min_cell_len_in_bits)
+    else:
+        stream_id = multiplexer.has_data_for_any_stream()
+        bits_in_buffer = multiplexer.bytes_queued(stream_id) * 8 + \
+            marionette.record_layer.PAYLOAD_HEADER_SIZE_IN_BITS
         cell_len_in_bits = max(min_cell_len_in_bits, bits_in_buffer)
-        cell_len_in_bits = min(cell_len_in_bits + cell_headers_in_bits,
-                               MAX_CELL_LENGTH_IN_BITS)
-
-        cell = marionette_state.get_global("multiplexer_outgoing").pop(
-            marionette_state.get_local("model_uuid"),
-            marionette_state.get_local("model_instance_id"),
-            cell_len_in_bits)
-        ptxt = cell.to_string()
-        # Convert string to bytes using latin-1 encoding (preserves byte values 0-255)
-        if isinstance(ptxt, str):
-            ptxt = ptxt.encode('latin-1')
-
-        ctxt = fteObj.encode(ptxt)
-        # FTE.encode() returns bytes, ensure it stays as bytes for channel.sendall()
-        if not isinstance(ctxt, bytes):
-            ctxt = ctxt.encode('latin-1') if isinstance(ctxt, str) else bytes(ctxt)
-        ctxt_len = len(ctxt)
-        bytes_sent = channel.sendall(ctxt)
-        retval = (ctxt_len == bytes_sent)
+        cell_len_in_bits = min(cell_len_in_bits, MAX_CELL_LENGTH_IN_BITS)
+        cells = [multiplexer.pop(model_uuid, model_instance_id,
+                                 cell_len_in_bits)]
+    ptxt = b''.join(cell_obj.to_bytes() for cell_obj in cells)
+    return (cells, encode_ptxt(marionette_state, regex, msg_len, ptxt))
 
-    return retval
+
+def get_padding_pool(marionette_state, regex, msg_len):
+    model_uuid = marionette_state.get_local("model_uuid")
+    model_instance_id = marionette_state.get_local("model_instance_id")
+
+    key = ("fte.padding", regex, msg_len, model_instance_id)
+    pool = marionette_state.get_prepared(key)
+    if pool is None:
+        cell = marionette.record_layer.Cell(
+            model_uuid, model_instance_id, 0, 1,
+            get_min_cell_len(marionette_state, regex, msg_len))
+        ptxt = cell.to_bytes()
+        pool = marionette.covertext_pool.CovertextPool(
+            lambda: encode_ptxt(marionette_state, regex, msg_len, ptxt))
+        marionette_state.set_prepared(key, pool)
+    return pool
+
+
+def get_min_cell_len(marionette_state, regex, msg_len):
+    """Returns the length in bits of the cells in a message that fill its
+    capacity, cell header included."""
+    fteObj = marionette_state.get_fte_obj(regex, msg_len)
+
+    min_cell_len_in_bytes = int(math.floor(fteObj.getCapacity() / 8.0)) \
+        - fte.encoder.DfaEncoderObject._COVERTEXT_HEADER_LEN_CIPHERTEXT \
+        - fte.encrypter.Encrypter._CTXT_EXPANSION
+    min_cell_len_in_bits = min_cell_len_in_bytes * 8
+
+    cell_headers_in_bits = marionette.record_layer.PAYLOAD_HEADER_SIZE_IN_BITS
+    return min(min_cell_len_in_bits + cell_headers_in_bits,
+               MAX_CELL_LENGTH_IN_BITS)
+
+
+def encode_ptxt(marionette_state, regex, msg_len, ptxt):
+    """Returns the ciphertext for ptxt, or a Deferred for it if we encode in
+    the pool."""
+    format_name = marionette.metrics.get_format_name(marionette_state)
+    if marionette.fte_pool.is_enabled():
+        return observe_time(marionette.fte_pool.encode(regex, msg_len, ptxt),
+                            ENCODE_SECONDS.labels(format_name))
+
+    t0 = time.perf_counter()
+    ctxt = marionette_state.get_fte_obj(regex, msg_len).encode(ptxt)
+    ENCODE_SECONDS.labels(format_name).observe(time.perf_counter() - t0)
+    # FTE.encode() returns bytes, ensure it stays as bytes for channel.sendall()
+    if not isinstance(ctxt, bytes):
+        ctxt = ctxt.encode('latin-1') if isinstance(ctxt, str) else bytes(ctxt)
+    return ctxt
+
+
+def send_ctxt(ctxt, channel, marionette_state=None, cells=None):
+    ctxt_len = len(ctxt)
+    bytes_sent = channel.sendall(ctxt)
+    if marionette_state is not None:
+        marionette.metrics.record_sent(marionette_state, cells, bytes_sent)
+    return (ctxt_len == bytes_sent)
+
+
+def observe_time(d, histogram):
+    """Observes the time until d fires in histogram."""
+    t0 = time.perf_counter()
+
+    def done(result):
+        histogram.observe(time.perf_counter() - t0)
+        return result
+    return d.addCallback(done)
 
 
 def recv(channel, marionette_state, input_args, blocking=True):
@@ -68,6 +233,9 @@ def recv(channel, marionette_state, input_args, blocking=True):
     regex = input_args[0]
     msg_len = int(input_args[1])
 
+    if marionette.fte_pool.is_enabled():
+        return recv_in_pool(channel, marionette_state, regex, msg_len)
+
     fteObj = marionette_state.get_fte_obj(regex, msg_len)
 
     try:
@@ -76,21 +244,15 @@ def recv(channel, marionette_state, input_args, blocking=True):
             # Convert string to bytes using latin-1 encoding (preserves byte values 0-255)
             if isinstance(ctxt, str):
                 ctxt = ctxt.encode('latin-1')
+            t0 = time.perf_counter()
             [ptxt, remainder] = fteObj.decode(ctxt)
-            # Convert bytes back to string for compatibility
-            if isinstance(ptxt, bytes):
-                ptxt = ptxt.decode('latin-1')
-            if isinstance(remainder, bytes):
-                remainder = remainder.decode('latin-1')
+            DECODE_SECONDS.labels(marionette.metrics.get_format_name(
+                marionette_state)).observe(time.perf_counter() - t0)
 
-            cell_obj = marionette.record_layer.unserialize(ptxt)
-            assert cell_obj.get_model_uuid() == marionette_state.get_local(
-                "model_uuid")
-
-            marionette_state.set_local(
-                "model_instance_id", cell_obj.get_model_instance_id())
-
-            if marionette_state.get_local("model_instance_id"):
+            cell_obj = accept_cell(ptxt, marionette_state)
+            if cell_obj:
+                marionette.metrics.record_received(
+                    marionette_state, ptxt, len(ctxt) - len(remainder))
                 if cell_obj.get_stream_id() > 0:
                     marionette_state.get_global(
                         "multiplexer_incoming").push(ptxt)
@@ -110,3 +272,80 @@ def recv(channel, marionette_state, input_args, blocking=True):
             channel.rollback()
 
     return retval
+
+
+def recv_in_pool(channel, marionette_state, regex, msg_len):
+    # The data stays in the channel until it's been decoded, as other models
+    # on the channel may want to try it meanwhile.
+    ctxt = channel.peek()
+    if len(ctxt) == 0:
+        return False
+
+    retval = marionette.fte_pool.decode(regex, msg_len,
+                                        ctxt.encode('latin-1'))
+    observe_time(retval, DECODE_SECONDS.labels(
+        marionette.metrics.get_format_name(marionette_state)))
+    retval.addCallbacks(recv_decoded, recv_failed,
+                        callbackArgs=(channel, marionette_state, ctxt))
+    return retval
+
+
+def recv_decoded(decoded, channel, marionette_state, ctxt):
+    [ptxt, remainder] = decoded
+
+    cell_obj = accept_cell(ptxt, marionette_state)
+    if not cell_obj:
+        return False
+    if not channel.consume(ctxt, len(ctxt) - len(remainder)):
+        # another model on the channel got there first
+        return False
+
+    marionette.metrics.record_received(
+        marionette_state, ptxt, len(ctxt) - len(remainder))
+    if cell_obj.get_stream_id() > 0:
+        marionette_state.get_global("multiplexer_incoming").push(ptxt)
+    return True
+
+
+def recv_failed(reason):
+    reason.trap(fte.encrypter.RecoverableDecryptionError)
+    return False
+
+
+def accept_cell(ptxt, marionette_state):
+    """Checks that ptxt holds cells for this model, one or, from a peer
+    with fte.pack_cells set, several back to back, and syncs our model
+    instance with the sender's. Returns the first cell, or None if they
+    can't be accepted yet."""
+    cells = unserialize_cells(ptxt)
+    cell_obj = cells[0]
+    assert cell_obj.get_model_uuid() == marionette_state.get_local(
+        "model_uuid")
+    for other in cells[1:]:
+        # a message belongs to a single model instance
+        if other.get_model_uuid() != cell_obj.get_model_uuid() or \
+                other.get_model_instance_id() != \
+                cell_obj.get_model_instance_id():
+            raise marionette.record_layer.UnserializeException()
+
+    marionette_state.set_local(
+        "model_instance_id", cell_obj.get_model_instance_id())
+
+    if marionette_state.get_local("model_instance_id"):
+        return cell_obj
+    return None
+
+
+def unserialize_cells(ptxt):
+    """Returns the cells in ptxt, which must hold at least one and nothing
+    but whole cells."""
+    retval = []
+    offset = 0
+    while offset < len(ptxt) or not retval:
+        (cell_obj, cell_len) = marionette.record_layer.unserialize_from(
+            ptxt, offset)
+        if cell_obj is None:
+            raise marionette.record_layer.UnserializeException()
+        retval.append(cell_obj)
+        offset += cell_len
+    return retval
@@ -2,7 +2,10 @@
 # coding: utf-8
 
 import time
+import bisect
 import random
+import weakref
+import collections
 
 from twisted.internet import reactor
 
@@ -10,36 +13,92 @@ import marionette.driver
 
 
 def sleep(channel, marionette_state, input_args, blocking=True):
-    sleep_dist = input_args[0]
-    sleep_dist = sleep_dist[1:-1]
-    while ' ' in sleep_dist:
-        sleep_dist = sleep_dist.replace(' ', '')
-    while '\n' in sleep_dist:
-        sleep_dist = sleep_dist.replace('\n', '')
-    while '\t' in sleep_dist:
-        sleep_dist = sleep_dist.replace('\t', '')
-    while '\r' in sleep_dist:
-        sleep_dist = sleep_dist.replace('\r', '')
-    sleep_dist = sleep_dist.split(',')
+    """Blocks the transition for a duration drawn from the distribution in
+    input_args[0]. Rather than sleeping in the reactor thread, it sets a
+    deadline for the model, which is woken up when it passes and tries the
+    transition again."""
+    now = time.monotonic()
+    deadline = marionette_state.get_deadline()
+    if deadline is None:
+        to_sleep = get_sleep_sampler(input_args[0]).sample(random.random())
+        if to_sleep <= 0:
+            return True
+        deadline = now + to_sleep
+        marionette_state.set_deadline(deadline)
+
+    if now >= deadline:
+        marionette_state.set_deadline(None)
+        return True
+
+    marionette_state.request_wakeup(deadline - now)
+    return False
+
+
+class SleepSampler(object):
+    """Draws durations from a parsed model.sleep distribution."""
+
+    def __init__(self, dist):
+        self.durations_ = list(dist.keys())
+        self.cumulative_ = []
+        self.total_ = 0
+        for duration in self.durations_:
+            self.total_ += dist[duration]
+            self.cumulative_.append(self.total_)
+        self.mean_ = 0.0
+        if self.total_:
+            self.mean_ = sum(duration * dist[duration]
+                             for duration in self.durations_) / self.total_
+
+    def sample(self, coin):
+        """Returns the duration for coin, a number in [0, 1). If the
+        probabilities add up to less than coin, it's the last duration."""
+        if not self.durations_:
+            return 0
+        i = bisect.bisect_left(self.cumulative_, coin)
+        return self.durations_[min(i, len(self.durations_) - 1)]
+
+    def get_mean(self):
+        return self.mean_
+
+
+# Parsed distributions, keyed by the argument of model.sleep. They're parsed
+# when a format using them is loaded, by PIOA.do_precomputations(), and the
+# loaded format holds on to them. The last MAX_RECENT_SLEEP_SAMPLERS parsed
+# are held here too, so that one no loaded format uses is still parsed only
+# once; beyond that, they're dropped from here.
+MAX_RECENT_SLEEP_SAMPLERS = 256
+
+sleep_samplers_ = weakref.WeakValueDictionary()
+recent_sleep_samplers_ = collections.deque(maxlen=MAX_RECENT_SLEEP_SAMPLERS)
+
+
+def get_sleep_sampler(sleep_dist):
+    """Returns the parsed distribution sleep_dist, parsing it unless it
+    was recently or a loaded format has."""
+    retval = sleep_samplers_.get(sleep_dist)
+    if retval is None:
+        retval = SleepSampler(parse_sleep_distribution(sleep_dist))
+        sleep_samplers_[sleep_dist] = retval
+        recent_sleep_samplers_.append(retval)
+    return retval
+
+
+def parse_sleep_distribution(sleep_dist):
+    """Parses the argument of model.sleep, a string like
+    "{'0.1': 0.5, '0.2': 0.5}", into {seconds: probability}. Zero or
+    negative durations are left out."""
+    sleep_dist = ''.join(sleep_dist[1:-1].split())
     dist = {}
-    for item in sleep_dist:
-        val = float(item.split(':')[0][1:-1])
-        prob = float(item.split(':')[1])
+    for item in sleep_dist.split(','):
+        (val, prob) = item.split(':')[:2]
+        val = float(val[1:-1])
         if val > 0:
-            dist[val] = prob
-
-    coin = random.random()
-    total_sum = 0
-    for to_sleep in dist.keys():
-        total_sum += dist[to_sleep]
-        if total_sum >= coin:
-            break
-
-    time.sleep(to_sleep)
-
-    return True
+            dist[val] = float(prob)
+    return dist
 
 
+# how often a model blocked in spawn checks on its children
+SPAWN_POLL_INTERVAL_S = 0.01
 
 # maybe these should be in marionette_state?
 client_driver_ = None
@@ -95,4 +154,7 @@ def spawn(channel, marionette_state, input_args, blocking=True):
             client_driver_ = None
             success = True
 
+    if not success:
+        marionette_state.request_wakeup(SPAWN_POLL_INTERVAL_S)
+
     return success
@@ -3,6 +3,7 @@
 
 import math
 import socket
+import functools
 import random
 import string
 
@@ -15,6 +16,9 @@ import fte.dfa
 import fte.bit_ops
 import re
 
+import marionette.covertext_pool
+import marionette.dfa_cache
+import marionette.metrics
 import marionette.record_layer
 
 def send(channel, marionette_state, input_args):
@@ -22,13 +26,15 @@ def send(channel, marionette_state, input_args):
 
     ctxt = generate_template(grammar)
 
-    for handler_key in conf[grammar]["handler_order"]:
+    cells = []
+    for handler_key in get_conf(grammar)["handler_order"]:
         ctxt = execute_handler_sender(
             marionette_state,
             grammar,
             handler_key,
             ctxt,
-            marionette_state.get_global("multiplexer_outgoing"))
+            marionette_state.get_global("multiplexer_outgoing"),
+            cells)
 
     ctxt_len = len(ctxt)
     while len(ctxt) > 0:
@@ -38,6 +44,7 @@ def send(channel, marionette_state, input_args):
         except socket.timeout:
             continue
     retval = (ctxt_len == bytes_sent)
+    marionette.metrics.record_sent(marionette_state, cells, ctxt_len)
 
     return retval
 
@@ -51,7 +58,7 @@ def recv(channel, marionette_state, input_args):
 
         if parser(grammar, ctxt):
             cell_str = ''
-            for handler_key in conf[grammar]["handler_order"]:
+            for handler_key in get_conf(grammar)["handler_order"]:
                 tmp_str = execute_handler_receiver(marionette_state,
                                                    grammar, handler_key, ctxt)
                 if tmp_str:
@@ -73,6 +80,10 @@ def recv(channel, marionette_state, input_args):
                     marionette_state.get_global(
                         "multiplexer_incoming").push(cell_str)
                     retval = True
+
+            if retval:
+                marionette.metrics.record_received(
+                    marionette_state, cell_str, len(ctxt))
     except socket.timeout as e:
         pass
     except socket.error as e:
@@ -87,8 +98,9 @@ def recv(channel, marionette_state, input_args):
 
 def get_grammar_capacity(grammar):
     retval = 0
-    for handler_key in conf[grammar]["handler_order"]:
-        retval += conf[grammar]['handlers'][handler_key].capacity()
+    grammar_conf = get_conf(grammar)
+    for handler_key in grammar_conf["handler_order"]:
+        retval += grammar_conf['handlers'][handler_key].capacity()
     retval /= 8.0
     return retval
 
@@ -114,8 +126,8 @@ def do_unembed(grammar, ctxt, handler_key):
 
 
 def execute_handler_sender(marionette_state, grammar, handler_key,
-                           template, multiplexer):
-    to_execute = conf[grammar]["handlers"][handler_key]
+                           template, multiplexer, cells=None):
+    to_execute = get_conf(grammar)["handlers"][handler_key]
 
     cell_len_in_bits = to_execute.capacity()
     to_embed = ''
@@ -123,6 +135,8 @@ def execute_handler_sender(marionette_state, grammar, handler_key,
         cell = multiplexer.pop(marionette_state.get_local("model_uuid"),
                                marionette_state.get_local("model_instance_id"),
                                cell_len_in_bits)
+        if cells is not None:
+            cells.append(cell)
         to_embed = cell.to_string()
     value_to_embed = to_execute.encode(marionette_state, template, to_embed)
     template = do_embed(grammar, template, handler_key, value_to_embed)
@@ -134,7 +148,7 @@ def execute_handler_receiver(marionette_state, grammar, handler_key,
                              ctxt):
     ptxt = ''
 
-    to_execute = conf[grammar]["handlers"][handler_key]
+    to_execute = get_conf(grammar)["handlers"][handler_key]
 
     handler_key_value = do_unembed(grammar, ctxt, handler_key)
     ptxt = to_execute.decode(marionette_state, handler_key_value)
@@ -143,21 +157,11 @@ def execute_handler_receiver(marionette_state, grammar, handler_key,
 
 # handlers
 
-regex_cache_ = {}
-fte_cache_ = {}
-
-
 class RankerHandler(object):
 
     def __init__(self, regex, msg_len):
         self.regex_ = regex
-
-        regex_key = regex + str(msg_len)
-        if not regex_cache_.get(regex_key):
-            dfa = fte.regex2dfa.regex2dfa(regex)
-            encoder = fte.dfa.DFA(dfa, msg_len)
-            regex_cache_[regex_key] = (dfa, encoder)
-        (self.dfa_, self.encoder_) = regex_cache_[regex_key]
+        self.encoder_ = marionette.dfa_cache.get_ranker(regex, msg_len)
 
     def capacity(self):
         cell_len_in_bytes = int(math.floor(self.encoder_.capacity / 8.0))
@@ -183,13 +187,7 @@ class FteHandler(object):
 
     def __init__(self, regex, msg_len):
         self.regex_ = regex
-
-        fte_key = regex + str(msg_len)
-        if not fte_cache_.get(fte_key):
-            dfa = fte.regex2dfa.regex2dfa(regex)
-            encrypter = fte.encoder.DfaEncoder(dfa, msg_len)
-            fte_cache_[fte_key] = (dfa, encrypter)
-        (self.dfa_, self.fte_encrypter_) = fte_cache_[fte_key]
+        self.fte_encrypter_ = marionette.dfa_cache.get_encoder(regex, msg_len)
 
     def capacity(self):
         if self.regex_.endswith(".+"):
@@ -470,11 +468,8 @@ class AmazonMsgLensHandler(object):
 
         self.min_len_ = min_len
 
-        key = self.regex_ + str(self.min_len_)
-        if not fte_cache_.get(key):
-            dfa = fte.regex2dfa.regex2dfa(self.regex_)
-            encoder = fte.encoder.DfaEncoder(dfa, self.min_len_)
-            fte_cache_[key] = (dfa, encoder)
+        self.encoder_ = marionette.dfa_cache.get_encoder(
+            self.regex_, self.min_len_)
 
         self.max_len_ = 2**18
 
@@ -506,22 +501,13 @@ class AmazonMsgLensHandler(object):
         ctxt = ''
 
         if self.target_len_ < self.min_len_ or self.target_len_ > self.max_len_:
-            key = self.regex_ + str(self.target_len_)
-            if not regex_cache_.get(key):
-                dfa = fte.regex2dfa.regex2dfa(self.regex_)
-                encoder = fte.dfa.DFA(dfa, self.target_len_)
-                regex_cache_[key] = (dfa, encoder)
-
-            (dfa, encoder) = regex_cache_[key]
-
-            to_unrank = random.randint(0, encoder.num_words_in_language(self.target_len_, self.target_len_))
-            ctxt = encoder.unrank(to_unrank)
+            key = (self.regex_, self.target_len_)
+            ctxt = marionette.covertext_pool.get_shared_pool(
+                ("tg.dummy",) + key,
+                functools.partial(make_dummy_covertext, *key)).get()
 
         else:
-            key = self.regex_ + str(self.min_len_)
-            (dfa, encoder) = fte_cache_[key]
-
-            ctxt = encoder.encode(to_embed)
+            ctxt = self.encoder_.encode(to_embed)
 
             if len(ctxt) != self.target_len_:
                 raise Exception("Could not find ctxt of len %d (%d)" % 
@@ -535,130 +521,170 @@ class AmazonMsgLensHandler(object):
         ctxt_len = len(ctxt)
 
         if ctxt_len >= self.min_len_:
-            key = self.regex_ + str(self.min_len_)
-            (dfa, encoder) = fte_cache_[key]
-            
             try:
-                retval = encoder.decode(ctxt)
+                retval = self.encoder_.decode(ctxt)
                 ptxt = retval[0]
             except Exception as e:
                 pass
 
         return ptxt
 
+
+def make_dummy_covertext(regex, target_len):
+    """Returns a random word of length target_len in regex's language."""
+    encoder = marionette.dfa_cache.get_ranker(regex, target_len)
+
+    to_unrank = random.randint(0, encoder.num_words_in_language(target_len, target_len))
+    return encoder.unrank(to_unrank)
+
 # formats
 
+# Handlers are built on first use of a grammar by get_conf(), or up front by
+# warm_up(), as some of them compile DFAs. grammars holds how to build them,
+# as (handler class, args) pairs; conf holds the grammars built so far.
+
+grammars = {}
 conf = {}
 
-conf["http_request_keep_alive"] = {
+grammars["http_request_keep_alive"] = {
     "grammar": "http_request_keep_alive",
     "handler_order": ["URL"],
-    "handlers": {"URL": RankerHandler("[a-zA-Z0-9\\?\\-\\.\\&]+", 2048), }
+    "handlers": {"URL": (RankerHandler, ("[a-zA-Z0-9\\?\\-\\.\\&]+", 2048)), }
 }
 
-conf["http_response_keep_alive"] = {
+grammars["http_response_keep_alive"] = {
     "grammar": "http_response_keep_alive",
     "handler_order": [  # "COOKIE",
         "HTTP-RESPONSE-BODY", "CONTENT-LENGTH"
     ],
     "handlers": {
-        "CONTENT-LENGTH": HttpContentLengthHandler(),
-        "COOKIE": RankerHandler("([a-zA-Z0-9]+=[a-zA-Z0-9]+;)+", 128),
-        "HTTP-RESPONSE-BODY": FteHandler(".+", 128),
+        "CONTENT-LENGTH": (HttpContentLengthHandler, ()),
+        "COOKIE": (RankerHandler, ("([a-zA-Z0-9]+=[a-zA-Z0-9]+;)+", 128)),
+        "HTTP-RESPONSE-BODY": (FteHandler, (".+", 128)),
     }
 }
 
-conf["http_request_close"] = {
+grammars["http_request_close"] = {
     "grammar": "http_request_close",
     "handler_order": ["URL"],
-    "handlers": {"URL": RankerHandler("[a-zA-Z0-9\\?\\-\\.\\&]+", 2048), }
+    "handlers": {"URL": (RankerHandler, ("[a-zA-Z0-9\\?\\-\\.\\&]+", 2048)), }
 }
 
-conf["http_response_close"] = {
+grammars["http_response_close"] = {
     "grammar": "http_response_close",
     "handler_order": [  # "COOKIE",
         "HTTP-RESPONSE-BODY", "CONTENT-LENGTH"
     ],
     "handlers": {
-        "CONTENT-LENGTH": HttpContentLengthHandler(),
-        "COOKIE": RankerHandler("([a-zA-Z0-9]+=[a-zA-Z0-9]+;)+", 128),
-        "HTTP-RESPONSE-BODY": FteHandler(".+", 128),
+        "CONTENT-LENGTH": (HttpContentLengthHandler, ()),
+        "COOKIE": (RankerHandler, ("([a-zA-Z0-9]+=[a-zA-Z0-9]+;)+", 128)),
+        "HTTP-RESPONSE-BODY": (FteHandler, (".+", 128)),
     }
 }
 
-conf["pop3_message_response"] = {
+grammars["pop3_message_response"] = {
     "grammar": "pop3_message_response",
     "handler_order": ["POP3-RESPONSE-BODY", "CONTENT-LENGTH"],
     "handlers": {
-        "CONTENT-LENGTH": Pop3ContentLengthHandler(),
-        "POP3-RESPONSE-BODY": RankerHandler("[a-zA-Z0-9]+", 2048),
+        "CONTENT-LENGTH": (Pop3ContentLengthHandler, ()),
+        "POP3-RESPONSE-BODY": (RankerHandler, ("[a-zA-Z0-9]+", 2048)),
     }
 }
 
-conf["pop3_password"] = {
+grammars["pop3_password"] = {
     "grammar": "pop3_password",
     "handler_order": ["PASSWORD"],
-    "handlers": {"PASSWORD": RankerHandler("[a-zA-Z0-9]+", 256), }
+    "handlers": {"PASSWORD": (RankerHandler, ("[a-zA-Z0-9]+", 256)), }
 }
 
-conf["http_request_keep_alive_with_msg_lens"] = {
+grammars["http_request_keep_alive_with_msg_lens"] = {
     "grammar": "http_request_keep_alive",
     "handler_order": ["URL"],
-    "handlers": {"URL": FteMsgLensHandler("[a-zA-Z0-9\\?\\-\\.\\&]+", 2048), }
+    "handlers": {"URL": (FteMsgLensHandler, ("[a-zA-Z0-9\\?\\-\\.\\&]+", 2048)), }
 }
 
-conf["http_response_keep_alive_with_msg_lens"] = {
+grammars["http_response_keep_alive_with_msg_lens"] = {
     "grammar": "http_response_keep_alive",
     "handler_order": ["HTTP-RESPONSE-BODY", "CONTENT-LENGTH"],
     "handlers": {
-        "CONTENT-LENGTH": HttpContentLengthHandler(),
-        "HTTP-RESPONSE-BODY": FteMsgLensHandler(".+", 2048),
+        "CONTENT-LENGTH": (HttpContentLengthHandler, ()),
+        "HTTP-RESPONSE-BODY": (FteMsgLensHandler, (".+", 2048)),
     }
 }
 
-conf["http_amazon_request"] = {
+grammars["http_amazon_request"] = {
     "grammar": "http_request_keep_alive",
     "handler_order": ["URL"],
-    "handlers": {"URL": RankerHandler("[a-zA-Z0-9\\?\\-\\.\\&]+", 2048), }
+    "handlers": {"URL": (RankerHandler, ("[a-zA-Z0-9\\?\\-\\.\\&]+", 2048)), }
 }
 
-conf["http_amazon_response"] = {
+grammars["http_amazon_response"] = {
     "grammar": "http_response_keep_alive",
     "handler_order": ["HTTP-RESPONSE-BODY", "CONTENT-LENGTH"],
     "handlers": {
-        "CONTENT-LENGTH": HttpContentLengthHandler(),
-        "HTTP-RESPONSE-BODY": AmazonMsgLensHandler(".+"),
+        "CONTENT-LENGTH": (HttpContentLengthHandler, ()),
+        "HTTP-RESPONSE-BODY": (AmazonMsgLensHandler, (".+",)),
     }
 }
 
-conf["ftp_entering_passive"] = {
+grammars["ftp_entering_passive"] = {
     "grammar": "ftp_entering_passive",
     "handler_order": ["FTP_PASV_PORT_X", "FTP_PASV_PORT_Y"],
     "handlers": {
-        "FTP_PASV_PORT_X": SetFTPPasvX(),
-        "FTP_PASV_PORT_Y": SetFTPPasvY(),
+        "FTP_PASV_PORT_X": (SetFTPPasvX, ()),
+        "FTP_PASV_PORT_Y": (SetFTPPasvY, ()),
     }
 }
 
-conf["dns_request"] = {
+grammars["dns_request"] = {
     "grammar": "dns_request",
     "handler_order": ["DNS_TRANSACTION_ID", "DNS_DOMAIN"],
     "handlers": {
-        "DNS_TRANSACTION_ID": SetDnsTransactionId(),
-        "DNS_DOMAIN": SetDnsDomain(),
+        "DNS_TRANSACTION_ID": (SetDnsTransactionId, ()),
+        "DNS_DOMAIN": (SetDnsDomain, ()),
         }
 }
 
-conf["dns_response"] = {
+grammars["dns_response"] = {
     "grammar": "dns_response",
     "handler_order": ["DNS_TRANSACTION_ID", "DNS_DOMAIN", "DNS_IP"],
     "handlers": {
-        "DNS_TRANSACTION_ID": SetDnsTransactionId(),
-        "DNS_DOMAIN": SetDnsDomain(),
-        "DNS_IP": SetDnsIp(),
+        "DNS_TRANSACTION_ID": (SetDnsTransactionId, ()),
+        "DNS_DOMAIN": (SetDnsDomain, ()),
+        "DNS_IP": (SetDnsIp, ()),
         }
 }
 
+def get_conf(grammar):
+    """Returns the handlers for grammar, building them on first use."""
+    retval = conf.get(grammar)
+    if retval is None:
+        spec = grammars[grammar]
+
+        # only handlers that are executed are built
+        handlers = {}
+        for handler_key in spec["handler_order"]:
+            (handler_class, args) = spec["handlers"][handler_key]
+            handlers[handler_key] = handler_class(*args)
+
+        retval = {
+            "grammar": spec["grammar"],
+            "handler_order": spec["handler_order"],
+            "handlers": handlers,
+        }
+        conf[grammar] = retval
+
+    return retval
+
+
+def warm_up(grammars_to_build):
+    """Builds the handlers for grammars_to_build ahead of their first use,
+    so that it doesn't stall a connection."""
+    if not templates:
+        load_templates()
+    for grammar in grammars_to_build:
+        get_conf(grammar)
+
 # grammars
 
 
@@ -681,60 +707,65 @@ def parser(grammar, msg):
 
 
 def generate_template(grammar):
+    if not templates:
+        load_templates()
     return random.choice(templates[grammar])
 
 #############
 
+# filled in on first use, as the request templates need marionette.conf
 templates = {}
 
-server_listen_ip = marionette.conf.get("server.server_ip")
-
-templates["http_request_keep_alive"] = [
-    "GET http://" +
-    server_listen_ip +
-    ":8080/%%URL%% HTTP/1.1\r\nUser-Agent: marionette 0.1\r\nConnection: keep-alive\r\n\r\n",
-]
-
-templates["http_request_close"] = [
-    "GET http://" +
-    server_listen_ip +
-    ":8080/%%URL%% HTTP/1.1\r\nUser-Agent: marionette 0.1\r\nConnection: close\r\n\r\n",
-]
-
-templates["http_response_keep_alive"] = [
-    "HTTP/1.1 200 OK\r\nContent-Length: %%CONTENT-LENGTH%%\r\nConnection: keep-alive\r\n\r\n%%HTTP-RESPONSE-BODY%%",
-    "HTTP/1.1 404 Not Found\r\nContent-Length: %%CONTENT-LENGTH%%\r\nConnection: keep-alive\r\n\r\n%%HTTP-RESPONSE-BODY%%",
-]
-
-templates["http_response_close"] = [
-    "HTTP/1.1 200 OK\r\nContent-Length: %%CONTENT-LENGTH%%\r\nConnection: close\r\n\r\n%%HTTP-RESPONSE-BODY%%",
-    "HTTP/1.1 404 Not Found\r\nContent-Length: %%CONTENT-LENGTH%%\r\nConnection: close\r\n\r\n%%HTTP-RESPONSE-BODY%%",
-]
-
-templates["pop3_message_response"] = [
-    "+OK %%CONTENT-LENGTH%% octets\nReturn-Path: sender@example.com\nReceived: from client.example.com ([192.0.2.1])\nFrom: sender@example.com\nSubject: Test message\nTo: recipient@example.com\n\n%%POP3-RESPONSE-BODY%%\n.\n",
-]
-
-templates["pop3_password"] = ["PASS %%PASSWORD%%\n", ]
-
-templates["http_request_keep_alive_with_msg_lens"] = templates[
-    "http_request_keep_alive"]
-templates["http_response_keep_alive_with_msg_lens"] = templates[
-    "http_response_keep_alive"]
-templates["http_amazon_request"] = templates["http_request_keep_alive"]
-templates["http_amazon_response"] = templates["http_response_keep_alive"]
-
-templates["ftp_entering_passive"] = [
-    "227 Entering Passive Mode (127,0,0,1,%%FTP_PASV_PORT_X%%,%%FTP_PASV_PORT_Y%%).\n",
-]
-
-templates["dns_request"] = [
-    "%%DNS_TRANSACTION_ID%%\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00%%DNS_DOMAIN%%\x00\x00\x01\x00\x01",
-]
-
-templates["dns_response"] = [
-   "%%DNS_TRANSACTION_ID%%\x81\x80\x00\x01\x00\x01\x00\x00\x00\x00%%DNS_DOMAIN%%\x00\x01\x00\x01\xc0\x0c\x00\x01\x00\x01\x00\x00\x00\x02\x00\x04%%DNS_IP%%",
-]
+
+def load_templates():
+    server_listen_ip = marionette.conf.get("server.server_ip")
+
+    templates["http_request_keep_alive"] = [
+        "GET http://" +
+        server_listen_ip +
+        ":8080/%%URL%% HTTP/1.1\r\nUser-Agent: marionette 0.1\r\nConnection: keep-alive\r\n\r\n",
+    ]
+
+    templates["http_request_close"] = [
+        "GET http://" +
+        server_listen_ip +
+        ":8080/%%URL%% HTTP/1.1\r\nUser-Agent: marionette 0.1\r\nConnection: close\r\n\r\n",
+    ]
+
+    templates["http_response_keep_alive"] = [
+        "HTTP/1.1 200 OK\r\nContent-Length: %%CONTENT-LENGTH%%\r\nConnection: keep-alive\r\n\r\n%%HTTP-RESPONSE-BODY%%",
+        "HTTP/1.1 404 Not Found\r\nContent-Length: %%CONTENT-LENGTH%%\r\nConnection: keep-alive\r\n\r\n%%HTTP-RESPONSE-BODY%%",
+    ]
+
+    templates["http_response_close"] = [
+        "HTTP/1.1 200 OK\r\nContent-Length: %%CONTENT-LENGTH%%\r\nConnection: close\r\n\r\n%%HTTP-RESPONSE-BODY%%",
+        "HTTP/1.1 404 Not Found\r\nContent-Length: %%CONTENT-LENGTH%%\r\nConnection: close\r\n\r\n%%HTTP-RESPONSE-BODY%%",
+    ]
+
+    templates["pop3_message_response"] = [
+        "+OK %%CONTENT-LENGTH%% octets\nReturn-Path: sender@example.com\nReceived: from client.example.com ([192.0.2.1])\nFrom: sender@example.com\nSubject: Test message\nTo: recipient@example.com\n\n%%POP3-RESPONSE-BODY%%\n.\n",
+    ]
+
+    templates["pop3_password"] = ["PASS %%PASSWORD%%\n", ]
+
+    templates["http_request_keep_alive_with_msg_lens"] = templates[
+        "http_request_keep_alive"]
+    templates["http_response_keep_alive_with_msg_lens"] = templates[
+        "http_response_keep_alive"]
+    templates["http_amazon_request"] = templates["http_request_keep_alive"]
+    templates["http_amazon_response"] = templates["http_response_keep_alive"]
+
+    templates["ftp_entering_passive"] = [
+        "227 Entering Passive Mode (127,0,0,1,%%FTP_PASV_PORT_X%%,%%FTP_PASV_PORT_Y%%).\n",
+    ]
+
+    templates["dns_request"] = [
+        "%%DNS_TRANSACTION_ID%%\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00%%DNS_DOMAIN%%\x00\x00\x01\x00\x01",
+    ]
+
+    templates["dns_response"] = [
+        "%%DNS_TRANSACTION_ID%%\x81\x80\x00\x01\x00\x01\x00\x00\x00\x00%%DNS_DOMAIN%%\x00\x01\x00\x01\xc0\x0c\x00\x01\x00\x01\x00\x00\x00\x02\x00\x04%%DNS_IP%%",
+    ]
 
 def get_http_header(header_name, msg):
     retval = None
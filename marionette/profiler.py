@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Capacity and overhead profiles of formats.
+
+    python -m marionette.profiler [--format NAME ...] [--json OUTPUT]
+
+A format's model is a Markov chain over its states. Restarting the model
+each time it reaches dead, as the client does, makes the chain run
+forever, and its stationary distribution says how often each transition
+is taken per step. Weighting what each transition's actions send by that
+gives the expected traffic of the format, per step and, dividing by how
+often dead is reached, per connection.
+
+What an fte or tg send carries is measured rather than guessed: every
+distinct send action in the format is run once into a sink, with data
+queued, so that message sizes come from the handlers' own capacity() and
+the time taken is the real cost of making the covertext. fte messages are
+measured at their nominal size; with more data queued they grow, carrying
+more payload per byte of overhead.
+
+We report, per connection:
+
+- payload bytes, each way
+- goodput ratio: payload bytes per covertext byte on the wire
+- round trips: one to connect, plus half for each blocking message
+- CPU time per payload byte spent making covertexts
+- time spent in model.sleep
+
+Connections made by model.spawn count towards the spawning format. Formats
+whose model never reaches dead have no per-connection numbers, but their
+ratios are still given.
+"""
+
+import sys
+import json
+import time
+import argparse
+
+sys.path.append('.')
+
+import marionette.benchmark
+import marionette.conf
+import marionette.dsl
+import marionette.multiplexer
+import marionette.plugins._model
+import marionette.record_layer
+
+RESULTS_VERSION = 1
+
+MAX_ITERATIONS = 100000
+TOLERANCE = 1e-12
+
+# runs of each send action we time, after a first one that warms up
+# encoders and caches
+MEASURE_REPEAT = 5
+# queued for tg sends, more than any grammar takes in one message
+TG_QUEUED_BYTES = 2 ** 20
+
+# what we set the variables channel.bind would set to, for tg handlers
+# that put port numbers in covertexts
+BOUND_PORT = 49152
+
+# totals kept per step and per connection
+KEYS = ['payload_up', 'payload_down', 'covertext_up', 'covertext_down',
+        'messages', 'blocking_messages', 'cpu', 'sleep', 'connections']
+
+
+def load_client(format_name, format_version=None):
+    mar_path = marionette.dsl.find_mar_files(
+        'client', format_name, format_version)[-1]
+    return marionette.dsl.load('client', format_name, mar_path)
+
+
+def get_transition_probabilities(executable):
+    """Returns {src: {dst: probability}} as PAState.transition picks them,
+    with dead leading back to start."""
+    retval = {}
+    for (name, state) in executable.states_.items():
+        if len(state.transitions_) == 1:
+            probabilities = {list(state.transitions_.keys())[0]: 1.0}
+        else:
+            probabilities = dict(
+                (dst, transition[1])
+                for (dst, transition) in state.transitions_.items()
+                if transition[1] > 0)
+            total = sum(probabilities.values())
+            for dst in probabilities:
+                probabilities[dst] /= total
+        retval[name] = probabilities
+
+    if 'dead' in retval:
+        retval['dead'] = {'start': 1.0}
+    for name in retval:
+        if not retval[name]:
+            # nowhere to go; the model is stuck here
+            retval[name] = {name: 1.0}
+    return retval
+
+
+def get_stationary_distribution(probabilities, initial_state='start'):
+    """Returns {state: probability} for the chain probabilities, as returned
+    by get_transition_probabilities, started at initial_state.
+
+    This is found by power iteration on the lazy chain (P + I) / 2, which
+    has the same stationary distribution but converges on periodic chains
+    too. States the chain can't reach from initial_state get none."""
+    distribution = dict((state, 0.0) for state in probabilities)
+    distribution[initial_state] = 1.0
+
+    for i in range(MAX_ITERATIONS):
+        next_distribution = dict((state, p / 2)
+                                 for (state, p) in distribution.items())
+        for (src, p) in distribution.items():
+            if p == 0:
+                continue
+            for (dst, q) in probabilities[src].items():
+                next_distribution[dst] += p * q / 2
+
+        delta = sum(abs(next_distribution[state] - distribution[state])
+                    for state in distribution)
+        distribution = next_distribution
+        if delta < TOLERANCE:
+            break
+
+    return distribution
+
+
+def measure_send(action, repeat=MEASURE_REPEAT, local=None):
+    """Runs the fte or tg send action into a sink and returns the payload
+    bytes it carried, the covertext bytes it wrote and the seconds it took,
+    averaged over repeat runs. local holds model variables to set first."""
+    if action.get_module() == 'fte':
+        from marionette.plugins import _fte as plugin
+    else:
+        from marionette.plugins import _tg as plugin
+    send = getattr(plugin, action.get_method())
+
+    marionette_state = marionette.benchmark.new_marionette_state()
+    marionette_state.set_local("party", action.get_party())
+    for (key, value) in (local or {}).items():
+        marionette_state.set_local(key, value)
+    channel = marionette.benchmark.new_channel()
+
+    payload = 0
+    covertext = 0
+    elapsed = 0.0
+    for i in range(repeat + 1):
+        multiplexer = marionette.multiplexer.BufferOutgoing()
+        marionette_state.set_global("multiplexer_outgoing", multiplexer)
+        multiplexer.push(1, b'x' * get_queued_bytes(
+            marionette_state, action))
+        queued = multiplexer.total_bytes_queued_
+
+        t0 = time.perf_counter()
+        send(channel, marionette_state, action.get_args())
+        t1 = time.perf_counter()
+
+        if i > 0:
+            payload += queued - multiplexer.total_bytes_queued_
+            covertext += len(channel.protocol_.transport.last_write_)
+            elapsed += t1 - t0
+
+    return (payload / repeat, covertext / repeat, elapsed / repeat)
+
+
+def get_queued_bytes(marionette_state, action):
+    if action.get_module() == 'fte':
+        # exactly a nominal message's worth
+        from marionette.plugins import _fte
+        (regex, msg_len) = (action.get_args()[0], int(action.get_args()[1]))
+        return (_fte.get_min_cell_len(marionette_state, regex, msg_len) -
+                marionette.record_layer.PAYLOAD_HEADER_SIZE_IN_BITS) // 8
+    return TG_QUEUED_BYTES
+
+
+def get_bound_variables(executable):
+    """Returns {name: BOUND_PORT} for the variables set by channel.bind in
+    the executable's format."""
+    return dict((action.get_args()[0], BOUND_PORT)
+                for action in executable.actions_
+                if action.get_module() == 'channel' and
+                action.get_method() == 'bind')
+
+
+def get_sleep_mean(action):
+    return marionette.plugins._model.get_sleep_sampler(
+        action.get_args()[0]).get_mean()
+
+
+class Profiler(object):
+    """Profiles formats, reusing the measurements of send actions and the
+    profiles of spawned formats between them."""
+
+    def __init__(self, repeat=MEASURE_REPEAT):
+        self.repeat_ = repeat
+        self.sends_ = {}
+        self.profiles_ = {}
+        self.profiling_ = set()
+
+    def profile(self, format_name, format_version=None):
+        """Returns the profile of format_name; see the module docstring."""
+        key = (format_name, format_version)
+        if key in self.profiles_:
+            return self.profiles_[key]
+        if key in self.profiling_:
+            raise ValueError("%s spawns itself" % format_name)
+
+        self.profiling_.add(key)
+        try:
+            retval = self.do_profile(format_name, format_version)
+        finally:
+            self.profiling_.discard(key)
+        self.profiles_[key] = retval
+        return retval
+
+    def do_profile(self, format_name, format_version):
+        executable = load_client(format_name, format_version)
+        probabilities = get_transition_probabilities(executable)
+        stationary = get_stationary_distribution(probabilities)
+
+        step = dict((key, 0.0) for key in KEYS)
+        for (src, p) in stationary.items():
+            if p == 0:
+                continue
+            for (dst, q) in probabilities[src].items():
+                if src == 'dead':
+                    step['connections'] += p * q
+                    continue
+                action_name = executable.states_[src].transitions_[dst][0]
+                totals = self.get_transition_totals(executable, action_name,
+                                                    format_version)
+                for key in KEYS:
+                    step[key] += p * q * totals[key]
+
+        per_connection = None
+        if stationary.get('dead'):
+            per_connection = dict(
+                (key, step[key] / stationary['dead']) for key in KEYS)
+
+        return make_profile(format_name, stationary, step, per_connection)
+
+    def get_transition_totals(self, executable, action_name,
+                              format_version):
+        """Returns what one pass through the transition with the action
+        block action_name sends and costs, in terms of KEYS."""
+        retval = dict((key, 0.0) for key in KEYS)
+        if action_name is None:
+            return retval
+
+        # both parties' sleeps run at the same time
+        sleeps = {'client': 0.0, 'server': 0.0}
+
+        for action in executable.actions_:
+            if action.get_name() != action_name:
+                continue
+            module = action.get_module()
+            method = action.get_method()
+
+            if module in ['fte', 'tg'] and method.startswith('send'):
+                (payload, covertext, elapsed) = self.measure(
+                    action, get_bound_variables(executable))
+                direction = 'up' if action.get_party() == 'client' \
+                    else 'down'
+                retval['payload_' + direction] += payload
+                retval['covertext_' + direction] += covertext
+                retval['messages'] += 1
+                if method == 'send':
+                    retval['blocking_messages'] += 1
+                retval['cpu'] += elapsed
+            elif module == 'io' and method == 'puts':
+                direction = 'up' if action.get_party() == 'client' \
+                    else 'down'
+                retval['covertext_' + direction] += len(action.get_args()[0])
+                retval['messages'] += 1
+                retval['blocking_messages'] += 1
+            elif module == 'model' and method == 'sleep':
+                sleeps[action.get_party()] += get_sleep_mean(action)
+            elif module == 'model' and method == 'spawn' and \
+                    action.get_party() == 'client':
+                spawned = self.profile(action.get_args()[0], format_version)
+                if spawned['per_connection'] is None:
+                    raise ValueError("spawned format %s never finishes" %
+                                     action.get_args()[0])
+                for key in KEYS:
+                    retval[key] += int(action.get_args()[1]) * \
+                        spawned['per_connection'][key]
+
+        retval['sleep'] += max(sleeps.values())
+        return retval
+
+    def measure(self, action, local):
+        key = (action.get_module(), action.get_method(), action.get_party(),
+               tuple(action.get_args()))
+        if key not in self.sends_:
+            self.sends_[key] = measure_send(action, self.repeat_, local)
+        return self.sends_[key]
+
+
+def make_profile(format_name, stationary, step, per_connection):
+    payload = step['payload_up'] + step['payload_down']
+    covertext = step['covertext_up'] + step['covertext_down']
+
+    retval = {
+        'format': format_name,
+        'stationary': stationary,
+        'step': step,
+        'per_connection': per_connection,
+        'goodput_ratio': payload / covertext if covertext else None,
+        'cpu_per_byte': step['cpu'] / payload if payload else None,
+        'bytes_per_connection': None,
+        'round_trips': None,
+        'sleep': None,
+    }
+    if per_connection is not None:
+        retval['bytes_per_connection'] = per_connection['payload_up'] + \
+            per_connection['payload_down']
+        retval['round_trips'] = per_connection['connections'] + \
+            per_connection['blocking_messages'] / 2
+        retval['sleep'] = per_connection['sleep']
+    return retval
+
+
+def profile(format_name, format_version=None):
+    """Returns the profile of format_name; see the module docstring."""
+    return Profiler().profile(format_name, format_version)
+
+
+def format_profile(profile):
+    def value(fmt, x, scale=1):
+        return fmt % (x * scale) if x is not None else '-'
+
+    per_connection = profile['per_connection'] or {}
+    return "%-32s %10s %10s %8s %8s %12s %8s" % (
+        profile['format'],
+        value("%.0f", per_connection.get('payload_up')),
+        value("%.0f", per_connection.get('payload_down')),
+        value("%.3f", profile['goodput_ratio']),
+        value("%.1f", profile['round_trips']),
+        value("%.2f", profile['cpu_per_byte'], 1e9),
+        value("%.3f", profile['sleep']))
+
+
+HEADER = "%-32s %10s %10s %8s %8s %12s %8s" % (
+    'format', 'up B/conn', 'down B/conn', 'goodput', 'RTTs',
+    'cpu ns/B', 'sleep s')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Expected capacity and overhead of formats.')
+    parser.add_argument('--format', '-f', dest='formats', action='append',
+        help='format to profile, may be repeated (default: all formats)')
+    parser.add_argument('--format-version', dest='format_version',
+        help='format version (default: the latest with the format)')
+    parser.add_argument('--repeat', '-r', dest='repeat', type=int,
+        default=MEASURE_REPEAT,
+        help='timed runs of each send action (default %d)' % MEASURE_REPEAT)
+    parser.add_argument('--json', '-o', dest='json',
+        help='save the profiles to this file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # time the plugins themselves, not the round trip to a pool
+    marionette.conf.set("fte.workers", 0)
+
+    format_names = args.formats or marionette.benchmark.get_format_names()
+    profiler = Profiler(args.repeat)
+
+    retval = 0
+    profiles = []
+    print(HEADER)
+    for format_name in format_names:
+        try:
+            result = profiler.profile(format_name, args.format_version)
+        except Exception as e:
+            print("%-32s error: %s" % (format_name, e))
+            retval = 1
+            continue
+        profiles.append(result)
+        print(format_profile(result))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'version': RESULTS_VERSION, 'profiles': profiles}, f,
+                      indent=2, sort_keys=True)
+
+    return retval
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import struct
 import binascii
 from functools import total_ordering
 
@@ -15,42 +16,83 @@ NEGOTIATE = 0x3
 @total_ordering
 class Cell(object):
 
+    __slots__ = ('cell_type_', 'payload_', 'sequence_id_', 'cell_length_',
+                 'stream_id_', 'model_uuid_', 'model_instance_id_')
+
     def __init__(self, model_uuid, model_instance_id, stream_id, seq_id,
                  length=0, cell_type=NORMAL):
         assert stream_id is not None
 
         self.cell_type_ = cell_type
-        self.payload_ = ''
-        self.payload_length_ = 0
-        self.sequence_id_ = seq_id
+        self.payload_ = b''
+        self.sequence_id_ = int(seq_id)
         self.cell_length_ = length
-        self.stream_id_ = stream_id
+        self.stream_id_ = int(stream_id)
         self.model_uuid_ = model_uuid
         self.model_instance_id_ = model_instance_id
 
+    @classmethod
+    def from_many(cls, model_uuid, model_instance_id, stream_id, seq_id,
+                  payloads, length=0, cell_type=NORMAL):
+        """Build one cell per entry in ``payloads`` for a single stream,
+        numbered with consecutive sequence IDs starting at ``seq_id``.
+        """
+        assert stream_id is not None
+
+        stream_id = int(stream_id)
+        seq_id = int(seq_id)
+
+        retval = []
+        for payload in payloads:
+            cell_obj = cls.__new__(cls)
+            cell_obj.cell_type_ = cell_type
+            cell_obj.sequence_id_ = seq_id
+            cell_obj.cell_length_ = length
+            cell_obj.stream_id_ = stream_id
+            cell_obj.model_uuid_ = model_uuid
+            cell_obj.model_instance_id_ = model_instance_id
+            cell_obj.set_payload(payload)
+            retval.append(cell_obj)
+            seq_id += 1
+
+        return retval
+
     def __lt__(self, other):
-        return self.get_seq_id() < other.get_seq_id()
+        return self.sequence_id_ < other.sequence_id_
 
     def __eq__(self, other):
-        retval = (
-            self.get_payload() == other.get_payload()) and (
-            self.get_stream_id() == other.get_stream_id()) and (
-            self.get_model_uuid() == other.get_model_uuid()) and (
-                self.get_model_instance_id() == other.get_model_instance_id()) and (
-                    self.get_seq_id() == other.get_seq_id())
-        return retval
+        return (self.sequence_id_ == other.sequence_id_ and
+                self.stream_id_ == other.stream_id_ and
+                self.model_uuid_ == other.model_uuid_ and
+                self.model_instance_id_ == other.model_instance_id_ and
+                self.payload_ == other.payload_)
 
     def get_cell_type(self):
         return self.cell_type_
 
     def get_payload(self):
-        return str(self.payload_)
+        return self.payload_
 
     def set_payload(self, payload):
+        # Payloads are kept as bytes, or as a memoryview over immutable
+        # bytes to avoid a copy; latin-1 strs are accepted for
+        # compatibility and map byte values 0-255 one-to-one.
+        if isinstance(payload, str):
+            payload = payload.encode('latin-1')
+        elif not isinstance(payload, (bytes, memoryview)):
+            payload = bytes(payload)
         self.payload_ = payload
 
     def get_stream_id(self):
-        return int(self.stream_id_)
+        return self.stream_id_
+
+    def get_length(self):
+        """Returns the length in bits this cell is padded to when
+        serialized."""
+        return self.cell_length_
+
+    def set_length(self, length):
+        self.cell_length_ = length
 
     def get_model_uuid(self):
         return self.model_uuid_
@@ -58,8 +100,12 @@ class Cell(object):
     def get_model_instance_id(self):
         return self.model_instance_id_
 
+    def set_model(self, model_uuid, model_instance_id):
+        self.model_uuid_ = model_uuid
+        self.model_instance_id_ = model_instance_id
+
     def get_seq_id(self):
-        return int(self.sequence_id_)
+        return self.sequence_id_
 
     def is_valid(self):
         retval = True
@@ -68,6 +114,9 @@ class Cell(object):
     def to_string(self):
         return serialize(self, self.cell_length_)
 
+    def to_bytes(self):
+        return serialize_to_bytes(self, self.cell_length_)
+
 
 class EndOfStreamException(Exception):
 
@@ -124,58 +173,58 @@ def bytes_to_long(bytestring):
 #   padding (variable)
 
 
-def serialize(cell_obj, pad_to=0):
-    retval = ''
+# precompiled, big-endian header layout; see the table above
+CELL_HEADER = struct.Struct('!IIIIIIB')
+assert CELL_HEADER.size == PAYLOAD_HEADER_SIZE_IN_BYTES
+CELL_LENGTHS = struct.Struct('!II')
 
-    stream_id = cell_obj.get_stream_id()
-    model_uuid = cell_obj.get_model_uuid()
-    model_instance_id = cell_obj.get_model_instance_id()
-    seq_id = cell_obj.get_seq_id()
+
+def serialize_to_bytes(cell_obj, pad_to=0):
     payload = cell_obj.get_payload()
-    padding = '\x00' * (
-        (pad_to // 8) - len(payload) - PAYLOAD_HEADER_SIZE_IN_BYTES)
-    cell_type = cell_obj.get_cell_type()
-
-    bytes_cell_len = pad_to_bytes(4, long_to_bytes(
-        PAYLOAD_HEADER_SIZE_IN_BYTES + len(payload) + len(padding)))
-    bytes_payload_len = pad_to_bytes(4, long_to_bytes(len(payload)))
-    bytes_model_uuid = pad_to_bytes(4, long_to_bytes(model_uuid))
-    bytes_model_instance_id = pad_to_bytes(4, long_to_bytes(model_instance_id))
-    bytes_stream_id = pad_to_bytes(4, long_to_bytes(stream_id))
-    bytes_seq_id = pad_to_bytes(4, long_to_bytes(seq_id))
-    bytes_cell_type = pad_to_bytes(1, long_to_bytes(cell_type))
-
-    retval += bytes_cell_len
-    retval += bytes_payload_len
-    retval += bytes_model_uuid
-    retval += bytes_model_instance_id
-    retval += bytes_stream_id
-    retval += bytes_seq_id
-    retval += bytes_cell_type
-    retval += payload
-    retval += padding
-
-    assert (PAYLOAD_HEADER_SIZE_IN_BYTES + len(payload) + len(padding)
-            ) == len(retval)
+    payload_len = len(payload)
+    cell_len = max(pad_to // 8, PAYLOAD_HEADER_SIZE_IN_BYTES + payload_len)
 
-    return retval
+    retval = bytearray(cell_len)
+    CELL_HEADER.pack_into(retval, 0,
+                          cell_len,
+                          payload_len,
+                          cell_obj.get_model_uuid(),
+                          cell_obj.get_model_instance_id(),
+                          cell_obj.get_stream_id(),
+                          cell_obj.get_seq_id(),
+                          cell_obj.get_cell_type())
+    retval[PAYLOAD_HEADER_SIZE_IN_BYTES:
+           PAYLOAD_HEADER_SIZE_IN_BYTES + payload_len] = payload
 
+    return bytes(retval)
 
-def unserialize(cell_str):
 
-    cell_len = bytes_to_long(cell_str[:4])
-    payload_len = bytes_to_long(cell_str[4:8])
-    model_uuid = bytes_to_long(cell_str[8:12])
-    model_instance_id = bytes_to_long(cell_str[12:16])
-    stream_id = bytes_to_long(cell_str[16:20])
-    seq_id = bytes_to_long(cell_str[20:24])
-    cell_type = bytes_to_long(cell_str[24:25])
+def serialize(cell_obj, pad_to=0):
+    return serialize_to_bytes(cell_obj, pad_to).decode('latin-1')
+
+
+def unserialize_from(buf, offset=0):
+    """Decode the cell starting at ``offset`` in ``buf``.
+
+    ``buf`` may be any object supporting the buffer protocol. Returns a
+    tuple ``(cell, consumed)``, or ``(None, 0)`` if ``buf`` doesn't yet
+    hold the complete cell. The payload is copied out exactly once, so the
+    caller is free to reuse or compact ``buf`` afterwards.
+    """
+    if len(buf) - offset < PAYLOAD_HEADER_SIZE_IN_BYTES:
+        return (None, 0)
+
+    (cell_len, payload_len, model_uuid, model_instance_id,
+     stream_id, seq_id, cell_type) = CELL_HEADER.unpack_from(buf, offset)
 
-    if cell_len != len(cell_str):
+    if cell_len < PAYLOAD_HEADER_SIZE_IN_BYTES + payload_len:
         raise UnserializeException()
+    if len(buf) - offset < cell_len:
+        return (None, 0)
 
-    payload = cell_str[PAYLOAD_HEADER_SIZE_IN_BYTES:
-                       PAYLOAD_HEADER_SIZE_IN_BYTES + payload_len]
+    payload_start = offset + PAYLOAD_HEADER_SIZE_IN_BYTES
+    with memoryview(buf) as view:
+        payload = bytes(view[payload_start:payload_start + payload_len])
 
     retval = Cell(
         model_uuid,
@@ -184,7 +233,35 @@ def unserialize(cell_str):
         seq_id,
         payload_len,
         cell_type)
-    retval.set_payload(payload)
+    retval.payload_ = payload
+
+    return (retval, cell_len)
+
+
+def count_cells(buf):
+    """Returns the number of complete cells in buf and the payload bytes
+    they hold, reading only their headers."""
+    num_cells = 0
+    payload_bytes = 0
+    offset = 0
+    while len(buf) - offset >= PAYLOAD_HEADER_SIZE_IN_BYTES:
+        (cell_len, payload_len) = CELL_LENGTHS.unpack_from(buf, offset)
+        if cell_len < PAYLOAD_HEADER_SIZE_IN_BYTES or \
+                len(buf) - offset < cell_len:
+            break
+        num_cells += 1
+        payload_bytes += payload_len
+        offset += cell_len
+    return (num_cells, payload_bytes)
+
+
+def unserialize(cell_str):
+    if isinstance(cell_str, str):
+        cell_str = cell_str.encode('latin-1')
+
+    (retval, cell_len) = unserialize_from(cell_str)
+    if retval is None or cell_len != len(cell_str):
+        raise UnserializeException()
 
     return retval
 
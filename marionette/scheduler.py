@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Stream schedulers for marionette.multiplexer.BufferOutgoing.
+
+A scheduler tracks the set of active streams (streams with queued data or a
+pending end-of-stream cell) and decides which of them the next cell is cut
+from. The contract with BufferOutgoing is:
+
+* add(stream_id) when a stream becomes active; repeated calls are no-ops.
+* next() returns the stream to serve, or None if there is none. It may
+  move on to a new round (DRR tops up deficits), but until the stream is
+  charged or removed, calling it again returns the same stream.
+* peek() returns the stream next() will return, without changing what
+  any later call returns. Use it to ask which stream is up, and next()
+  only to serve it.
+* After serving a stream, exactly one of charge(stream_id, nbytes) (the
+  stream is still active) or remove(stream_id) (it isn't) is called.
+
+All schedulers select in O(1) (amortized for DRR), and add, remove and
+charge streams in O(1). DRR's peek() works out the next round without
+starting it, which takes a scan up to the first stream with a positive
+deficit, and of every stream if none has one. Round robin queues are
+OrderedDicts rather than deques, so that a stream can be taken out of the
+middle without a scan.
+"""
+
+import random
+import collections
+
+
+class RandomScheduler(object):
+    """Picks a uniformly random active stream."""
+
+    def __init__(self):
+        self.streams_ = []
+        self.index_ = {}
+        # drawn by peek() or next(), and kept until it's served
+        self.next_ = None
+
+    def __len__(self):
+        return len(self.streams_)
+
+    def add(self, stream_id):
+        if stream_id not in self.index_:
+            self.index_[stream_id] = len(self.streams_)
+            self.streams_.append(stream_id)
+
+    def remove(self, stream_id):
+        i = self.index_.pop(stream_id, None)
+        if i is None:
+            return
+        if self.next_ == stream_id:
+            self.next_ = None
+        last = self.streams_.pop()
+        if last != stream_id:
+            self.streams_[i] = last
+            self.index_[last] = i
+
+    def peek(self):
+        if self.next_ is None and self.streams_:
+            self.next_ = self.streams_[random.randrange(len(self.streams_))]
+        return self.next_
+
+    def next(self):
+        return self.peek()
+
+    def charge(self, stream_id, nbytes):
+        if self.next_ == stream_id:
+            self.next_ = None
+
+
+class DeficitRoundRobinScheduler(object):
+    """Deficit round robin over active streams.
+
+    Each round a stream may send about quantum * weight bytes, so streams
+    share bandwidth in proportion to their weights regardless of how big
+    their cells are.
+    """
+
+    DEFAULT_QUANTUM = 2 ** 14
+
+    def __init__(self, quantum=DEFAULT_QUANTUM):
+        self.quantum_ = quantum
+        # {stream_id: deficit}, in round robin order
+        self.active_ = collections.OrderedDict()
+        self.weights_ = {}
+
+    def __len__(self):
+        return len(self.active_)
+
+    def set_weight(self, stream_id, weight):
+        if weight <= 0:
+            raise ValueError("stream weight must be positive, got %r" %
+                             weight)
+        # weights outlive idle periods; set weight 1 to forget a stream
+        if weight == 1:
+            self.weights_.pop(stream_id, None)
+        else:
+            self.weights_[stream_id] = weight
+
+    def add(self, stream_id):
+        if stream_id not in self.active_:
+            self.active_[stream_id] = self._quantum(stream_id)
+
+    def remove(self, stream_id):
+        self.active_.pop(stream_id, None)
+
+    def next(self):
+        if not self.active_:
+            return None
+        stream_id = next(iter(self.active_))
+        while self.active_[stream_id] <= 0:
+            self.active_[stream_id] += self._quantum(stream_id)
+            self.active_.move_to_end(stream_id)
+            stream_id = next(iter(self.active_))
+        return stream_id
+
+    def peek(self):
+        # the first stream with a positive deficit, or else the one that
+        # gets there in the fewest top-ups, first in order on a tie
+        retval = None
+        min_rounds = None
+        for (stream_id, deficit) in self.active_.items():
+            if deficit > 0:
+                return stream_id
+            rounds = -deficit // self._quantum(stream_id) + 1
+            if min_rounds is None or rounds < min_rounds:
+                retval = stream_id
+                min_rounds = rounds
+        return retval
+
+    def charge(self, stream_id, nbytes):
+        if stream_id in self.active_:
+            self.active_[stream_id] -= max(nbytes, 1)
+
+    def _quantum(self, stream_id):
+        # at least a byte, so that next() always gets somewhere
+        return max(1, int(self.quantum_ * self.weights_.get(stream_id, 1)))
+
+
+class PriorityScheduler(object):
+    """Strict priority for interactive streams.
+
+    A stream that becomes active is treated as interactive until it has sent
+    more than interactive_bytes; after that it is demoted to the bulk class
+    until it goes idle again. Interactive streams are always served before
+    bulk ones, and each class is served round robin.
+    """
+
+    DEFAULT_INTERACTIVE_BYTES = 2 ** 14
+
+    def __init__(self, interactive_bytes=DEFAULT_INTERACTIVE_BYTES):
+        self.interactive_bytes_ = interactive_bytes
+        # ordered sets of stream IDs, in round robin order
+        self.interactive_ = collections.OrderedDict()
+        self.bulk_ = collections.OrderedDict()
+        self.sent_ = {}
+
+    def __len__(self):
+        return len(self.sent_)
+
+    def add(self, stream_id):
+        if stream_id not in self.sent_:
+            self.sent_[stream_id] = 0
+            self.interactive_[stream_id] = None
+
+    def remove(self, stream_id):
+        if self.sent_.pop(stream_id, None) is None:
+            return
+        self.interactive_.pop(stream_id, None)
+        self.bulk_.pop(stream_id, None)
+
+    def peek(self):
+        if self.interactive_:
+            return next(iter(self.interactive_))
+        if self.bulk_:
+            return next(iter(self.bulk_))
+        return None
+
+    def next(self):
+        return self.peek()
+
+    def charge(self, stream_id, nbytes):
+        sent = self.sent_.get(stream_id)
+        if sent is None:
+            return
+
+        queue = self.interactive_ if sent <= self.interactive_bytes_ \
+            else self.bulk_
+        del queue[stream_id]
+
+        sent += nbytes
+        self.sent_[stream_id] = sent
+        if sent <= self.interactive_bytes_:
+            self.interactive_[stream_id] = None
+        else:
+            self.bulk_[stream_id] = None
+
+
+SCHEDULERS = {
+    'random': RandomScheduler,
+    'drr': DeficitRoundRobinScheduler,
+    'priority': PriorityScheduler,
+}
+
+
+def new_scheduler(name):
+    if name not in SCHEDULERS:
+        raise ValueError("unknown stream scheduler: %s" % name)
+    return SCHEDULERS[name]()
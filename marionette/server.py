@@ -13,11 +13,17 @@ from . import multiplexer
 from . import record_layer
 from . import updater
 from . import conf
+from . import wakeup
+from . import logger
 
-EVENT_LOOP_FREQUENCY_S = 0.01
+# the driver wakes us up when a model finishes or a channel arrives; this
+# is only a fallback for anything that slips through
+HOUSEKEEPING_INTERVAL_S = 1.0
 AUTOUPDATE_DELAY = 5
 CLEANUP_INTERVAL_S = 60  # Run cleanup every 60 seconds
 
+LOG = logger.get_logger('server')
+
 
 class Server(object):
     factory = None
@@ -29,31 +35,52 @@ class Server(object):
 
         self.factory_instances = {}
         self.factory_last_activity = {}  # Track last activity time for each factory
+        self.reactor_ = None
+        self.wakeup_ = wakeup.Wakeup(self.execute)
 
         if self.check_for_update():
             self.do_update()
 
         self.set_driver(format_name)
         self.reload_ = False
+        self.stopped_ = False
         
         # Schedule periodic cleanup
-        reactor.callLater(CLEANUP_INTERVAL_S, self._periodic_cleanup, reactor)
+        self.cleanup_call_ = reactor.callLater(CLEANUP_INTERVAL_S,
+                                               self._periodic_cleanup, reactor)
 
     def set_driver(self, format_name):
         self.format_name_ = format_name
         self.driver_ = driver.ServerDriver("server")
         self.driver_.set_multiplexer_incoming(self.multiplexer_incoming_)
         self.driver_.set_multiplexer_outgoing(self.multiplexer_outgoing_)
+        self.driver_.set_wakeup_callback(self.wakeup)
         self.driver_.setFormat(self.format_name_)
 
     def execute(self, reactor):
+        if self.stopped_:
+            return
+        self.reactor_ = reactor
+
         if not self.driver_.isRunning():
             if self.reload_:
                 self.set_driver(self.format_name_)
                 self.reload_ = False
 
         self.driver_.execute(reactor)
-        reactor.callLater(EVENT_LOOP_FREQUENCY_S, self.execute, reactor)
+        self.wakeup_.schedule(reactor, HOUSEKEEPING_INTERVAL_S)
+
+    def wakeup(self):
+        if self.reactor_ and not self.stopped_:
+            self.wakeup_.schedule(self.reactor_)
+
+    def stop(self):
+        """Stops our models and stops accepting connections."""
+        self.stopped_ = True
+        self.wakeup_.cancel()
+        self.driver_.stop_all()
+        if self.cleanup_call_.active():
+            self.cleanup_call_.cancel()
 
     def process_cell(self, cell_obj):
         cell_type = cell_obj.get_cell_type()
@@ -121,9 +148,9 @@ class Server(object):
                 orphaned_streams.append(stream_id)
         
         for stream_id in orphaned_streams:
-            from twisted.python import log
-            log.msg("Cleaning up orphaned factory for stream %d (inactive for %.1f seconds)" %
-                   (stream_id, current_time - self.factory_last_activity.get(stream_id, 0)))
+            LOG.info("Cleaning up orphaned factory for stream %d (inactive for %.1f seconds)",
+                     stream_id,
+                     current_time - self.factory_last_activity.get(stream_id, 0))
             if stream_id in self.factory_instances:
                 self.factory_instances[stream_id].connectionLost()
             self._cleanup_factory(stream_id)
@@ -139,4 +166,5 @@ class Server(object):
         self.cleanup_orphaned_factories()
         
         # Schedule next cleanup
-        reactor.callLater(CLEANUP_INTERVAL_S, self._periodic_cleanup, reactor)
+        self.cleanup_call_ = reactor.callLater(CLEANUP_INTERVAL_S,
+                                               self._periodic_cleanup, reactor)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Unit tests for marionette.benchmark module.
+"""
+
+import io
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+sys.path.insert(0, '.')
+
+import marionette.benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+    """Test running, saving and comparing benchmarks."""
+
+    def setUp(self):
+        """Set up a scratch directory for results."""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def results(self, medians):
+        return {
+            'version': marionette.benchmark.RESULTS_VERSION,
+            'benchmarks': dict((name, {'median': median})
+                               for (name, median) in medians.items()),
+        }
+
+    def test_time_benchmark(self):
+        """Test that loops are calibrated to the minimum time."""
+        calls = []
+        result = marionette.benchmark.time_benchmark(
+            lambda: calls.append(1), min_time=0.001, repeat=3)
+        self.assertEqual(len(result['values']), 3)
+        self.assertGreater(result['loops'], 1)
+        self.assertGreaterEqual(len(calls), result['loops'] * 3)
+
+        marionette.benchmark.summarize(result)
+        self.assertLessEqual(result['min'], result['median'])
+
+    def test_compare(self):
+        """Test that only changes beyond the threshold are reported."""
+        baseline = self.results({'a': 1.0, 'b': 1.0, 'c': 1.0, 'd': 1.0})
+        results = self.results({'a': 1.05, 'b': 1.2, 'c': 0.5, 'e': 9.0})
+        rows = marionette.benchmark.compare(baseline, results, 0.1)
+        self.assertEqual([(row[0], row[4]) for row in rows],
+                         [('a', 'same'), ('b', 'slower'), ('c', 'faster')])
+
+    def test_main(self):
+        """Test saving results and comparing them with a baseline."""
+        results_path = os.path.join(self.tmp_dir, 'results.json')
+        with contextlib.redirect_stdout(io.StringIO()):
+            retval = marionette.benchmark.main(
+                ['-k', '^record_layer', '--min-time', '0.001', '-r', '2',
+                 '-o', results_path])
+        self.assertEqual(retval, 0)
+
+        with open(results_path) as f:
+            results = json.load(f)
+        self.assertEqual(sorted(results['benchmarks']),
+                         ['record_layer.serialize',
+                          'record_layer.unserialize'])
+
+        for result in results['benchmarks'].values():
+            result['median'] /= 2
+        baseline_path = os.path.join(self.tmp_dir, 'baseline.json')
+        with open(baseline_path, 'w') as f:
+            json.dump(results, f)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(marionette.benchmark.main(
+                ['-i', results_path, '-c', results_path]), 0)
+            self.assertEqual(marionette.benchmark.main(
+                ['-i', results_path, '-c', baseline_path]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Unit tests for marionette.covertext_pool module.
+"""
+
+import sys
+import unittest
+from unittest import mock
+
+from twisted.internet import defer
+from twisted.internet import task
+
+sys.path.insert(0, '.')
+
+import marionette.covertext_pool
+
+
+class TestCovertextPool(unittest.TestCase):
+    """Test CovertextPool class."""
+
+    def setUp(self):
+        """Set up a pool of numbered covertexts on a fake reactor."""
+        self.clock = task.Clock()
+        patcher = mock.patch.object(
+            marionette.covertext_pool, 'reactor', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(marionette.covertext_pool.clear)
+
+        self.made = 0
+        self.pool = marionette.covertext_pool.CovertextPool(self.make, 3)
+
+    def make(self):
+        self.made += 1
+        return self.made
+
+    def test_fills_on_demand(self):
+        """Test that a pool fills up to its size once it's used."""
+        self.assertEqual(self.pool.get(), 1)
+        self.clock.advance(0)
+        self.assertEqual(len(self.pool), 0)
+
+        self.assertEqual(self.pool.get(), 2)
+        self.clock.advance(0)
+        self.assertEqual(len(self.pool), 1)
+
+        for i in range(10):
+            self.pool.get()
+            self.clock.advance(0)
+        self.assertEqual(len(self.pool), 3)
+        self.assertEqual(self.pool.get(), self.made - 2)
+
+    def test_refills_per_call(self):
+        """Test that refills are spread over reactor iterations."""
+        self.pool.size_ = 10
+        self.pool.taken_ = 10
+        self.pool.get()
+
+        marionette.covertext_pool.refill()
+        self.assertEqual(len(self.pool),
+                         marionette.covertext_pool.REFILLS_PER_CALL)
+        self.clock.advance(0)
+        self.assertEqual(len(self.pool), 10)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_deferred(self):
+        """Test a pool whose covertexts are made asynchronously."""
+        deferreds = []
+
+        def make():
+            deferreds.append(defer.Deferred())
+            return deferreds[-1]
+
+        pool = marionette.covertext_pool.CovertextPool(make, 2)
+        pool.taken_ = 2
+        self.assertIs(pool.get(), deferreds[0])
+
+        for i in range(5):
+            self.clock.advance(0)
+        self.assertEqual(len(deferreds), 3)
+        self.assertEqual(len(pool), 0)
+
+        deferreds[1].callback(b'covertext')
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(pool.get(), b'covertext')
+
+    def test_disabled(self):
+        """Test that a pool of size 0 makes every covertext when taken."""
+        pool = marionette.covertext_pool.CovertextPool(self.make, 0)
+        for i in range(3):
+            pool.get()
+            self.clock.advance(0)
+        self.assertEqual(self.made, 3)
+        self.assertEqual(len(pool), 0)
+
+    def test_shared_pool(self):
+        """Test that shared pools are kept by key."""
+        pool = marionette.covertext_pool.get_shared_pool(('a', 1), self.make)
+        self.assertIs(
+            marionette.covertext_pool.get_shared_pool(('a', 1), None), pool)
+        self.assertIsNot(
+            marionette.covertext_pool.get_shared_pool(('a', 2), self.make),
+            pool)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import stat
+import tempfile
+import unittest
+
+sys.path.insert(0, '.')
+
+import fte
+
+import marionette.conf
+import marionette.dfa_cache
+
+
+class TestDfaCache(unittest.TestCase):
+    """Test the on-disk and in-process DFA caches."""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.old_cache_dir = marionette.conf.get("fte.dfa_cache_dir")
+        marionette.conf.set("fte.dfa_cache_dir", self.cache_dir)
+        marionette.dfa_cache.clear()
+
+        self.calls = []
+        self.old_regex2dfa = fte.regex2dfa.regex2dfa
+
+        def regex2dfa(regex):
+            self.calls.append(regex)
+            return self.old_regex2dfa(regex)
+        fte.regex2dfa.regex2dfa = regex2dfa
+
+    def tearDown(self):
+        fte.regex2dfa.regex2dfa = self.old_regex2dfa
+        marionette.conf.set("fte.dfa_cache_dir", self.old_cache_dir)
+        marionette.dfa_cache.clear()
+        shutil.rmtree(self.cache_dir)
+
+    def test_persisted(self):
+        """Test that a DFA is compiled once and then read from disk."""
+        dfa = marionette.dfa_cache.regex2dfa("^a+$")
+        self.assertEqual(self.calls, ["^a+$"])
+
+        cache_path = marionette.dfa_cache.get_cache_path("^a+$")
+        self.assertTrue(cache_path.startswith(self.cache_dir))
+        self.assertTrue(os.path.exists(cache_path))
+        # readable by other users sharing the cache
+        self.assertEqual(stat.S_IMODE(os.stat(cache_path).st_mode), 0o644)
+
+        # a fresh process only has the disk cache
+        marionette.dfa_cache.clear()
+        self.assertEqual(marionette.dfa_cache.regex2dfa("^a+$"), dfa)
+        self.assertEqual(self.calls, ["^a+$"])
+
+    def test_versioned(self):
+        """Test that upgrading fte or regex2dfa moves to a new directory."""
+        cache_dir = marionette.dfa_cache.get_cache_dir()
+        old_get_version = marionette.dfa_cache.get_version
+        for package in ['fte', 'regex2dfa']:
+            def get_version(name, package=package):
+                if name == package:
+                    return 'upgraded'
+                return old_get_version(name)
+            marionette.dfa_cache.get_version = get_version
+            try:
+                self.assertNotEqual(marionette.dfa_cache.get_cache_dir(),
+                                    cache_dir)
+            finally:
+                marionette.dfa_cache.get_version = old_get_version
+
+    def test_disabled(self):
+        """Test that nothing is written with the disk cache disabled."""
+        marionette.conf.set("fte.dfa_cache", False)
+        try:
+            self.assertIsNone(marionette.dfa_cache.get_cache_dir())
+            marionette.dfa_cache.regex2dfa("^b+$")
+            marionette.dfa_cache.clear()
+            marionette.dfa_cache.regex2dfa("^b+$")
+        finally:
+            marionette.conf.set("fte.dfa_cache", True)
+
+        self.assertEqual(self.calls, ["^b+$", "^b+$"])
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_encoders_shared(self):
+        """Test that encoders are shared per regex and msg_len."""
+        encoder = marionette.dfa_cache.get_encoder("^c+$", 128)
+        self.assertIs(marionette.dfa_cache.get_encoder("^c+$", 128), encoder)
+        self.assertIsNot(marionette.dfa_cache.get_encoder("^c+$", 256),
+                         encoder)
+        self.assertEqual(self.calls, ["^c+$"])
+
+
+if __name__ == "__main__":
+    unittest.main()
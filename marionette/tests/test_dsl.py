@@ -1,4 +1,6 @@
+import os
 import sys
+import copy
 import unittest
 
 sys.path.append('.')
@@ -572,6 +574,249 @@ action downstream_async:
         self.assertEqual(parsed_format.get_action_blocks()[0].get_method(), "puts")
         self.assertEqual(parsed_format.get_action_blocks()[0].get_args()[0], "\x41\x42\\backslash")
 
+    def test_action_blocks(self):
+        mar_files = marionette.dsl.find_mar_files('server',
+                                                     'http_active_probing2',
+                                                     '20150701')
+        executable = marionette.dsl.load('server', 'http_active_probing2',
+                                         mar_files[0])
+
+        for src_state in executable.states_:
+            for dst_state in executable.states_[src_state].transitions_:
+                action_name = executable.states_[
+                    src_state].transitions_[dst_state][0]
+                expected = [action for action in executable.actions_
+                            if action.execute('server', action_name)]
+                self.assertEqual(
+                    executable.determine_action_block(src_state, dst_state),
+                    expected)
+
+        replica = executable.replicate()
+        self.assertIs(replica.machine_, executable.machine_)
+
+    def test_action_callable(self):
+        import marionette.plugins._io
+
+        mar_files = marionette.dsl.find_mar_files('server',
+                                                     'http_active_probing2',
+                                                     '20150701')
+        executable = marionette.dsl.load('server', 'http_active_probing2',
+                                         mar_files[0])
+
+        matching = [action for action in executable.actions_
+                    if action.get_regex_match_incoming()]
+        self.assertTrue(matching)
+        for action in matching:
+            self.assertIs(action.get_callable(), getattr(
+                marionette.plugins._io, action.get_method()))
+            self.assertEqual(action.get_compiled_regex_match_incoming().pattern,
+                             action.get_regex_match_incoming())
+
+        # changing the method drops the cached plugin function
+        action = copy.deepcopy(matching[0])
+        action.set_method('gets')
+        self.assertIs(action.get_callable(), marionette.plugins._io.gets)
+
+        # so does changing the plugin, for the prepare_ function too, which
+        # is also only looked up once
+        import importlib
+        import marionette.plugins._fte
+        from unittest import mock
+        self.assertIsNone(action.get_prepare_callable())
+        action.set_module('fte')
+        action.set_method('send')
+        with mock.patch.object(marionette.action.importlib, 'import_module',
+                               wraps=importlib.import_module) as import_module:
+            for i in range(2):
+                self.assertIs(action.get_prepare_callable(),
+                              marionette.plugins._fte.prepare_send)
+            self.assertEqual(import_module.call_count, 1)
+
+    def test_compiled_format_cache(self):
+        marionette.dsl.invalidate_compiled_formats()
+        mar_files = marionette.dsl.find_mar_files('client',
+                                                     'http_simple_blocking',
+                                                     '20150701')
+        executable1 = marionette.dsl.load('client', 'http_simple_blocking',
+                                          mar_files[0])
+        executable2 = marionette.dsl.load('client', 'http_simple_blocking',
+                                          mar_files[0])
+        self.assertEqual(len(marionette.dsl.compiled_formats_), 1)
+
+        # compiled state is shared, per-connection state isn't
+        self.assertIs(executable1.states_, executable2.states_)
+        self.assertIs(executable1.machine_, executable2.machine_)
+        self.assertIsNot(executable1.marionette_state_,
+                         executable2.marionette_state_)
+        executable1.set_global("multiplexer_outgoing", "a")
+        self.assertIsNone(executable2.get_global("multiplexer_outgoing"))
+        self.assertEqual(executable1.get_local("model_uuid"),
+                         executable2.get_local("model_uuid"))
+        self.assertNotEqual(executable1.get_local("model_instance_id"),
+                            executable2.get_local("model_instance_id"))
+
+        # nested formats get the version they're in, not their subdir
+        mar_path = marionette.dsl.find_mar_files('client', 'ta/amzn_sess',
+                                                 '20150701')[0]
+        self.assertEqual(marionette.dsl.get_format_version(mar_path),
+                         '20150701')
+        marionette.dsl.load('client', 'ta/amzn_sess', mar_path)
+        self.assertIn('20150701', [key[2] for key
+                                   in marionette.dsl.compiled_formats_
+                                   if key[1] == 'ta/amzn_sess'])
+        marionette.dsl.invalidate_compiled_formats('ta/amzn_sess')
+
+        marionette.dsl.invalidate_compiled_formats('http_simple_nonblocking')
+        self.assertEqual(len(marionette.dsl.compiled_formats_), 1)
+        marionette.dsl.invalidate_compiled_formats('http_simple_blocking')
+        self.assertEqual(len(marionette.dsl.compiled_formats_), 0)
+
+    def test_bundle(self):
+        import shutil
+        import stat
+        import tempfile
+        from unittest import mock
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        cache_home = os.path.join(tmp_dir, 'cache')
+        patcher = mock.patch.dict(os.environ, {'XDG_CACHE_HOME': cache_home})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        format_dir = os.path.join(tmp_dir, 'formats')
+        os.mkdir(format_dir)
+        mar_files = marionette.dsl.find_mar_files('server',
+                                                     'http_active_probing2',
+                                                     '20150701')
+        mar_path = os.path.join(format_dir, 'http_active_probing2.mar')
+        shutil.copy(mar_files[0], mar_path)
+        bundle_path = mar_path + marionette.dsl.BUNDLE_SUFFIX
+
+        def get_mode(path):
+            return stat.S_IMODE(os.stat(path).st_mode)
+
+        # the first load parses and saves a bundle that round-trips, in the
+        # cache dir rather than next to the format
+        parsed_format = marionette.dsl.parse_file(mar_path)
+        self.assertEqual(os.listdir(format_dir), ['http_active_probing2.mar'])
+        with open(mar_path) as f:
+            mar_str = f.read()
+        cache_path = marionette.dsl.get_bundle_cache_path(
+            marionette.dsl.get_digest(mar_str))
+        self.assertTrue(cache_path.startswith(cache_home))
+        self.assertEqual(get_mode(cache_path), 0o644)
+        self.assertEqual(
+            marionette.dsl.format_to_dict(parsed_format),
+            marionette.dsl.format_to_dict(marionette.dsl.parse(mar_str)))
+
+        # the next one doesn't parse
+        with mock.patch.object(marionette.dsl, 'parse') as parse:
+            bundled_format = marionette.dsl.parse_file(mar_path)
+            self.assertFalse(parse.called)
+        self.assertEqual(marionette.dsl.format_to_dict(bundled_format),
+                         marionette.dsl.format_to_dict(parsed_format))
+        self.assertTrue(any(action.get_regex_match_incoming()
+                            for action in bundled_format.get_action_blocks()))
+
+        # compiled bundles go next to the format, readable by everyone
+        self.assertEqual(marionette.dsl.compile_all(format_dir),
+                         [(mar_path, True)])
+        self.assertEqual(get_mode(bundle_path), 0o644)
+        shutil.rmtree(cache_home)
+        with mock.patch.object(marionette.dsl, 'parse') as parse:
+            marionette.dsl.parse_file(mar_path)
+            self.assertFalse(parse.called)
+        self.assertFalse(os.path.exists(cache_home))
+
+        # changing the source invalidates the bundles
+        with open(mar_path, 'a') as f:
+            f.write('\n')
+        with mock.patch.object(marionette.dsl, 'parse',
+                               wraps=marionette.dsl.parse) as parse:
+            marionette.dsl.parse_file(mar_path)
+            self.assertTrue(parse.called)
+
+        # so do corrupt ones, or ones from another version
+        marionette.dsl.compile_all(format_dir)
+        for path in [bundle_path, marionette.dsl.get_bundle_cache_path(
+                marionette.dsl.get_digest(mar_str + '\n'))]:
+            with open(path, 'w') as f:
+                f.write('{')
+        self.assertEqual(
+            marionette.dsl.format_to_dict(marionette.dsl.parse_file(mar_path)),
+            marionette.dsl.format_to_dict(parsed_format))
+        marionette.dsl.compile_all(format_dir)
+        with mock.patch.object(marionette.dsl, 'BUNDLE_VERSION', 0):
+            with mock.patch.object(marionette.dsl, 'parse',
+                                   wraps=marionette.dsl.parse) as parse:
+                marionette.dsl.parse_file(mar_path)
+                self.assertTrue(parse.called)
+
+    def test_format_index(self):
+        import shutil
+        import tempfile
+        from unittest import mock
+
+        format_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, format_dir)
+        for (version, format_name) in [('20150701', 'a'),
+                                       ('20150701', 'ta/b'),
+                                       ('20150702', 'a'),
+                                       ('.hidden', 'a')]:
+            mar_path = os.path.join(format_dir, version, format_name + '.mar')
+            os.makedirs(os.path.dirname(mar_path), exist_ok=True)
+            open(mar_path, 'w').close()
+
+        marionette.dsl.refresh_format_index()
+        self.addCleanup(marionette.dsl.refresh_format_index)
+        with mock.patch.object(marionette.dsl, 'get_format_dir',
+                               return_value=format_dir):
+            index = marionette.dsl.get_format_index()
+            self.assertEqual(marionette.dsl.list_mar_files('client'),
+                             ['a:20150701', 'ta/b:20150701', 'a:20150702'])
+            self.assertEqual(
+                marionette.dsl.find_mar_files('client', 'a'),
+                [os.path.join(format_dir, '20150702', 'a.mar')])
+            self.assertEqual(
+                marionette.dsl.find_mar_files('server', 'a'),
+                [os.path.join(format_dir, '20150701', 'a.mar'),
+                 os.path.join(format_dir, '20150702', 'a.mar')])
+            self.assertEqual(
+                marionette.dsl.find_mar_files('server', 'a', '2015070[1]'),
+                [os.path.join(format_dir, '20150701', 'a.mar')])
+            self.assertEqual(marionette.dsl.find_mar_files('client', 'c'), [])
+            self.assertEqual(
+                marionette.dsl.get_latest_version('client', 'ta/b'),
+                '20150701')
+            self.assertIsNone(
+                marionette.dsl.get_latest_version('client', 'c'))
+            self.assertIsNotNone(index.get_mtime('a', '20150701'))
+
+            # lookups don't walk the formats dir again
+            with mock.patch.object(os, 'walk') as walk:
+                marionette.dsl.find_mar_files('client', 'a')
+                marionette.dsl.list_mar_files('server')
+                self.assertFalse(walk.called)
+            self.assertIs(marionette.dsl.get_format_index(), index)
+
+            # a new version is found on its own, a new format in an existing
+            # version once the index is refreshed
+            os.mkdir(os.path.join(format_dir, '20150703'))
+            open(os.path.join(format_dir, '20150703', 'c.mar'), 'w').close()
+            os.utime(format_dir, (0, 0))
+            self.assertEqual(marionette.dsl.get_latest_version('client', 'c'),
+                             '20150703')
+            self.assertTrue(
+                marionette.dsl.get_format_index().has_version('20150703'))
+
+            open(os.path.join(format_dir, '20150701', 'c.mar'), 'w').close()
+            self.assertEqual(len(marionette.dsl.find_mar_files('server', 'c')),
+                             1)
+            marionette.dsl.refresh_format_index()
+            self.assertEqual(len(marionette.dsl.find_mar_files('server', 'c')),
+                             2)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the cells marionette.plugins._fte puts in a message and
+accepts from one.
+"""
+
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, '.')
+
+import marionette.conf
+import marionette.executables.pioa
+import marionette.multiplexer
+import marionette.record_layer
+from marionette.plugins import _fte
+
+REGEX = '^[a-zA-Z0-9]+$'
+
+
+class TestMakeCtxt(unittest.TestCase):
+    """Test which cells go in a message, with and without packing."""
+
+    def setUp(self):
+        """Set up a model state with data queued on two streams, and
+        'encode' to the plaintext."""
+        self.buffer = marionette.multiplexer.BufferOutgoing()
+        self.buffer.push(1, b'a' * 10)
+        self.buffer.push(2, b'b' * 10)
+        self.state = marionette.executables.pioa.MarionetteSystemState()
+        self.state.set_global("multiplexer_outgoing", self.buffer)
+        self.state.set_local("model_uuid", 1)
+        self.state.set_local("model_instance_id", 2)
+
+        pack_cells = marionette.conf.get("fte.pack_cells")
+        self.addCleanup(marionette.conf.set, "fte.pack_cells", pack_cells)
+        patcher = mock.patch.object(
+            _fte, 'encode_ptxt',
+            lambda marionette_state, regex, msg_len, ptxt: ptxt)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_single_cell(self):
+        """Test that by default a message holds one cell, as peers without
+        pack_cells expect."""
+        marionette.conf.set("fte.pack_cells", False)
+        (cells, ptxt) = _fte.make_ctxt(self.state, REGEX, 128)
+        self.assertEqual(len(cells), 1)
+        self.assertEqual(marionette.record_layer.unserialize(ptxt).get_payload(),
+                         cells[0].get_payload())
+        self.assertEqual(len(cells[0].get_payload()), 10)
+        self.assertFalse(self.buffer.is_empty())
+
+    def test_pack_cells(self):
+        """Test that with pack_cells a message carries every stream."""
+        marionette.conf.set("fte.pack_cells", True)
+        (cells, ptxt) = _fte.make_ctxt(self.state, REGEX, 128)
+        self.assertEqual(sorted(cell_obj.get_stream_id()
+                                for cell_obj in cells), [1, 2])
+        self.assertTrue(self.buffer.is_empty())
+        self.assertEqual(len(_fte.unserialize_cells(ptxt)), 2)
+
+    def test_discarded_presend(self):
+        """Test that a cell popped for a send that didn't happen is sent by
+        the next one, padded for its message rather than the first."""
+        marionette.conf.set("fte.pack_cells", False)
+        (cells, ptxt) = _fte.make_ctxt(self.state, REGEX, 512)
+        self.assertEqual(len(ptxt) * 8,
+                         _fte.get_min_cell_len(self.state, REGEX, 512))
+        _fte.discard_presend(self.state, [REGEX, 512, cells, ptxt])
+
+        (requeued, ptxt) = _fte.make_ctxt(self.state, REGEX, 128)
+        self.assertEqual(requeued[0].get_stream_id(),
+                         cells[0].get_stream_id())
+        self.assertEqual(len(ptxt) * 8,
+                         _fte.get_min_cell_len(self.state, REGEX, 128))
+
+
+class TestAcceptCell(unittest.TestCase):
+    """Test checking the cells of a received message."""
+
+    def setUp(self):
+        self.state = marionette.executables.pioa.MarionetteSystemState()
+        self.state.set_local("model_uuid", 1)
+
+    def serialize(self, *cells):
+        retval = b''
+        for (model_instance_id, stream_id) in cells:
+            cell_obj = marionette.record_layer.Cell(
+                1, model_instance_id, stream_id, 1)
+            cell_obj.set_payload(b'x')
+            retval += cell_obj.to_bytes()
+        return retval
+
+    def test_accept(self):
+        """Test that one or several cells of a model are accepted."""
+        for ptxt in [self.serialize((5, 1)),
+                     self.serialize((5, 1), (5, 2))]:
+            cell_obj = _fte.accept_cell(ptxt, self.state)
+            self.assertEqual(cell_obj.get_stream_id(), 1)
+            self.assertEqual(self.state.get_local("model_instance_id"), 5)
+
+    def test_every_cell_checked(self):
+        """Test that a cell of another model instance, or a partial one,
+        past the first is refused."""
+        self.assertRaises(marionette.record_layer.UnserializeException,
+                          _fte.accept_cell,
+                          self.serialize((5, 1), (6, 2)), self.state)
+        self.assertRaises(marionette.record_layer.UnserializeException,
+                          _fte.accept_cell,
+                          self.serialize((5, 1), (5, 2))[:-1], self.state)
+        self.assertRaises(marionette.record_layer.UnserializeException,
+                          _fte.accept_cell, b'', self.state)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Unit tests for actions that finish asynchronously, as fte actions do when
+marionette.fte_pool is enabled.
+"""
+
+import sys
+import unittest
+
+from twisted.internet import defer
+from twisted.internet import task
+
+sys.path.insert(0, '.')
+
+import marionette.action
+import marionette.channel
+import marionette.executables.pioa
+import marionette.fte_pool
+
+
+class TestDeferredActions(unittest.TestCase):
+    """Test PIOA transitions whose action returns a Deferred."""
+
+    def setUp(self):
+        """Set up a model with a single start -> end transition."""
+        self.clock = task.Clock()
+        self.deferreds = []
+
+        action = marionette.action.MarionetteAction(
+            'go', 'server', 'fte', 'recv', [])
+        action.callable_ = self.run_action
+
+        self.pioa = marionette.executables.pioa.PIOA('server', 'client')
+        self.pioa.add_state('start')
+        self.pioa.add_state('end')
+        self.pioa.states_['start'].add_transition('end', 'go', 1.0)
+        self.pioa.states_['start'].set_error_transition('end')
+        self.pioa.actions_ = [action]
+        self.pioa.reactor_ = self.clock
+        self.pioa.set_channel(marionette.channel.Channel(None, 'tcp'))
+
+    def run_action(self, channel, marionette_state, args):
+        d = defer.Deferred()
+        self.deferreds.append(d)
+        return d
+
+    def test_waits_for_result(self):
+        """Test that the transition completes once the Deferred fires."""
+        self.assertFalse(self.pioa.transition())
+        self.assertFalse(self.pioa.transition())
+        self.assertEqual(len(self.deferreds), 1)
+        self.assertEqual(self.pioa.current_state_, 'start')
+
+        self.deferreds[0].callback(True)
+        self.assertTrue(self.pioa.wakeup_.is_pending())
+        self.assertTrue(self.pioa.transition())
+        self.assertEqual(self.pioa.current_state_, 'end')
+
+    def test_failed_result(self):
+        """Test that a failed action is retried on the next attempt."""
+        self.assertFalse(self.pioa.transition())
+        self.deferreds[0].callback(False)
+        self.assertFalse(self.pioa.transition())
+        self.assertEqual(self.pioa.current_state_, 'start')
+
+        self.assertFalse(self.pioa.transition())
+        self.assertEqual(len(self.deferreds), 2)
+
+    def test_retry_after_new_data(self):
+        """Test that a failed action is retried at once if data arrived
+        while it ran."""
+        self.assertFalse(self.pioa.transition())
+        self.pioa.channel_.appendToBuffer(b'more')
+        self.deferreds[0].callback(False)
+
+        self.assertFalse(self.pioa.transition())
+        self.assertEqual(len(self.deferreds), 2)
+
+    def test_exception(self):
+        """Test that an exception takes the error transition."""
+        self.assertFalse(self.pioa.transition())
+        self.deferreds[0].errback(ValueError('bad'))
+        # the error transition runs the same action again
+        self.assertFalse(self.pioa.transition())
+        self.deferreds[1].callback(True)
+        self.assertTrue(self.pioa.transition())
+        self.assertEqual(self.pioa.current_state_, 'end')
+
+
+class TestChannelConsume(unittest.TestCase):
+    """Test taking decoded data out of a channel."""
+
+    def test_consume(self):
+        channel = marionette.channel.Channel(None, 'tcp')
+        channel.appendToBuffer(b'abcdef')
+        ctxt = channel.peek()
+        channel.appendToBuffer(b'gh')
+
+        self.assertTrue(channel.consume(ctxt, 4))
+        self.assertEqual(channel.peek(), 'efgh')
+        self.assertFalse(channel.consume(ctxt, 4))
+        self.assertEqual(channel.peek(), 'efgh')
+
+
+class TestWorkerFunctions(unittest.TestCase):
+    """Test the functions run in the pool's workers."""
+
+    def test_round_trip(self):
+        regex = '^[a-z]+$'
+        ctxt = marionette.fte_pool.do_encode(regex, 128, b'hello')
+        self.assertIsInstance(ctxt, bytes)
+
+        [ptxt, remainder] = marionette.fte_pool.do_decode(
+            regex, 128, ctxt + b'xyz')
+        self.assertEqual(ptxt, b'hello')
+        self.assertEqual(remainder, b'xyz')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Unit tests for marionette.logger module.
+"""
+
+import sys
+import unittest
+from unittest import mock
+
+from twisted.python import log
+
+sys.path.insert(0, '.')
+
+import marionette.channel
+import marionette.logger
+
+
+class Formatted(object):
+    """An argument that counts how often it's formatted."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __str__(self):
+        self.count += 1
+        return 'formatted'
+
+
+class TestLogger(unittest.TestCase):
+    """Test leveled, sampled logging."""
+
+    def setUp(self):
+        """Collect the events we log."""
+        self.events = []
+        log.addObserver(self.events.append)
+        self.addCleanup(log.removeObserver, self.events.append)
+        self.logger = marionette.logger.Logger('test')
+
+    def test_levels(self):
+        """Test that messages below the level are dropped unformatted."""
+        arg = Formatted()
+        self.logger.debug("dropped %s", arg)
+        self.assertEqual(self.events, [])
+
+        self.assertEqual(arg.count, 0)
+
+        self.logger.info("kept %s", arg, stream_id=3)
+        [event] = self.events
+        self.assertEqual(log.textFromEventDict(event), 'kept formatted')
+        self.assertEqual(event['system'], 'marionette.test')
+        self.assertEqual(event['logLevel'], marionette.logger.INFO)
+        self.assertEqual(event['stream_id'], 3)
+
+        self.logger.set_level(marionette.logger.DEBUG)
+        self.assertTrue(self.logger.debug_enabled)
+        self.logger.debug("kept")
+        self.assertEqual(len(self.events), 2)
+
+        self.logger.set_level(marionette.logger.ERROR)
+        self.assertFalse(self.logger.info_enabled)
+        self.logger.warning("dropped")
+        self.logger.error("kept")
+        self.assertEqual(len(self.events), 3)
+
+    def test_sample(self):
+        """Test that only one in N debug and info messages is logged."""
+        self.logger.set_sample(10)
+        for i in range(100):
+            self.logger.info("%d", i)
+            self.logger.warning("%d", i)
+
+        infos = [event for event in self.events
+                 if event['logLevel'] == marionette.logger.INFO]
+        self.assertEqual(len(infos), 10)
+        self.assertEqual(len(self.events), 110)
+
+    def test_configure(self):
+        """Test setting levels and sampling per subsystem."""
+        test_logger = marionette.logger.get_logger('test_configure')
+        self.assertIs(marionette.logger.get_logger('test_configure'),
+                      test_logger)
+        self.addCleanup(marionette.logger.configure, '', '', '')
+
+        marionette.logger.configure(
+            'warning', 'test_configure:debug, test_new:error',
+            'test_configure:5')
+        self.assertTrue(test_logger.debug_enabled)
+        self.assertEqual(test_logger.get_sample(), 5)
+        self.assertEqual(marionette.logger.get_logger('test_new').get_level(),
+                         marionette.logger.ERROR)
+        self.assertEqual(
+            marionette.logger.get_logger('channel').get_level(),
+            marionette.logger.WARNING)
+
+        with mock.patch.object(marionette.logger.marionette.conf, 'get',
+                               return_value=True):
+            marionette.logger.configure('', '', '')
+        self.assertTrue(
+            marionette.logger.get_logger('channel').debug_enabled)
+
+        self.assertRaises(ValueError, marionette.logger.configure,
+                          'loud', '', '')
+        self.assertRaises(ValueError, marionette.logger.configure,
+                          '', 'channel', '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Unit tests for marionette.loopback module.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+from unittest import mock
+
+from twisted.internet import task
+
+sys.path.insert(0, '.')
+
+import marionette.channel
+import marionette.loopback
+
+
+class TestLoopback(unittest.TestCase):
+    """Test connecting channels in memory."""
+
+    def setUp(self):
+        """Install a loopback on a fake reactor."""
+        self.clock = task.Clock()
+        patcher = mock.patch.object(
+            marionette.loopback, 'reactor', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.loopback = marionette.loopback.Loopback(delay=0.05)
+        self.loopback.install()
+        self.addCleanup(self.loopback.uninstall)
+
+    def accept(self, port):
+        self.addCleanup(marionette.channel.stop_accepting_new_channels,
+                        'tcp', port)
+        return marionette.channel.accept_new_channel('tcp', port)
+
+    def connect(self, port):
+        channels = []
+        marionette.channel.start_connection('tcp', port, channels.append)
+        return channels
+
+    def test_connect(self):
+        """Test that data written on one end arrives at the other, in order,
+        after the delay."""
+        self.assertIsNone(self.accept(8080))
+        [client] = self.connect(8080)
+        server = self.accept(8080)
+        self.assertEqual(server.party, 'server')
+        self.assertEqual(client.party, 'client')
+
+        client.send(b'abc')
+        client.send(b'def')
+        self.clock.advance(0.04)
+        self.assertEqual(server.peek(), '')
+        self.clock.advance(0.01)
+        self.assertEqual(server.recv(), 'abcdef')
+
+        server.send(b'x' * 10)
+        self.clock.advance(0.05)
+        self.assertEqual(client.recv(), 'x' * 10)
+
+        self.assertEqual(self.loopback.get_bytes_written(), 16)
+        self.assertEqual(self.loopback.get_num_connections(), 1)
+
+    def test_not_listening(self):
+        """Test that connections to ports nobody listens on go nowhere."""
+        self.assertEqual(self.connect(8080), [])
+
+        self.accept(8080)
+        marionette.channel.stop_accepting_new_channels('tcp', 8080)
+        self.assertEqual(self.connect(8080), [])
+
+    def test_bind(self):
+        """Test that bind() gets a port of its own."""
+        port = marionette.channel.bind()
+        self.addCleanup(marionette.channel.stop_accepting_new_channels,
+                        'tcp', port)
+        self.assertGreaterEqual(port,
+                                marionette.loopback.FIRST_EPHEMERAL_PORT)
+        self.assertEqual(len(self.connect(port)), 1)
+
+    def test_percentile(self):
+        """Test nearest-rank percentiles."""
+        values = list(range(1, 101))
+        self.assertEqual(marionette.loopback.percentile(values, 50), 50)
+        self.assertEqual(marionette.loopback.percentile(values, 99), 99)
+        self.assertEqual(marionette.loopback.percentile([3], 99), 3)
+        self.assertIsNone(marionette.loopback.percentile([], 50))
+
+
+class TestLoopbackRun(unittest.TestCase):
+    """Test echoing streams through a format."""
+
+    def setUp(self):
+        """Set up a scratch directory for results."""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def test_main(self):
+        """Test a run, in a process of its own as it runs the reactor."""
+        results_path = os.path.join(self.tmp_dir, 'results.json')
+        output = subprocess.check_output(
+            [sys.executable, '-m', 'marionette.loopback', '-f', 'dummy',
+             '-n', '3', '-s', '2000', '--timeout', '30', '-o', results_path],
+            stderr=subprocess.STDOUT, timeout=120)
+        self.assertIn(b'dummy', output)
+
+        with open(results_path) as f:
+            [result] = json.load(f)['results']
+        self.assertIsNone(result['error'])
+        self.assertEqual(result['payload_bytes'], 2 * 3 * 2000)
+        self.assertGreaterEqual(result['wire_bytes'], result['payload_bytes'])
+        self.assertGreater(result['cells'], 0)
+        self.assertLessEqual(result['latency_p50'], result['latency_p99'])
+
+
+if __name__ == '__main__':
+    unittest.main()
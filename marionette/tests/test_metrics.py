@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Unit tests for marionette.metrics module.
+"""
+
+import sys
+import unittest
+
+sys.path.insert(0, '.')
+
+import marionette.channel
+import marionette.metrics
+import marionette.multiplexer
+import marionette.record_layer
+
+
+class FakeState(object):
+
+    def __init__(self, format_name):
+        self.local_ = {"format_name": format_name}
+
+    def get_local(self, key):
+        return self.local_.get(key)
+
+
+class TestMetrics(unittest.TestCase):
+    """Test metrics and their rendering."""
+
+    def setUp(self):
+        """Use a registry of our own."""
+        self.registry = marionette.metrics.Registry()
+
+    def test_counter(self):
+        """Test that counters render with their labels."""
+        counter = self.registry.register(marionette.metrics.Counter(
+            'test_total', 'A "test" counter.\nTwo lines.', ['format']))
+        counter.labels('dummy').inc()
+        counter.labels('dummy').inc(2)
+        counter.labels('http\\"x').inc(0.5)
+
+        self.assertEqual(counter.labels('dummy').get(), 3)
+        self.assertEqual(self.registry.render(), '\n'.join([
+            '# HELP test_total A "test" counter.\\nTwo lines.',
+            '# TYPE test_total counter',
+            'test_total{format="dummy"} 3',
+            'test_total{format="http\\\\\\"x"} 0.5',
+        ]) + '\n')
+
+    def test_labels(self):
+        """Test that the wrong number of label values is refused."""
+        counter = marionette.metrics.Counter('test_total', '', ['format'])
+        self.assertRaises(ValueError, counter.labels)
+        self.assertRaises(ValueError, counter.labels, 'a', 'b')
+
+        self.registry.register(counter)
+        self.assertRaises(ValueError, self.registry.register, counter)
+
+    def test_gauge_function(self):
+        """Test that a gauge can read its values when collected."""
+        values = {('1',): 10}
+        gauge = self.registry.register(marionette.metrics.Gauge(
+            'test_depth', 'Depth.', ['stream']))
+        gauge.set_function(lambda: values)
+        self.assertIn('test_depth{stream="1"} 10', self.registry.render())
+
+        values = {}
+        self.assertNotIn('test_depth{', self.registry.render())
+
+    def test_histogram(self):
+        """Test that histogram buckets are cumulative."""
+        histogram = self.registry.register(marionette.metrics.Histogram(
+            'test_seconds', 'Time.', buckets=[0.1, 1.0]))
+        for value in [0.05, 0.1, 0.5, 2.0]:
+            histogram.observe(value)
+
+        lines = self.registry.render().splitlines()
+        self.assertEqual(lines[2:], [
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            'test_seconds_sum 2.65',
+            'test_seconds_count 4',
+        ])
+
+    def test_clear(self):
+        """Test that clearing forgets values."""
+        counter = self.registry.register(marionette.metrics.Counter(
+            'test_total', 'Test.'))
+        counter.inc()
+        self.registry.clear()
+        self.assertEqual(self.registry.render(),
+                         '# HELP test_total Test.\n# TYPE test_total counter\n')
+
+
+class TestTrafficMetrics(unittest.TestCase):
+    """Test the metrics the plugins, multiplexer and channels update."""
+
+    def setUp(self):
+        marionette.metrics.REGISTRY.clear()
+        self.addCleanup(marionette.metrics.REGISTRY.clear)
+        self.state = FakeState('test_format')
+
+    def test_record_sent(self):
+        """Test counting cells and padding sent."""
+        cells = [marionette.record_layer.Cell(1, 2, 3, i) for i in range(2)]
+        for cell_obj in cells:
+            cell_obj.set_payload(b'x' * 10)
+        marionette.metrics.record_sent(self.state, cells, 500)
+        marionette.metrics.record_sent(self.state, None, 100)
+
+        self.assertEqual(
+            marionette.metrics.CELLS_SENT.labels('test_format').get(), 3)
+        self.assertEqual(marionette.metrics.PAYLOAD_BYTES_SENT.labels(
+            'test_format').get(), 20)
+        self.assertEqual(marionette.metrics.COVERTEXT_BYTES_SENT.labels(
+            'test_format').get(), 600)
+
+    def test_record_received(self):
+        """Test counting the cells in a decoded message."""
+        ptxt = b''
+        for (seq_id, payload) in enumerate([b'abc', b'', b'defg']):
+            cell_obj = marionette.record_layer.Cell(1, 2, 3, seq_id)
+            cell_obj.set_payload(payload)
+            ptxt += marionette.record_layer.serialize_to_bytes(cell_obj, 512)
+        marionette.metrics.record_received(self.state, ptxt, 1000)
+
+        self.assertEqual(marionette.record_layer.count_cells(ptxt), (3, 7))
+        self.assertEqual(marionette.record_layer.count_cells(ptxt[:-1]),
+                         (2, 3))
+        self.assertEqual(
+            marionette.metrics.CELLS_RECEIVED.labels('test_format').get(), 3)
+        self.assertEqual(marionette.metrics.PAYLOAD_BYTES_RECEIVED.labels(
+            'test_format').get(), 7)
+
+    def test_queue_depths(self):
+        """Test that queued stream data shows up until it's sent."""
+        outgoing = marionette.multiplexer.BufferOutgoing('random')
+        outgoing.push(7, b'x' * 100)
+        self.assertIn('marionette_outgoing_queued_bytes{stream="7"} 100',
+                      marionette.metrics.render())
+
+        outgoing.pop(1, 2, 8 * 1024)
+        self.assertIn('marionette_outgoing_queued_bytes{stream="7"} 0',
+                      marionette.metrics.render())
+
+    def test_channels_active(self):
+        """Test that open channels are counted by party."""
+        channel = marionette.channel.Channel(None, 'test')
+        channel.party = 'client'
+        self.assertIn(
+            'marionette_channels_active{party="client",transport="test"} 1',
+            marionette.metrics.render())
+
+        channel.closed_ = True
+        self.assertNotIn('transport="test"', marionette.metrics.render())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -68,6 +68,209 @@ class TestBufferOutgoing(unittest.TestCase):
         # Should not raise exception
         self.buffer.terminate(stream_id)
 
+    def test_pop_many(self):
+        """Test popping several cells from one stream at once."""
+        header_bits = marionette.record_layer.PAYLOAD_HEADER_SIZE_IN_BITS
+        self.buffer.push(7, b'A' * 10 + b'B' * 10 + b'C' * 5)
+
+        cells = self.buffer.pop_many(1, 1, header_bits + 10 * 8, 8)
+
+        self.assertEqual([c.get_payload() for c in cells],
+                         [b'A' * 10, b'B' * 10, b'C' * 5])
+        self.assertEqual([c.get_seq_id() for c in cells], [1, 2, 3])
+        self.assertFalse(self.buffer.has_data(7))
+
+        cell = self.buffer.pop(1, 1, header_bits + 10 * 8)
+        self.assertEqual(cell.get_stream_id(), 0)
+
+    def test_pop_always_a_cell(self):
+        """Test that a pop with room for no payload byte is padding, and
+        leaves the data queued."""
+        header_bits = marionette.record_layer.PAYLOAD_HEADER_SIZE_IN_BITS
+        self.buffer.push(7, b'abc')
+
+        for n in [8, header_bits, header_bits + 7]:
+            cell = self.buffer.pop(1, 1, n)
+            self.assertIsNotNone(cell)
+            self.assertEqual(cell.get_stream_id(), 0)
+            self.assertEqual(self.buffer.bytes_queued(7), 3)
+
+        cell = self.buffer.pop(1, 1, header_bits + 8)
+        self.assertEqual(cell.get_stream_id(), 7)
+        self.assertEqual(cell.get_payload(), b'a')
+
+    def test_push_pop_across_chunks(self):
+        """Test that cell payloads are cut correctly across pushes."""
+        header_bits = marionette.record_layer.PAYLOAD_HEADER_SIZE_IN_BITS
+        self.buffer.push(7, b'abc')
+        self.buffer.push(7, 'def')
+        self.buffer.push(7, bytearray(b'ghij'))
+
+        self.assertEqual(self.buffer.peek(7), b'abcdefghij')
+        self.assertEqual(self.buffer.bytes_queued(7), 10)
+
+        payloads = []
+        while self.buffer.has_data(7):
+            cell = self.buffer.pop(1, 1, header_bits + 4 * 8)
+            payloads.append(bytes(cell.get_payload()))
+        self.assertEqual(payloads, [b'abcd', b'efgh', b'ij'])
+        self.assertEqual(self.buffer.peek(7), b'')
+
+    def test_terminate_without_data(self):
+        """Test that a stream terminated before any push gets an end cell."""
+        self.buffer.terminate(7)
+
+        cell = self.buffer.pop(1, 1, 1024)
+        self.assertEqual(cell.get_stream_id(), 7)
+        self.assertEqual(cell.get_cell_type(),
+                         marionette.record_layer.END_OF_STREAM)
+        self.assertEqual(self.buffer.pop(1, 1, 1024).get_stream_id(), 0)
+
+    def test_wait_for_data(self):
+        """Test that waiters are called once when data arrives."""
+        calls = []
+        self.buffer.wait_for_data(lambda: calls.append(1))
+
+        self.buffer.push(7, b'')
+        self.assertEqual(calls, [])
+        self.buffer.push(7, b'abc')
+        self.assertEqual(calls, [1])
+        self.buffer.push(7, b'def')
+        self.assertEqual(calls, [1])
+
+        self.buffer.wait_for_data(lambda: calls.append(2))
+        self.buffer.terminate(7)
+        self.assertEqual(calls, [1, 2])
+
+    def test_requeue(self):
+        """Test that a requeued cell is popped again first, for the model
+        popping it."""
+        header_bits = marionette.record_layer.PAYLOAD_HEADER_SIZE_IN_BITS
+        self.buffer.push(7, b'abcdefgh')
+        cell = self.buffer.pop(1, 1, header_bits + 4 * 8)
+
+        self.buffer.requeue(cell)
+        self.assertEqual(self.buffer.has_data_for_any_stream(), 7)
+
+        cell = self.buffer.pop(2, 3, header_bits + 8 * 8)
+        self.assertEqual(bytes(cell.get_payload()), b'abcd')
+        self.assertEqual(cell.get_seq_id(), 1)
+        self.assertEqual(cell.get_model_uuid(), 2)
+        self.assertEqual(cell.get_model_instance_id(), 3)
+
+        cell = self.buffer.pop(2, 3, header_bits + 8 * 8)
+        self.assertEqual(bytes(cell.get_payload()), b'efgh')
+        self.assertEqual(cell.get_seq_id(), 2)
+
+    def test_requeue_repadded(self):
+        """Test that a requeued cell drops the padding it was popped with,
+        and is padded for the pop that hands it out again."""
+        header_bytes = marionette.record_layer.PAYLOAD_HEADER_SIZE_IN_BYTES
+        self.buffer.push(7, b'abc')
+        cell = self.buffer.pop(1, 1, 1024)
+        self.assertEqual(len(cell.to_bytes()), 128)
+
+        self.buffer.requeue(cell)
+        cell = self.buffer.pop(1, 1, (header_bytes + 8) * 8)
+        self.assertEqual(len(cell.to_bytes()), header_bytes + 8)
+
+        # a payload that doesn't fit still goes out whole
+        self.buffer.requeue(cell)
+        cell = self.buffer.pop(1, 1, (header_bytes + 1) * 8)
+        self.assertEqual(bytes(cell.get_payload()), b'abc')
+        self.assertEqual(len(cell.to_bytes()), header_bytes + 3)
+
+    def test_pop_packed(self):
+        """Test packing cells from several streams into one message."""
+        header_bits = marionette.record_layer.PAYLOAD_HEADER_SIZE_IN_BITS
+        self.buffer.push(7, b'abc')
+        self.buffer.push(8, b'defgh')
+        self.buffer.terminate(9)
+        self.assertEqual(self.buffer.queued_bits(), 8 * 8 + 3 * header_bits)
+
+        cells = self.buffer.pop_packed(1, 1, self.buffer.queued_bits(),
+                                       4096)
+        self.assertTrue(self.buffer.is_empty())
+        self.assertEqual(sorted(c.get_stream_id() for c in cells), [7, 8, 9])
+        ptxt = b''.join(c.to_bytes() for c in cells)
+        self.assertEqual(len(ptxt), 4096 // 8)
+
+        incoming = marionette.multiplexer.BufferIncoming()
+        incoming.push(ptxt)
+        payloads = dict((c.get_stream_id(), c.get_payload())
+                        for c in incoming.pop_cells())
+        self.assertEqual(payloads, {7: b'abc', 8: b'defgh', 9: b''})
+
+    def test_pop_packed_limit(self):
+        """Test that packed cells don't take more than n bits."""
+        header_bits = marionette.record_layer.PAYLOAD_HEADER_SIZE_IN_BITS
+        self.buffer.push(7, b'a' * 100)
+        self.buffer.push(8, b'b' * 100)
+
+        cells = self.buffer.pop_packed(1, 1, 2 * header_bits + 120 * 8)
+        self.assertEqual(sum(c.get_length() for c in cells),
+                         2 * header_bits + 120 * 8)
+        self.assertEqual(self.buffer.queued_bits(),
+                         header_bits + 80 * 8)
+
+        # whichever stream the scheduler served second was cut short
+        cut = cells[-1]
+        self.assertEqual(len(cut.get_payload()), 20)
+        cells = self.buffer.pop_packed(1, 1, self.buffer.queued_bits())
+        self.assertEqual(len(cells), 1)
+        self.assertEqual(cells[0].get_stream_id(), cut.get_stream_id())
+        self.assertEqual(bytes(cells[0].get_payload()),
+                         bytes(cut.get_payload())[:1] * 80)
+
+        cells = self.buffer.pop_packed(1, 1, 0, 1024)
+        self.assertEqual(len(cells), 1)
+        self.assertEqual(cells[0].get_stream_id(), 0)
+        self.assertEqual(cells[0].get_length(), 1024)
+
+    def test_is_empty(self):
+        """Test that the buffer is empty only if it would pop padding."""
+        self.assertTrue(self.buffer.is_empty())
+        self.buffer.push(7, b'abc')
+        self.assertFalse(self.buffer.is_empty())
+
+        cell = self.buffer.pop(1, 1, 1024)
+        self.assertTrue(self.buffer.is_empty())
+        self.buffer.requeue(cell)
+        self.assertFalse(self.buffer.is_empty())
+        self.buffer.pop(1, 1, 1024)
+
+        self.buffer.terminate(7)
+        self.assertFalse(self.buffer.is_empty())
+        self.buffer.pop(1, 1, 1024)
+        self.assertTrue(self.buffer.is_empty())
+
+
+class TestStreamBuffer(unittest.TestCase):
+    """Test StreamBuffer class."""
+
+    def test_pop_single_chunk_is_zero_copy(self):
+        """Test that pops within one chunk return views into it."""
+        fifo = marionette.multiplexer.StreamBuffer()
+        fifo.append(b'0123456789')
+
+        head = fifo.pop(4)
+        self.assertIsInstance(head, memoryview)
+        self.assertEqual(bytes(head), b'0123')
+        self.assertEqual(bytes(fifo.pop(6)), b'456789')
+        self.assertEqual(len(fifo), 0)
+        self.assertEqual(fifo.pop(1), b'')
+
+    def test_pop_spanning_chunks(self):
+        """Test pops that span several chunks."""
+        fifo = marionette.multiplexer.StreamBuffer()
+        for chunk in [b'ab', b'cde', b'f', b'ghi']:
+            fifo.append(chunk)
+
+        self.assertEqual(bytes(fifo.pop(1)), b'a')
+        self.assertEqual(bytes(fifo.pop(5)), b'bcdef')
+        self.assertEqual(fifo.peek(), b'ghi')
+        self.assertEqual(bytes(fifo.pop(100)), b'ghi')
+
 
 class TestBufferIncoming(unittest.TestCase):
     """Test BufferIncoming class."""
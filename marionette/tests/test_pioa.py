@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Unit tests for picking transitions in marionette.executables.pioa.
+"""
+
+import sys
+import random
+import unittest
+
+sys.path.insert(0, '.')
+
+import marionette.executables.pioa
+import marionette.profiler
+
+
+def linear_transition(transitions, rng):
+    """The way PAState.transition used to pick a destination, walking the
+    transitions and adding up probabilities for every draw."""
+    coin = rng.random()
+    sum = 0
+    for state in transitions:
+        if transitions[state][1] == 0:
+            continue
+        sum += transitions[state][1]
+        if sum >= coin:
+            break
+    return state
+
+
+class TestPAState(unittest.TestCase):
+    """Test PAState.transition()."""
+
+    def new_state(self, probabilities):
+        state = marionette.executables.pioa.PAState('start')
+        for (i, probability) in enumerate(probabilities):
+            state.add_transition('s%d' % i, 'NULL', probability)
+        return state
+
+    def assertSameDraws(self, state, seed, draws=2000):
+        """Asserts that state picks what the linear walk picks, for the
+        same draws."""
+        rng = random.Random(seed)
+        reference_rng = random.Random(seed)
+        for i in range(draws):
+            self.assertEqual(state.transition(rng),
+                             linear_transition(state.transitions_,
+                                               reference_rng))
+
+    def test_same_draws(self):
+        """Test that the table picks what the linear walk picks."""
+        self.assertSameDraws(self.new_state([0.25, 0, 0.5, 0.25]), 1)
+        # don't add up to 1, so some draws fall past the end
+        self.assertSameDraws(self.new_state([0.1] * 9 + [0]), 2)
+        self.assertSameDraws(self.new_state([1.0 / 3] * 3), 3)
+        self.assertSameDraws(self.new_state([0, 0]), 4)
+
+    def test_single(self):
+        """Test that a single transition is taken without an RNG."""
+        state = self.new_state([1.0])
+        self.assertEqual(state.transition(None), 's0')
+
+    def test_potential_transitions(self):
+        """Test listing the transitions that can be taken."""
+        state = self.new_state([0.5, 0, 0.5])
+        self.assertEqual(state.get_potential_transitions(), ('s0', 's2'))
+
+        state.add_transition('s3', 'NULL', 0.5)
+        self.assertEqual(state.get_potential_transitions(),
+                         ('s0', 's2', 's3'))
+
+    def test_formats(self):
+        """Test that models of generated formats take the same routes."""
+        for format_name in ['ta/amzn_sess', 'ta/amzn_conn']:
+            executable = marionette.profiler.load_client(format_name)
+            for (i, state) in enumerate(
+                    sorted(executable.states_.values(),
+                           key=lambda state: state.name_)):
+                if len(state.transitions_) > 1:
+                    self.assertSameDraws(state, i, 200)
+
+
+class TestStateMachine(unittest.TestCase):
+    """Test the compiled form of a model."""
+
+    def test_same_draws(self):
+        """Test that compiled models pick what their states pick."""
+        for format_name in ['ta/amzn_sess', 'http_simple_blocking']:
+            executable = marionette.profiler.load_client(format_name)
+            machine = executable.get_machine()
+            self.assertEqual(machine.names_[:2], ('start', 'dead'))
+
+            for (name, state) in executable.states_.items():
+                state_id = machine.ids_[name]
+                self.assertEqual(
+                    [machine.names_[dst] for dst
+                     in machine.potential_[state_id]],
+                    list(state.get_potential_transitions()))
+                if not state.transitions_:
+                    continue
+                rng = random.Random(state_id)
+                reference_rng = random.Random(state_id)
+                for i in range(200):
+                    self.assertEqual(
+                        machine.names_[machine.transition(state_id, rng)],
+                        state.transition(reference_rng))
+
+    def test_replicas(self):
+        """Test that replicas share the machine and keep their own
+        state."""
+        executable = marionette.profiler.load_client('http_simple_blocking')
+        replica = executable.replicate()
+        self.assertIs(replica.get_machine(), executable.get_machine())
+
+        replica.current_state_ = 'dead'
+        self.assertFalse(replica.isRunning())
+        self.assertTrue(executable.isRunning())
+        self.assertEqual(executable.current_state_, 'start')
+        self.assertEqual(replica.state_id_,
+                         marionette.executables.pioa.DEAD)
+
+
+if __name__ == '__main__':
+    unittest.main()
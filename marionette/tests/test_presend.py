@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Unit tests for preparing the next transition's action while a model is
+blocked, and for fte sends encoded ahead of time.
+"""
+
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, '.')
+
+import marionette.action
+import marionette.channel
+import marionette.executables.pioa
+import marionette.multiplexer
+import marionette.record_layer
+from marionette.plugins import _fte
+
+REGEX = '^GET\\ /$'
+
+
+class TestPrepareNextTransition(unittest.TestCase):
+    """Test PIOA.prepare_next_transition() and its cancellation."""
+
+    def setUp(self):
+        """Set up a lockstep client: start -> up (no action),
+        up -> down (send), down -> up (recv)."""
+        self.prepared = []
+        self.cancelled = []
+
+        send = marionette.action.MarionetteAction(
+            'get', 'client', 'fte', 'send', [REGEX, 128])
+        recv = marionette.action.MarionetteAction(
+            'ok', 'client', 'fte', 'recv', [REGEX, 128])
+
+        self.pioa = marionette.executables.pioa.PIOA('client', 'client')
+        for state in ['start', 'up', 'down', 'error']:
+            self.pioa.add_state(state)
+        self.pioa.states_['start'].add_transition('up', 'NULL', 1.0)
+        self.pioa.states_['up'].add_transition('down', 'get', 1.0)
+        self.pioa.states_['down'].add_transition('up', 'ok', 1.0)
+        self.pioa.actions_ = [send, recv]
+
+        patcher = mock.patch.object(
+            marionette.action.MarionetteAction, 'get_prepare_callable',
+            lambda action: self.prepare
+            if action.get_method() == 'send' else None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def prepare(self, channel, marionette_state, args):
+        self.prepared.append(args)
+        return lambda: self.cancelled.append(args)
+
+    def get_route(self):
+        """Returns the prepared route by state name."""
+        names = self.pioa.get_machine().names_
+        return [(names[src_state], names[dst_state])
+                for (src_state, dst_state) in self.pioa.prepared_[0]]
+
+    def finish_transition(self, dst_state):
+        self.pioa.finish_transition(
+            True, self.pioa.get_machine().ids_[dst_state], [])
+
+    def test_before_channel(self):
+        """Test that a model waiting for its channel prepares its first
+        send, past transitions without actions."""
+        self.pioa.channel_requested_ = True
+        self.assertFalse(self.pioa.transition())
+        self.pioa.prepare_next_transition()
+        self.assertEqual(self.prepared, [[REGEX, 128]])
+        self.assertEqual(self.get_route(), [('start', 'up'), ('up', 'down')])
+
+        # once is enough
+        self.pioa.prepare_next_transition()
+        self.assertEqual(len(self.prepared), 1)
+
+        self.finish_transition('up')
+        self.assertEqual(self.cancelled, [])
+        self.finish_transition('down')
+        self.assertEqual(self.cancelled, [[REGEX, 128]])
+        self.assertIsNone(self.pioa.prepared_)
+
+    def test_blocked_on_recv(self):
+        """Test that a model blocked on a recv prepares the send after
+        it."""
+        self.pioa.set_channel(marionette.channel.Channel(None, 'tcp'))
+        self.pioa.current_state_ = 'down'
+        self.assertFalse(self.pioa.transition())
+        self.assertEqual(self.pioa.next_state_, 'up')
+
+        self.pioa.prepare_next_transition()
+        self.assertEqual(self.get_route(), [('down', 'up'), ('up', 'down')])
+
+    def test_cancelled(self):
+        """Test that the prepared work is undone if we go elsewhere, or
+        stop."""
+        self.pioa.prepare_next_transition()
+        self.finish_transition('error')
+        self.assertEqual(self.cancelled, [[REGEX, 128]])
+
+        self.pioa.current_state_ = 'start'
+        self.pioa.prepare_next_transition()
+        self.pioa.finish()
+        self.assertEqual(len(self.cancelled), 2)
+
+    def test_same_route(self):
+        """Test that the prepared transition is the one the model takes."""
+        states = ['start', 'up', 'down', 'stay']
+        for state in states:
+            self.pioa.add_state(state)
+        self.pioa.states_['start'].transitions_ = {}
+        for state in states:
+            self.pioa.states_['start'].add_transition(state, 'NULL', 0.25)
+            self.pioa.states_['up'].add_transition(state, 'get', 0.25)
+        self.pioa.compile_action_blocks()
+
+        for i in range(10):
+            self.pioa.current_state_ = 'start'
+            self.pioa.next_state_ = None
+            self.pioa.prepared_ = None
+            self.pioa.prepare_next_transition()
+            if not self.pioa.prepared_:
+                continue
+
+            for (src_state, dst_state) in self.get_route():
+                self.assertEqual(self.pioa.current_state_, src_state)
+                self.pioa.get_potential_transitions()
+                self.assertEqual(self.pioa.next_state_, dst_state)
+                self.finish_transition(dst_state)
+
+
+class TestPresend(unittest.TestCase):
+    """Test picking up an fte send prepared ahead of time."""
+
+    def setUp(self):
+        """Set up a model state with an outgoing buffer."""
+        self.buffer = marionette.multiplexer.BufferOutgoing()
+        self.state = marionette.executables.pioa.MarionetteSystemState()
+        self.state.set_global("multiplexer_outgoing", self.buffer)
+
+    def presend(self, stream_id):
+        cells = None
+        if stream_id:
+            cells = [marionette.record_layer.Cell(1, 1, stream_id, 1)]
+        presend = [REGEX, 128, cells, b'ctxt']
+        self.state.set_prepared("fte.send", presend)
+        return cells
+
+    def test_take(self):
+        """Test that a matching presend is used once."""
+        self.presend(0)
+        self.assertEqual(_fte.take_presend(self.state, REGEX, 128),
+                         (None, b'ctxt'))
+        self.assertEqual(_fte.take_presend(self.state, REGEX, 128),
+                         (None, None))
+
+    def test_different_send(self):
+        """Test that a presend for another send is put back."""
+        cells = self.presend(7)
+        self.assertEqual(_fte.take_presend(self.state, REGEX, 256),
+                         (None, None))
+        self.assertIs(self.buffer.pop(2, 2, 1024), cells[0])
+
+    def test_padding_with_data(self):
+        """Test that prepared padding isn't sent once there's data."""
+        self.presend(0)
+        self.buffer.push(7, b'data')
+        self.assertEqual(_fte.take_presend(self.state, REGEX, 128),
+                         (None, None))
+        self.assertEqual(self.buffer.pop(2, 2, 1024).get_stream_id(), 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
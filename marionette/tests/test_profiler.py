@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Unit tests for marionette.profiler module.
+"""
+
+import sys
+import unittest
+
+sys.path.insert(0, '.')
+
+import marionette.benchmark
+import marionette.conf
+import marionette.profiler
+
+
+class TestStationaryDistribution(unittest.TestCase):
+    """Test the Markov chain analysis."""
+
+    def assertDistributionEqual(self, distribution, expected):
+        self.assertEqual(sorted(distribution), sorted(expected))
+        for state in expected:
+            self.assertAlmostEqual(distribution[state], expected[state],
+                                   places=6)
+
+    def test_cycle(self):
+        """Test that a periodic chain converges."""
+        probabilities = {
+            'start': {'a': 1.0},
+            'a': {'dead': 1.0},
+            'dead': {'start': 1.0},
+        }
+        self.assertDistributionEqual(
+            marionette.profiler.get_stationary_distribution(probabilities),
+            {'start': 1 / 3.0, 'a': 1 / 3.0, 'dead': 1 / 3.0})
+
+    def test_branches(self):
+        """Test that states are visited in proportion to their
+        probability."""
+        probabilities = {
+            'start': {'a': 0.25, 'b': 0.75},
+            'a': {'dead': 1.0},
+            'b': {'b': 0.5, 'dead': 0.5},
+            'dead': {'start': 1.0},
+        }
+        # per connection: start 1, a 0.25, b 0.75 * 2, dead 1
+        self.assertDistributionEqual(
+            marionette.profiler.get_stationary_distribution(probabilities),
+            {'start': 1 / 3.75, 'a': 0.25 / 3.75, 'b': 1.5 / 3.75,
+             'dead': 1 / 3.75})
+
+    def test_never_finishes(self):
+        """Test that states left behind end up with no probability."""
+        probabilities = {
+            'start': {'loop': 1.0},
+            'loop': {'loop': 1.0},
+            'dead': {'start': 1.0},
+        }
+        self.assertDistributionEqual(
+            marionette.profiler.get_stationary_distribution(probabilities),
+            {'start': 0.0, 'loop': 1.0, 'dead': 0.0})
+
+
+class TestProfiler(unittest.TestCase):
+    """Test profiling the formats we ship."""
+
+    def setUp(self):
+        """Make sure fte runs in process."""
+        workers = marionette.conf.get("fte.workers")
+        marionette.conf.set("fte.workers", 0)
+        self.addCleanup(marionette.conf.set, "fte.workers", workers)
+
+    def test_transition_probabilities(self):
+        """Test that dead leads back to start."""
+        executable = marionette.profiler.load_client('http_simple_blocking')
+        probabilities = marionette.profiler.get_transition_probabilities(
+            executable)
+        self.assertEqual(probabilities['start'], {'upstream': 1.0})
+        self.assertEqual(probabilities['dead'], {'start': 1.0})
+
+    def test_request_response(self):
+        """Test a format with one request and one response."""
+        profile = marionette.profiler.profile('http_simple_blocking',
+                                              '20150701')
+        per_connection = profile['per_connection']
+        self.assertAlmostEqual(per_connection['connections'], 1.0)
+        self.assertAlmostEqual(per_connection['messages'], 2.0)
+        self.assertAlmostEqual(profile['round_trips'], 2.0)
+        # a message's worth each way; the request and response regexes
+        # have capacities of their own, so the directions differ
+        executable = marionette.profiler.load_client('http_simple_blocking',
+                                                     '20150701')
+        marionette_state = marionette.benchmark.new_marionette_state()
+        for action in executable.actions_:
+            if action.get_method() != 'send':
+                continue
+            direction = 'up' if action.get_party() == 'client' else 'down'
+            expected = marionette.profiler.get_queued_bytes(marionette_state,
+                                                            action)
+            self.assertGreater(expected, 0)
+            self.assertAlmostEqual(per_connection['payload_' + direction],
+                                   expected)
+        self.assertGreater(profile['goodput_ratio'], 0)
+        self.assertLess(profile['goodput_ratio'], 1)
+        self.assertGreater(profile['cpu_per_byte'], 0)
+
+    def test_sleep(self):
+        """Test that model.sleep counts its mean duration."""
+        profile = marionette.profiler.profile('http_timings')
+        self.assertAlmostEqual(profile['sleep'], 0.0625)
+
+    def test_never_finishes(self):
+        """Test that formats that keep their connection open still get
+        ratios."""
+        profile = marionette.profiler.profile('dummy')
+        self.assertIsNone(profile['per_connection'])
+        self.assertIsNone(profile['round_trips'])
+        self.assertGreater(profile['goodput_ratio'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
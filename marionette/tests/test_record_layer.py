@@ -92,6 +92,107 @@ class Tests(unittest.TestCase):
             cell_actual = buffer.pop()
             self.assertEqual(cell_actual.get_stream_id(), stream_id)
 
+    def test_pushPop_partialCell(self):
+        cell_expected = marionette.record_layer.Cell(1, 1, 1, 1)
+        cell_expected.set_payload('X' * 100)
+        cell_bytes = cell_expected.to_bytes()
+
+        buffer = marionette.multiplexer.BufferIncoming()
+        buffer.push(cell_bytes[:30])
+        self.assertEqual(buffer.pop(), None)
+        buffer.push(cell_bytes[30:-1])
+        self.assertEqual(buffer.pop(), None)
+        buffer.push(cell_bytes[-1:])
+        self.assertEqual(buffer.pop(), cell_expected)
+        self.assertEqual(buffer.fifo_len_, 0)
+
+    def test_popCells_batch(self):
+        buffer = marionette.multiplexer.BufferIncoming()
+        buffer.COMPACT_THRESHOLD = 64
+
+        cells_expected = []
+        data = b''
+        for i in range(50):
+            cell = marionette.record_layer.Cell(1, 1, 1, i + 1)
+            cell.set_payload(b'XXX' + str(i).encode())
+            cells_expected.append(cell)
+            data += cell.to_bytes()
+
+        buffer.push(data + data[:10])
+        self.assertEqual(buffer.pop_cells(), cells_expected)
+        self.assertEqual(buffer.fifo_len_, 10)
+        self.assertEqual(buffer.pop_cells(), [])
+
+        buffer.push(data[10:])
+        self.assertEqual(buffer.pop_cells(), cells_expected)
+        self.assertEqual(len(buffer.fifo_), 0)
+
+    def test_serialize_headerLayout(self):
+        cell = marionette.record_layer.Cell(0x01020304, 5, 6, 7)
+        cell.set_payload('XY')
+        cell_bytes = marionette.record_layer.serialize_to_bytes(cell, 40 * 8)
+
+        expected = (b'\x00\x00\x00\x28' + b'\x00\x00\x00\x02' +
+                    b'\x01\x02\x03\x04' + b'\x00\x00\x00\x05' +
+                    b'\x00\x00\x00\x06' + b'\x00\x00\x00\x07' +
+                    b'\x01' + b'XY' + b'\x00' * 13)
+        self.assertEqual(cell_bytes, expected)
+        self.assertEqual(marionette.record_layer.serialize(cell, 40 * 8),
+                         expected.decode('latin-1'))
+
+    def test_unserializeFrom_offset(self):
+        buf = bytearray(b'junk')
+        for i in range(3):
+            cell = marionette.record_layer.Cell(1, 1, 1, i + 1)
+            cell.set_payload(b'payload' + bytes([i]))
+            buf += cell.to_bytes()
+
+        offset = 4
+        for i in range(3):
+            (cell_actual, consumed) = \
+                marionette.record_layer.unserialize_from(buf, offset)
+            self.assertEqual(cell_actual.get_seq_id(), i + 1)
+            self.assertEqual(cell_actual.get_payload(), b'payload' + bytes([i]))
+            offset += consumed
+        self.assertEqual(offset, len(buf))
+
+    def test_unserializeFrom_partial(self):
+        cell = marionette.record_layer.Cell(1, 1, 1, 1)
+        cell.set_payload('XXX')
+        cell_bytes = cell.to_bytes()
+
+        for i in range(len(cell_bytes)):
+            self.assertEqual(
+                marionette.record_layer.unserialize_from(cell_bytes[:i]),
+                (None, 0))
+
+    def test_unserialize_badLength(self):
+        cell = marionette.record_layer.Cell(1, 1, 1, 1)
+        cell_bytes = cell.to_bytes()
+        self.assertRaises(marionette.record_layer.UnserializeException,
+                          marionette.record_layer.unserialize,
+                          cell_bytes + b'\x00')
+
+    def test_cell_fromMany(self):
+        cells = marionette.record_layer.Cell.from_many(
+            1, 2, 3, 10, [b'a', 'b', bytearray(b'c')], 1024)
+
+        self.assertEqual([c.get_seq_id() for c in cells], [10, 11, 12])
+        self.assertEqual([c.get_payload() for c in cells], [b'a', b'b', b'c'])
+        for cell in cells:
+            self.assertEqual(cell.get_stream_id(), 3)
+            self.assertEqual(len(cell.to_bytes()), 1024 // 8)
+            self.assertFalse(hasattr(cell, '__dict__'))
+
+    def test_cell_memoryviewPayload(self):
+        cell_expected = marionette.record_layer.Cell(1, 1, 1, 1)
+        cell_expected.set_payload(b'XXX')
+        cell_actual = marionette.record_layer.Cell(1, 1, 1, 1)
+        cell_actual.set_payload(memoryview(b'_XXX_')[1:4])
+
+        self.assertEqual(cell_actual, cell_expected)
+        self.assertEqual(cell_actual.to_bytes(), cell_expected.to_bytes())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Unit tests for marionette.scheduler module.
+"""
+
+import sys
+import unittest
+
+sys.path.insert(0, '.')
+
+import marionette.multiplexer
+import marionette.record_layer
+import marionette.scheduler
+
+
+class TestSchedulers(unittest.TestCase):
+    """Behaviour shared by all schedulers."""
+
+    def test_add_remove(self):
+        """Test tracking of active streams."""
+        for name in marionette.scheduler.SCHEDULERS:
+            scheduler = marionette.scheduler.new_scheduler(name)
+            self.assertEqual(scheduler.next(), None)
+
+            for stream_id in [1, 2, 3]:
+                scheduler.add(stream_id)
+                scheduler.add(stream_id)
+            self.assertEqual(len(scheduler), 3)
+
+            scheduler.remove(2)
+            scheduler.remove(2)
+            self.assertEqual(len(scheduler), 2)
+            self.assertIn(scheduler.next(), [1, 3])
+
+            scheduler.remove(1)
+            scheduler.remove(3)
+            self.assertEqual(scheduler.next(), None)
+
+    def test_peek(self):
+        """Test that peek() returns what next() will, and changes nothing."""
+        for name in marionette.scheduler.SCHEDULERS:
+            scheduler = marionette.scheduler.new_scheduler(name)
+            self.assertEqual(scheduler.peek(), None)
+            for stream_id in [1, 2, 3]:
+                scheduler.add(stream_id)
+
+            for i in range(50):
+                stream_id = scheduler.peek()
+                self.assertEqual(scheduler.peek(), stream_id)
+                self.assertEqual(scheduler.next(), stream_id)
+                scheduler.charge(stream_id, 5000 * stream_id)
+
+    def test_drr_peek_is_pure(self):
+        """Test that a DRR peek doesn't start a new round."""
+        scheduler = marionette.scheduler.DeficitRoundRobinScheduler(100)
+        scheduler.set_weight(3, 4)
+        for stream_id in [1, 2, 3]:
+            scheduler.add(stream_id)
+        scheduler.charge(1, 250)
+        scheduler.charge(2, 250)
+        scheduler.charge(3, 500)
+
+        state = list(scheduler.active_.items())
+        # no deficit is positive; 1 and 2 need two top-ups of 100, 3 one
+        # of 400
+        self.assertEqual(scheduler.peek(), 3)
+        self.assertEqual(list(scheduler.active_.items()), state)
+        self.assertEqual(scheduler.next(), 3)
+
+    def test_unknown_scheduler(self):
+        """Test that unknown scheduler names are rejected."""
+        self.assertRaises(ValueError,
+                          marionette.scheduler.new_scheduler, 'fifo')
+
+
+class TestDeficitRoundRobinScheduler(unittest.TestCase):
+    """Test DeficitRoundRobinScheduler class."""
+
+    def serve(self, scheduler, cell_sizes, rounds):
+        sent = {}
+        for i in range(rounds):
+            stream_id = scheduler.next()
+            sent[stream_id] = sent.get(stream_id, 0) + cell_sizes[stream_id]
+            scheduler.charge(stream_id, cell_sizes[stream_id])
+        return sent
+
+    def test_byte_fairness(self):
+        """Test that streams get equal bytes regardless of cell size."""
+        scheduler = marionette.scheduler.DeficitRoundRobinScheduler(1000)
+        scheduler.add(1)
+        scheduler.add(2)
+
+        sent = self.serve(scheduler, {1: 100, 2: 500}, 1200)
+        self.assertAlmostEqual(sent[1] / float(sent[2]), 1.0, delta=0.05)
+
+    def test_weights(self):
+        """Test that weights scale each stream's share."""
+        scheduler = marionette.scheduler.DeficitRoundRobinScheduler(1000)
+        scheduler.set_weight(2, 3)
+        scheduler.add(1)
+        scheduler.add(2)
+
+        sent = self.serve(scheduler, {1: 100, 2: 100}, 4000)
+        self.assertAlmostEqual(sent[2] / float(sent[1]), 3.0, delta=0.1)
+
+    def test_small_weights(self):
+        """Test that weights must be positive, and that a weight too small
+        for a byte of quantum still gets served."""
+        scheduler = marionette.scheduler.DeficitRoundRobinScheduler(1000)
+        self.assertRaises(ValueError, scheduler.set_weight, 1, 0)
+        self.assertRaises(ValueError, scheduler.set_weight, 1, -2)
+
+        scheduler.set_weight(1, 0.0001)
+        scheduler.add(1)
+        sent = self.serve(scheduler, {1: 100}, 10)
+        self.assertEqual(sent, {1: 1000})
+
+    def test_remove_middle(self):
+        """Test that removing a stream keeps the others' order."""
+        scheduler = marionette.scheduler.DeficitRoundRobinScheduler(100)
+        for stream_id in [1, 2, 3]:
+            scheduler.add(stream_id)
+        scheduler.remove(2)
+        self.assertEqual(len(scheduler), 2)
+        sent = self.serve(scheduler, {1: 100, 3: 100}, 4)
+        self.assertEqual(sent, {1: 200, 3: 200})
+
+
+class TestPriorityScheduler(unittest.TestCase):
+    """Test PriorityScheduler class."""
+
+    def test_interactive_first(self):
+        """Test that new streams preempt streams that already sent a lot."""
+        scheduler = marionette.scheduler.PriorityScheduler(1000)
+        scheduler.add(1)
+        scheduler.charge(1, 5000)
+        self.assertEqual(scheduler.next(), 1)
+
+        scheduler.add(2)
+        self.assertEqual(scheduler.next(), 2)
+        scheduler.charge(2, 500)
+        self.assertEqual(scheduler.next(), 2)
+        scheduler.charge(2, 600)
+        self.assertEqual(scheduler.next(), 1)
+
+        scheduler.remove(2)
+        scheduler.add(2)
+        self.assertEqual(scheduler.next(), 2)
+
+
+class TestBufferOutgoingScheduling(unittest.TestCase):
+    """Test BufferOutgoing with the different schedulers."""
+
+    def test_all_data_delivered(self):
+        """Test that every scheduler drains all streams and ends them."""
+        n = marionette.record_layer.PAYLOAD_HEADER_SIZE_IN_BITS + 64 * 8
+        for name in marionette.scheduler.SCHEDULERS:
+            buffer = marionette.multiplexer.BufferOutgoing(name)
+            for stream_id in range(1, 11):
+                buffer.push(stream_id, b'x' * (stream_id * 100))
+                buffer.terminate(stream_id)
+
+            received = {}
+            ended = set()
+            while len(ended) < 10:
+                cell = buffer.pop(1, 1, n)
+                stream_id = cell.get_stream_id()
+                self.assertNotEqual(stream_id, 0)
+                if cell.get_cell_type() == \
+                        marionette.record_layer.END_OF_STREAM:
+                    ended.add(stream_id)
+                else:
+                    received[stream_id] = received.get(stream_id, 0) + \
+                        len(cell.get_payload())
+
+            for stream_id in range(1, 11):
+                self.assertEqual(received[stream_id], stream_id * 100)
+            self.assertEqual(buffer.pop(1, 1, n).get_stream_id(), 0)
+            self.assertEqual(len(buffer.scheduler_), 0)
+
+    def test_has_data_matches_pop(self):
+        """Test that the stream reported by has_data_for_any_stream is
+        the one the next pop is cut from."""
+        n = marionette.record_layer.PAYLOAD_HEADER_SIZE_IN_BITS + 64 * 8
+        for name in marionette.scheduler.SCHEDULERS:
+            buffer = marionette.multiplexer.BufferOutgoing(name)
+            for stream_id in range(1, 6):
+                buffer.push(stream_id, b'x' * 1000)
+
+            while buffer.has_data_for_any_stream():
+                stream_id = buffer.has_data_for_any_stream()
+                self.assertEqual(buffer.pop(1, 1, n).get_stream_id(),
+                                 stream_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import unittest
+
+sys.path.insert(0, '.')
+
+import marionette.dsl
+import marionette.plugins._tg
+
+
+class TestTgHandlers(unittest.TestCase):
+    """Test lazy construction of tg handlers."""
+
+    def setUp(self):
+        marionette.plugins._tg.conf.clear()
+        marionette.dsl.invalidate_compiled_formats()
+
+    def test_get_conf(self):
+        """Test that handlers are built once, on first use."""
+        grammar_conf = marionette.plugins._tg.get_conf("pop3_password")
+        self.assertEqual(list(marionette.plugins._tg.conf), ["pop3_password"])
+        self.assertIsInstance(grammar_conf["handlers"]["PASSWORD"],
+                              marionette.plugins._tg.RankerHandler)
+        self.assertIs(marionette.plugins._tg.get_conf("pop3_password"),
+                      grammar_conf)
+
+    def test_unused_handlers_skipped(self):
+        """Test that handlers missing from handler_order aren't built."""
+        grammar_conf = marionette.plugins._tg.get_conf("http_response_close")
+        self.assertNotIn("COOKIE", grammar_conf["handlers"])
+        self.assertEqual(sorted(grammar_conf["handlers"]),
+                         sorted(grammar_conf["handler_order"]))
+
+    def test_warm_up_on_load(self):
+        """Test that loading a format builds exactly its grammars."""
+        format_name = 'http_simple_blocking_with_msg_lens'
+        mar_files = marionette.dsl.find_mar_files('client', format_name,
+                                                  '20150701')
+        marionette.dsl.load('client', format_name, mar_files[0])
+        self.assertEqual(sorted(marionette.plugins._tg.conf),
+                         ["http_request_keep_alive_with_msg_lens",
+                          "http_response_keep_alive_with_msg_lens"])
+        self.assertTrue(marionette.plugins._tg.templates)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Unit tests for marionette.wakeup module.
+"""
+
+import sys
+import unittest
+from unittest import mock
+
+from twisted.internet import task
+
+sys.path.insert(0, '.')
+
+import marionette.channel
+import marionette.driver
+import marionette.executables.pioa
+import marionette.plugins._model
+import marionette.wakeup
+
+
+class TestWakeup(unittest.TestCase):
+    """Test Wakeup class."""
+
+    def setUp(self):
+        """Set up test fixtures."""
+        self.clock = task.Clock()
+        self.calls = []
+        self.wakeup = marionette.wakeup.Wakeup(
+            lambda reactor: self.calls.append(reactor.seconds()))
+
+    def test_coalesce(self):
+        """Test that repeated requests result in a single call."""
+        for i in range(10):
+            self.wakeup.schedule(self.clock, 1.0)
+        self.assertTrue(self.wakeup.is_pending())
+
+        self.clock.advance(0.5)
+        self.assertEqual(self.calls, [])
+        self.clock.advance(0.5)
+        self.assertEqual(self.calls, [1.0])
+        self.clock.advance(5)
+        self.assertEqual(self.calls, [1.0])
+        self.assertFalse(self.wakeup.is_pending())
+
+    def test_earlier_request_wins(self):
+        """Test that an earlier request replaces a later one."""
+        self.wakeup.schedule(self.clock, 1.0)
+        self.wakeup.schedule(self.clock, 0.25)
+        self.wakeup.schedule(self.clock, 0.5)
+
+        self.clock.advance(0.25)
+        self.assertEqual(self.calls, [0.25])
+        self.clock.advance(5)
+        self.assertEqual(self.calls, [0.25])
+
+    def test_cancel(self):
+        """Test cancelling a pending call."""
+        self.wakeup.schedule(self.clock, 1.0)
+        self.wakeup.cancel()
+
+        self.clock.advance(5)
+        self.assertEqual(self.calls, [])
+
+
+class TestChannelDataCallback(unittest.TestCase):
+    """Test that channels report incoming data."""
+
+    def test_append_notifies(self):
+        """Test that appendToBuffer calls the registered callbacks."""
+        channel = marionette.channel.Channel(None, 'tcp')
+        calls = []
+        callback = lambda: calls.append(channel.peek())
+
+        channel.add_data_callback(callback)
+        channel.add_data_callback(callback)
+        channel.appendToBuffer(b'abc')
+        self.assertEqual(calls, ['abc'])
+
+        channel.remove_data_callback(callback)
+        channel.appendToBuffer(b'def')
+        self.assertEqual(calls, ['abc'])
+
+
+class TestSleep(unittest.TestCase):
+    """Test that model.sleep waits for a deadline instead of blocking."""
+
+    DIST = "{'0.025' : 0.25,\n  '0.05': 0.25, '0.1': 0.5, '0': 0.0}"
+
+    def setUp(self):
+        """Control time and the coin sleep draws."""
+        self.now = 100.0
+        patcher = mock.patch('time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('random.random', lambda: 0.3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.state = marionette.executables.pioa.MarionetteSystemState()
+
+    def sleep(self):
+        return marionette.plugins._model.sleep(None, self.state, [self.DIST])
+
+    def test_parse(self):
+        """Test parsing a distribution, once."""
+        self.assertEqual(
+            marionette.plugins._model.parse_sleep_distribution(self.DIST),
+            {0.025: 0.25, 0.05: 0.25, 0.1: 0.5})
+
+        sampler = marionette.plugins._model.get_sleep_sampler(self.DIST)
+        self.assertIs(marionette.plugins._model.get_sleep_sampler(self.DIST),
+                      sampler)
+        self.assertEqual(sampler.sample(0.0), 0.025)
+        self.assertEqual(sampler.sample(0.25), 0.025)
+        self.assertEqual(sampler.sample(0.3), 0.05)
+        self.assertEqual(sampler.sample(0.99), 0.1)
+        self.assertAlmostEqual(sampler.get_mean(), 0.06875)
+
+    def test_parsed_on_load(self):
+        """Test that a format's distributions are parsed when it's loaded,
+        and dropped once it's gone and they're no longer recent."""
+        import gc
+        import marionette.dsl
+
+        marionette.dsl.invalidate_compiled_formats('http_timings')
+        mar_path = marionette.dsl.find_mar_files('client', 'http_timings',
+                                                 '20150701')[0]
+        executable = marionette.dsl.load('client', 'http_timings', mar_path)
+        sleep_dists = [action.get_args()[0] for action in executable.actions_
+                       if action.get_module() == 'model' and
+                       action.get_method() == 'sleep']
+        self.assertTrue(sleep_dists)
+        for sleep_dist in sleep_dists:
+            self.assertIn(marionette.plugins._model.sleep_samplers_[sleep_dist],
+                          executable.sleep_samplers_)
+        self.assertIs(executable.replicate().sleep_samplers_,
+                      executable.sleep_samplers_)
+
+        marionette.dsl.invalidate_compiled_formats('http_timings')
+        del executable
+        gc.collect()
+        for sleep_dist in sleep_dists:
+            self.assertIn(sleep_dist, marionette.plugins._model.sleep_samplers_)
+
+        marionette.plugins._model.recent_sleep_samplers_.clear()
+        gc.collect()
+        for sleep_dist in sleep_dists:
+            self.assertNotIn(sleep_dist, marionette.plugins._model.sleep_samplers_)
+
+    def test_parsed_once(self):
+        """Test that a distribution no loaded format uses is parsed once,
+        and that only the most recent ones are kept."""
+        import gc
+
+        calls = []
+        parse = marionette.plugins._model.parse_sleep_distribution
+
+        def parse_sleep_distribution(sleep_dist):
+            calls.append(sleep_dist)
+            return parse(sleep_dist)
+        patcher = mock.patch.object(marionette.plugins._model,
+                                    'parse_sleep_distribution',
+                                    parse_sleep_distribution)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        dist = "{'0.5': 1.0}"
+        for i in range(3):
+            marionette.plugins._model.get_sleep_sampler(dist)
+            gc.collect()
+        self.assertEqual(calls, [dist])
+
+        for i in range(marionette.plugins._model.MAX_RECENT_SLEEP_SAMPLERS):
+            marionette.plugins._model.get_sleep_sampler(
+                "{'%d': 1.0}" % (i + 1))
+        gc.collect()
+        self.assertNotIn(dist, marionette.plugins._model.sleep_samplers_)
+
+    def test_sleep(self):
+        """Test that the transition is held until the deadline."""
+        self.assertFalse(self.sleep())
+        self.assertEqual(self.state.get_deadline(), 100.05)
+        self.assertAlmostEqual(self.state.pop_wakeup_delay(), 0.05)
+
+        self.now += 0.02
+        self.assertFalse(self.sleep())
+        self.assertAlmostEqual(self.state.pop_wakeup_delay(), 0.03)
+
+        self.now += 0.03
+        self.assertTrue(self.sleep())
+        self.assertIsNone(self.state.get_deadline())
+
+    def test_no_duration(self):
+        """Test that a distribution without durations doesn't hold up."""
+        self.assertTrue(marionette.plugins._model.sleep(
+            None, self.state, ["{'0': 1.0}"]))
+        self.assertIsNone(self.state.get_deadline())
+
+
+
+class TestSpawn(unittest.TestCase):
+    """Test how model.spawn ends the models it started."""
+
+    def setUp(self):
+        self.driver = marionette.driver.ServerDriver('server')
+        self.driver.executable_ = mock.Mock()
+        self.running = mock.Mock()
+        self.driver.running_ = [self.running]
+        self.addCleanup(setattr, marionette.plugins._model,
+                        'server_driver_', None)
+
+    def test_spawned_models_finish(self):
+        """Test that models still running when spawn has seen enough of
+        them finish are left to complete."""
+        self.driver.num_executables_completed_ = 2
+        marionette.plugins._model.server_driver_ = self.driver
+        state = marionette.executables.pioa.MarionetteSystemState()
+        state.set_local("party", "server")
+
+        self.assertTrue(marionette.plugins._model.spawn(
+            None, state, ['dummy', '2']))
+        self.assertIsNone(marionette.plugins._model.server_driver_)
+        self.driver.executable_.stop.assert_called_once_with()
+        self.running.stop.assert_not_called()
+        self.assertEqual(self.driver.running_, [self.running])
+
+    def test_stop_all(self):
+        """Test that stopping a server stops its running models."""
+        self.driver.stop_all()
+        self.driver.executable_.stop.assert_called_once_with()
+        self.running.stop.assert_called_once_with()
+        self.assertEqual(self.driver.running_, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
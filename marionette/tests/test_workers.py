@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import select
+import socket
+import unittest
+
+sys.path.insert(0, '.')
+
+import marionette.workers
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'),
+                     'SO_REUSEPORT steering needs Linux')
+class TestReuseportGroup(unittest.TestCase):
+    """Test SO_REUSEPORT groups steered by source address."""
+
+    def setUp(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.sockets = marionette.workers.bind_reuseport_group(
+            'tcp', '0.0.0.0', self.port, 4)
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+    def accepted_by(self, src_ip):
+        client = socket.socket()
+        client.bind((src_ip, 0))
+        client.connect(('127.0.0.1', self.port))
+        try:
+            readable, _, _ = select.select(self.sockets, [], [], 1)
+            self.assertEqual(len(readable), 1)
+            readable[0].accept()[0].close()
+            return self.sockets.index(readable[0])
+        finally:
+            client.close()
+
+    def test_steering(self):
+        """Test that a source address always reaches the same socket."""
+        for (src_ip, slot) in [('127.0.0.1', 1), ('127.0.0.2', 2),
+                               ('127.0.0.4', 0)]:
+            for i in range(4):
+                self.assertEqual(self.accepted_by(src_ip), slot)
+
+    def test_inherited_sockets(self):
+        """Test the encoding of a worker's sockets."""
+        sockets = {('tcp', self.port): self.sockets[0]}
+        value = marionette.workers.format_inherited_sockets(sockets)
+        self.assertEqual(value, 'tcp:%d:%d' % (self.port,
+                                               self.sockets[0].fileno()))
+
+        parsed = marionette.workers.parse_inherited_sockets(value)
+        self.assertEqual(list(parsed), [('tcp', self.port)])
+        self.assertEqual(parsed[('tcp', self.port)].fileno(),
+                         self.sockets[0].fileno())
+        parsed[('tcp', self.port)].detach()
+
+
+class TestWorkerArgv(unittest.TestCase):
+    """Test the command line each worker runs."""
+
+    def test_metrics_listen(self):
+        """Test that each worker serves metrics on its own address."""
+        self.assertIsNone(marionette.workers.get_metrics_listen('', 1))
+        self.assertEqual(
+            [marionette.workers.get_metrics_listen('127.0.0.1:9100', slot)
+             for slot in range(3)],
+            ['127.0.0.1:9100', '127.0.0.1:9101', '127.0.0.1:9102'])
+        self.assertEqual(
+            marionette.workers.get_metrics_listen('[::1]:9100', 2),
+            '[::1]:9102')
+        self.assertEqual(
+            marionette.workers.get_metrics_listen('unix:/run/m.sock', 1),
+            'unix:/run/m.sock.1')
+
+    def test_strip_option(self):
+        """Test that --metrics is dropped from the supervisor's argv."""
+        for argv in [['server', '--metrics', ':9100', '-w', '4'],
+                     ['server', '--metrics=:9100', '-w', '4']]:
+            self.assertEqual(
+                marionette.workers.strip_option(argv, '--metrics'),
+                ['server', '-w', '4'])
+
+
+class TestListenPorts(unittest.TestCase):
+    """Test finding the ports a format listens on."""
+
+    def test_dummy(self):
+        self.assertEqual(marionette.workers.get_listen_ports('dummy'),
+                         [('tcp', 8082)])
+
+
+if __name__ == "__main__":
+    unittest.main()
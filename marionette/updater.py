@@ -80,9 +80,7 @@ class FormatUpdater(object):
                 self.install_package(format_package)
 
     def package_exists(self, format_package):
-        format_dir = marionette.dsl.get_format_dir()
-        package_dir = os.path.join(format_dir, format_package)
-        return os.path.isdir(package_dir)
+        return marionette.dsl.get_format_index().has_version(format_package)
 
     def install_package(self, format_package):
         package_file_url = 'http://%s/%s.tar.gz' % (self.addr_, format_package)
@@ -103,5 +101,8 @@ class FormatUpdater(object):
         tar.extractall(package_dir)
         tar.close()
 
+        marionette.dsl.refresh_format_index()
+        marionette.dsl.invalidate_compiled_formats()
+
         if self.callback_:
             self.callback_()
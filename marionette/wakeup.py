@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+class Wakeup(object):
+    """Coalesces requests to run ``callback(reactor)`` into at most one
+    pending reactor call.
+
+    Requesting a wakeup while one is already pending only has an effect if
+    the new one is due earlier, in which case it replaces the old one.
+    """
+
+    def __init__(self, callback):
+        self.callback_ = callback
+        self.call_ = None
+
+    def schedule(self, reactor, delay=0):
+        if self.call_ is not None and self.call_.active():
+            if self.call_.getTime() <= reactor.seconds() + delay:
+                return
+            self.call_.cancel()
+        self.call_ = reactor.callLater(delay, self.fire, reactor)
+
+    def fire(self, reactor):
+        self.call_ = None
+        self.callback_(reactor)
+
+    def cancel(self):
+        if self.call_ is not None and self.call_.active():
+            self.call_.cancel()
+        self.call_ = None
+
+    def is_pending(self):
+        return self.call_ is not None and self.call_.active()
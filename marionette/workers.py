@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Multi-process servers.
+
+A Supervisor runs N copies of the server as child processes. For each
+fixed port the server format listens on, the supervisor binds one socket per
+worker with SO_REUSEPORT and each worker inherits its own.
+
+A marionette session is spread over many connections, so all connections
+from one client have to reach the same worker. A classic BPF program on each
+port's reuseport group therefore picks the socket from the client's source
+address instead of the kernel's default 4-tuple hash. The supervisor keeps
+every socket open, so a restarted worker takes over the socket (and the
+clients) of the worker it replaces and the other workers are undisturbed.
+
+Each worker keeps its own metrics, so with metrics enabled each one serves
+them on its own address, derived from the configured one by its slot: port
++ slot for host:port, PATH.slot for unix:PATH.
+"""
+
+import os
+import sys
+import time
+import ctypes
+import signal
+import socket
+import struct
+import subprocess
+
+sys.path.append('.')
+
+import marionette.conf
+import marionette.dsl
+
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+SO_ATTACH_REUSEPORT_CBPF = 51
+
+# classic BPF
+BPF_LD_W_ABS = 0x20
+BPF_ALU_MOD_K = 0x94
+BPF_RET_A = 0x16
+SKF_NET_OFF = -0x100000
+
+LISTEN_BACKLOG = 128
+
+# a worker that exits sooner than this after starting is restarted with
+# exponential backoff, up to MAX_RESTART_DELAY_S
+MIN_UPTIME_S = 10.0
+RESTART_DELAY_S = 0.5
+MAX_RESTART_DELAY_S = 30.0
+POLL_INTERVAL_S = 0.2
+SHUTDOWN_TIMEOUT_S = 5.0
+
+
+def get_listen_ports(format_name, format_version=None):
+    """Returns the (transport_protocol, port) pairs with a fixed port number
+    that the server models for format_name, and any models they spawn,
+    listen on."""
+    retval = set()
+
+    to_visit = [(format_name, format_version)]
+    visited = set()
+    while to_visit:
+        (name, version) = to_visit.pop()
+        if (name, version) in visited:
+            continue
+        visited.add((name, version))
+
+        for executable in marionette.dsl.load_all('server', name, version):
+            port = executable.get_port()
+            if isinstance(port, int):
+                retval.add((executable.get_transport_protocol(), port))
+
+            for action in executable.actions_:
+                if action.get_module() == 'model' and \
+                        action.get_method() == 'spawn':
+                    to_visit.append((action.get_args()[0], version))
+
+    return sorted(retval)
+
+
+def steering_program(num_sockets, family):
+    """Returns a BPF program for SO_ATTACH_REUSEPORT_CBPF that picks socket
+    (last 32 bits of source address) % num_sockets."""
+    if family == socket.AF_INET6:
+        src_offset = 8 + 12
+    else:
+        src_offset = 12
+
+    instructions = [
+        (BPF_LD_W_ABS, 0, 0, (SKF_NET_OFF + src_offset) & 0xffffffff),
+        (BPF_ALU_MOD_K, 0, 0, num_sockets),
+        (BPF_RET_A, 0, 0, 0),
+    ]
+    return b''.join(struct.pack('HBBI', *instruction)
+                    for instruction in instructions)
+
+
+def attach_steering_program(sock, num_sockets):
+    program = steering_program(num_sockets, sock.family)
+    buf = ctypes.create_string_buffer(program)
+    fprog = struct.pack('HL', len(program) // 8, ctypes.addressof(buf))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, fprog)
+
+
+def bind_reuseport_group(transport_protocol, ip, port, num_sockets):
+    """Binds num_sockets sockets to ip:port with SO_REUSEPORT, steered by
+    source address. Socket i serves the clients that hash to i."""
+    family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+    sock_type = socket.SOCK_STREAM if transport_protocol == 'tcp' \
+        else socket.SOCK_DGRAM
+
+    retval = []
+    for i in range(num_sockets):
+        sock = socket.socket(family, sock_type)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind((ip, port))
+        if transport_protocol == 'tcp':
+            sock.listen(LISTEN_BACKLOG)
+        sock.setblocking(False)
+        retval.append(sock)
+
+    attach_steering_program(retval[0], num_sockets)
+
+    return retval
+
+
+def format_inherited_sockets(sockets):
+    """Encodes {(transport_protocol, port): sock} for a worker's command
+    line; see parse_inherited_sockets."""
+    return ','.join('%s:%d:%d' % (transport_protocol, port, sock.fileno())
+                    for ((transport_protocol, port), sock)
+                    in sorted(sockets.items()))
+
+
+def parse_inherited_sockets(value):
+    retval = {}
+    for entry in value.split(','):
+        if not entry:
+            continue
+        (transport_protocol, port, fd) = entry.split(':')
+        sock_type = socket.SOCK_STREAM if transport_protocol == 'tcp' \
+            else socket.SOCK_DGRAM
+        retval[(transport_protocol, int(port))] = socket.socket(
+            type=sock_type, fileno=int(fd))
+    return retval
+
+
+def get_metrics_listen(listen, slot):
+    """Returns the address worker slot serves its metrics on, for the
+    configured address listen (host:port or unix:PATH)."""
+    if not listen:
+        return None
+    if listen.startswith('unix:'):
+        return '%s.%d' % (listen, slot)
+    (host, port) = listen.rsplit(':', 1)
+    return '%s:%d' % (host, int(port) + slot)
+
+
+def strip_option(argv, option):
+    """Returns argv without option and its value, given either as
+    ``option value`` or ``option=value``."""
+    retval = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == option:
+            skip = True
+        elif not arg.startswith(option + '='):
+            retval.append(arg)
+    return retval
+
+
+class Worker(object):
+
+    def __init__(self, slot, sockets, metrics_listen=None):
+        self.slot_ = slot
+        self.sockets_ = sockets
+        self.metrics_listen_ = metrics_listen
+        self.process_ = None
+        self.started_ = None
+        self.restart_delay_ = RESTART_DELAY_S
+        self.restart_at_ = None
+
+    def start(self, argv):
+        argv = argv + ['--worker_sockets',
+                       format_inherited_sockets(self.sockets_)]
+        if self.metrics_listen_:
+            argv += ['--metrics', self.metrics_listen_]
+        fds = [sock.fileno() for sock in self.sockets_.values()]
+        self.process_ = subprocess.Popen(argv, pass_fds=fds)
+        self.started_ = time.time()
+        self.restart_at_ = None
+
+    def poll(self):
+        """Returns the worker's exit status if it has exited, else None."""
+        if self.process_ is None:
+            return None
+        retval = self.process_.poll()
+        if retval is not None:
+            self.process_ = None
+        return retval
+
+    def schedule_restart(self):
+        if time.time() - self.started_ < MIN_UPTIME_S:
+            self.restart_delay_ = min(self.restart_delay_ * 2,
+                                      MAX_RESTART_DELAY_S)
+        else:
+            self.restart_delay_ = RESTART_DELAY_S
+        self.restart_at_ = time.time() + self.restart_delay_
+
+    def is_running(self):
+        return self.process_ is not None
+
+    def get_pid(self):
+        return self.process_.pid if self.process_ else None
+
+    def terminate(self):
+        if self.process_:
+            self.process_.terminate()
+
+    def kill(self):
+        if self.process_:
+            self.process_.kill()
+            self.process_.wait()
+            self.process_ = None
+
+
+class Supervisor(object):
+    """Starts num_workers copies of the command argv, each with its own
+    listening sockets for listen_ports, and restarts them when they exit.
+    argv must not set --metrics; with ``listen`` set in the [metrics]
+    section of marionette.conf each worker gets its own address instead."""
+
+    def __init__(self, num_workers, listen_ports, argv):
+        self.argv_ = argv
+        self.stopping_ = False
+
+        server_ip = marionette.conf.get("server.server_ip")
+        groups = {}
+        for (transport_protocol, port) in listen_ports:
+            groups[(transport_protocol, port)] = bind_reuseport_group(
+                transport_protocol, server_ip, port, num_workers)
+
+        metrics_listen = marionette.conf.get("metrics.listen")
+        self.workers_ = []
+        for slot in range(num_workers):
+            sockets = {}
+            for key in groups:
+                sockets[key] = groups[key][slot]
+            self.workers_.append(Worker(
+                slot, sockets, get_metrics_listen(metrics_listen, slot)))
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+
+        for worker in self.workers_:
+            worker.start(self.argv_)
+            log("worker %d started (pid %d)" % (worker.slot_,
+                                               worker.get_pid()))
+            if worker.metrics_listen_:
+                log("worker %d serves metrics on %s" % (
+                    worker.slot_, worker.metrics_listen_))
+
+        while not self.stopping_:
+            self.check_workers()
+            time.sleep(POLL_INTERVAL_S)
+
+        self.shutdown()
+
+    def check_workers(self):
+        for worker in self.workers_:
+            status = worker.poll()
+            if status is not None:
+                worker.schedule_restart()
+                log("worker %d exited with status %d, restarting in %.1fs" %
+                    (worker.slot_, status, worker.restart_delay_))
+
+            if not worker.is_running() and worker.restart_at_ is not None \
+                    and time.time() >= worker.restart_at_:
+                worker.start(self.argv_)
+                log("worker %d restarted (pid %d)" % (worker.slot_,
+                                                     worker.get_pid()))
+
+    def handle_signal(self, signum, frame):
+        self.stopping_ = True
+
+    def shutdown(self):
+        for worker in self.workers_:
+            worker.terminate()
+
+        deadline = time.time() + SHUTDOWN_TIMEOUT_S
+        while time.time() < deadline:
+            for worker in self.workers_:
+                worker.poll()
+            if not any(worker.is_running() for worker in self.workers_):
+                break
+            time.sleep(POLL_INTERVAL_S)
+
+        for worker in self.workers_:
+            worker.kill()
+
+
+def log(msg):
+    # the supervisor doesn't run a reactor, so it doesn't use twisted's log
+    sys.stderr.write("marionette supervisor[%d]: %s\n" % (os.getpid(), msg))
+    sys.stderr.flush()
@@ -16,9 +16,10 @@ setup(
     author_email='kpdyer@gmail.com',
     url='https://github.com/marionette-tg/marionette',
     license='MIT',
-    scripts=['bin/marionette_client', 'bin/marionette_server'],
+    scripts=['bin/marionette_client', 'bin/marionette_server',
+             'bin/marionette_compile'],
     packages=find_packages(),
-    package_data={'marionette': ['marionette.conf', 'formats/*.mar', 'formats/**/*.mar', 'formats/**/**/*.mar']},
+    package_data={'marionette': ['marionette.conf', 'formats/*.mar', 'formats/**/*.mar', 'formats/**/**/*.mar', 'formats/*.mar.json', 'formats/**/*.mar.json', 'formats/**/**/*.mar.json']},
     include_package_data=True,
     python_requires='>=3.10',
     install_requires=[